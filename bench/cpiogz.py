@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Compare the built-in cpio/gzip writer with the C{find | cpio | gzip -9}
+pipeline it replaced.
+
+Usage: cpiogz.py [<tree> [<levels> [<threads>]]]
+
+Archives C{<tree>}, or a generated initrd-like tree of about 60MB if none is
+given, with the pipeline and with writeCpioGz at each of the comma-separated
+C{<levels>} (default 9,6,1). Each built-in archive is checked by unpacking it
+with C{gzip -dc | cpio} and comparing the file list and contents with the
+tree. C{cpio} can be GNU cpio or bsdcpio.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from jobmaster.cpiogz import writeCpioGz
+from jobmaster.util import cpuCount, listTree
+
+
+def find_cpio():
+    for name in ('cpio', 'bsdcpio'):
+        for path in os.environ.get('PATH', '').split(':'):
+            if os.access(os.path.join(path, name), os.X_OK):
+                return name
+    sys.exit("No cpio found")
+
+
+def make_tree(top):
+    """Something shaped like an installer initrd: binaries, libraries,
+    modules, text, links."""
+    rand = random.Random(42)
+    words = ['module', 'kernel', 'install', 'anaconda', 'device', 'driver',
+            'network', 'storage', 'firmware', 'python', 'config', 'lib']
+    for n in range(40):
+        d = os.path.join(top, 'lib/modules/%02d' % n)
+        os.makedirs(d)
+        for m in range(25):
+            # Module-ish: half repetitive, half noise
+            size = rand.randint(4096, 65536)
+            text = ' '.join(rand.choice(words)
+                    for x in range(size / 16))[:size / 2]
+            noise = os.urandom(size / 4)
+            open(os.path.join(d, 'mod%02d.ko' % m), 'wb').write(
+                    text + noise + text[:size / 4])
+    os.makedirs(os.path.join(top, 'usr/share/doc'))
+    for n in range(300):
+        open(os.path.join(top, 'usr/share/doc/file%d.txt' % n), 'w').write(
+                '\n'.join(' '.join(rand.choice(words) for x in range(12))
+                    for y in range(rand.randint(10, 400))))
+    os.makedirs(os.path.join(top, 'sbin'))
+    open(os.path.join(top, 'sbin/busybox'), 'wb').write(os.urandom(1 << 20))
+    for name in ('ls', 'cp', 'mount', 'sh'):
+        os.link(os.path.join(top, 'sbin/busybox'),
+                os.path.join(top, 'sbin', name))
+    os.symlink('busybox', os.path.join(top, 'sbin/init'))
+
+
+def run_pipeline(tree, output, cpio):
+    if cpio == 'cpio':
+        archive = 'cpio --quiet -c -o'
+    else:
+        archive = 'bsdcpio --quiet -o --format newc'
+    subprocess.check_call('find . | %s | gzip -9 > %s' % (archive, output),
+            shell=True, cwd=tree)
+
+
+def verify(tree, output, cpio):
+    """Unpack C{output} with the system tools and compare it to C{tree}."""
+    unpacked = tempfile.mkdtemp(prefix='cpiogz-check-')
+    try:
+        subprocess.check_call('gzip -t %s && gzip -dc %s | %s --quiet -id'
+                % (output, output, cpio), shell=True, cwd=unpacked)
+        expected = listTree(tree)
+        actual = listTree(unpacked)
+        if expected != actual:
+            return 'file lists differ'
+        for path in expected:
+            a = os.path.join(tree, path)
+            b = os.path.join(unpacked, path)
+            if os.path.islink(a):
+                if os.readlink(a) != os.readlink(b):
+                    return 'link %s differs' % path
+            elif os.path.isfile(a):
+                if digest(a) != digest(b):
+                    return 'contents of %s differ' % path
+                if os.stat(a).st_mode != os.stat(b).st_mode:
+                    return 'mode of %s differs' % path
+        return 'ok'
+    finally:
+        shutil.rmtree(unpacked)
+
+
+def digest(path):
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+
+
+def main(args):
+    levels = [9, 6, 1]
+    threads = 0
+    workDir = tempfile.mkdtemp(prefix='cpiogz-bench-')
+    try:
+        if args:
+            tree = args[0]
+        else:
+            tree = os.path.join(workDir, 'tree')
+            make_tree(tree)
+        if len(args) > 1:
+            levels = [int(x) for x in args[1].split(',')]
+        if len(args) > 2:
+            threads = int(args[2])
+        cpio = find_cpio()
+
+        size = sum(os.lstat(os.path.join(tree, x)).st_size
+                for x in listTree(tree))
+        print '%d files, %.1f MB, %d CPUs' % (len(listTree(tree)),
+                size / 1048576.0, cpuCount())
+
+        output = os.path.join(workDir, 'pipeline.img')
+        start = time.time()
+        run_pipeline(tree, output, cpio)
+        elapsed = time.time() - start
+        print '%-28s %7.2fs %9d bytes' % ('find|%s|gzip -9' % cpio, elapsed,
+                os.stat(output).st_size)
+
+        for level in levels:
+            output = os.path.join(workDir, 'builtin-%d.img' % level)
+            start = time.time()
+            writeCpioGz(tree, output, level, threads)
+            elapsed = time.time() - start
+            print '%-28s %7.2fs %9d bytes  %s' % ('writeCpioGz level %d'
+                    % level, elapsed, os.stat(output).st_size,
+                    verify(tree, output, cpio))
+    finally:
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
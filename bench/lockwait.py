@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Measure how long it takes to get a contended lock with Lockable._lockWait,
+and compare it with the sleep-polling loop it replaced.
+
+Usage: lockwait.py [<processes> [<hold ms>]]
+
+Starts C{<processes>} (default 50) processes that all ask for the same
+exclusive lock at once, hold it for C{<hold ms>} (default 5) and release it.
+Reports how long each waited, the gap between one process releasing the lock
+and the next getting it, and how often the waiters were woken up. Each mode
+is run without and with a C{breakIf} callback, and the blocking one once more
+in processes that have another thread running, as the proxy does. Finally
+checks that a wait still times out with C{LockTimeoutError} and still stops
+when C{breakIf} returns true.
+"""
+
+import fcntl
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from jobmaster.subprocutil import Lockable, LockError, LockTimeoutError
+
+
+class BenchLock(Lockable):
+    def __init__(self, path):
+        self._lockPath = path
+
+
+class PollingLock(BenchLock):
+    """The previous _lockWait: retry every 0.1 to 0.5 seconds."""
+
+    def _lockWait(self, mode=fcntl.LOCK_SH, timeout=600.0, breakIf=None):
+        runUntil = time.time() + timeout
+        while True:
+            try:
+                return self._lock(mode)
+            except LockError:
+                pass
+            if breakIf and breakIf():
+                return False
+            if time.time() > runUntil:
+                raise LockTimeoutError('Timed out waiting for lock')
+            time.sleep(random.uniform(0.1, 0.5))
+
+
+def child(lockClass, path, startAt, hold, useBreak, busy, output):
+    lock = lockClass(path)
+    if busy:
+        thread = threading.Thread(target=time.sleep, args=(3600,))
+        thread.setDaemon(True)
+        thread.start()
+    while time.time() < startAt:
+        time.sleep(0.001)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    wanted = time.time()
+    lock._lockWait(fcntl.LOCK_EX, timeout=600,
+            breakIf=useBreak and (lambda: False) or None)
+    acquired = time.time()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    time.sleep(hold)
+    released = time.time()
+    lock._close()
+    os.write(output, '%r %r %r %d\n' % (wanted, acquired, released,
+        (after.ru_nvcsw + after.ru_nivcsw)
+        - (before.ru_nvcsw + before.ru_nivcsw)))
+
+
+def run(lockClass, processes, hold, useBreak, busy, workDir):
+    path = os.path.join(workDir, 'bench.lock')
+    reader, writer = os.pipe()
+    startAt = time.time() + 0.5
+    pids = []
+    for n in range(processes):
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(reader)
+                child(lockClass, path, startAt, hold, useBreak, busy,
+                        writer)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(writer)
+    data = ''
+    while True:
+        chunk = os.read(reader, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(reader)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    records = sorted(tuple(float(x) for x in line.split())
+            for line in data.splitlines())
+    records.sort(key=lambda x: x[1])
+    waits = sorted(x[1] - x[0] for x in records)
+    gaps = sorted(b[1] - a[2] for a, b in zip(records, records[1:]))
+    switches = sum(x[3] for x in records)
+    return waits, gaps, switches, records[-1][2] - startAt
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def check_semantics(workDir):
+    path = os.path.join(workDir, 'check.lock')
+    holder = BenchLock(path)
+    holder._lock(fcntl.LOCK_EX)
+    try:
+        waiter = BenchLock(path)
+        start = time.time()
+        try:
+            waiter._lockWait(fcntl.LOCK_EX, timeout=0.3)
+        except LockTimeoutError:
+            timedOut = 'timed out after %.2fs' % (time.time() - start)
+        else:
+            timedOut = 'did NOT time out'
+        waiter._close()
+
+        waiter = BenchLock(path)
+        calls = []
+        def breakIf():
+            calls.append(time.time())
+            return len(calls) >= 3
+        start = time.time()
+        result = waiter._lockWait(fcntl.LOCK_EX, timeout=60, breakIf=breakIf)
+        broke = 'breakIf returned %r after %.2fs, %d calls' % (result,
+                time.time() - start, len(calls))
+        waiter._close()
+    finally:
+        holder._close()
+    return timedOut, broke
+
+
+def main(args):
+    processes = 50
+    hold = 0.005
+    if args:
+        processes = int(args[0])
+    if len(args) > 1:
+        hold = float(args[1]) / 1000
+    workDir = tempfile.mkdtemp(prefix='lockwait-bench-')
+    try:
+        print '%d processes, lock held %.1f ms each' % (processes,
+                hold * 1000)
+        print '%-26s %9s %9s %9s %9s %9s %8s' % ('', 'wait p50', 'wait p99',
+                'gap p50', 'gap max', 'total', 'wakeups')
+        for name, lockClass, busy in (('polling', PollingLock, False),
+                ('blocking', BenchLock, False),
+                ('blocking +thread', BenchLock, True)):
+            for useBreak in (False, True):
+                waits, gaps, switches, total = run(lockClass, processes,
+                        hold, useBreak, busy, workDir)
+                label = name + (useBreak and ' +breakIf' or '')
+                print '%-26s %8.1fms %8.1fms %8.2fms %8.1fms %8.2fs %8d' % (
+                        label, percentile(waits, 0.5) * 1000,
+                        percentile(waits, 0.99) * 1000,
+                        percentile(gaps, 0.5) * 1000, gaps[-1] * 1000,
+                        total, switches)
+        timedOut, broke = check_semantics(workDir)
+        print 'timeout 0.3s: %s' % timedOut
+        print '%s' % broke
+    finally:
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Micro-benchmark of ProxyClient.handle_header dispatch for proxied requests,
+comparing the combined path matcher against the old per-pattern scan.
+
+Usage: proxy_dispatch.py [<iterations>]
+"""
+
+import re
+import sys
+import time
+import weakref
+from jobmaster import proxy
+
+REQUESTS = [
+        'POST /api/v1/images/%d/build_log HTTP/1.1\r\n'
+            'Content-Length: 100\r\n\r\n',
+        'PUT /api/v1/images/%d HTTP/1.1\r\nContent-Length: 200\r\n\r\n',
+        'PUT /uploadBuild/%d/image.tgz HTTP/1.1\r\n'
+            'Content-Length: 1000\r\n\r\n',
+        'GET /images/%d/foo.iso HTTP/1.1\r\n\r\n',
+        'GET /forbidden/%d HTTP/1.1\r\n\r\n',
+        ]
+
+
+class LinearMatcher(object):
+    """The original loop over each method's compiled patterns."""
+
+    def __init__(self):
+        self.paths = dict((method, [re.compile(x) for x in patterns])
+                for (method, patterns) in proxy.ALLOWED_PATHS.iteritems())
+
+    def match(self, method, path):
+        for pattern in self.paths.get(method, ()):
+            if pattern.match(path):
+                return '%s %s' % (method, pattern.pattern)
+        return None
+
+
+class NullUpstream(object):
+    outstanding = 0
+    keep_alive = True
+
+    def __init__(self):
+        self.request_times = []
+
+    def send(self, data):
+        del self.request_times[:]
+
+
+class NullClient(proxy.ProxyClient):
+    def send(self, data):
+        pass
+
+
+def run(matcher, iterations, jobs=10):
+    server = proxy.ProxyServer(0, {})
+    server.pathMatcher = matcher
+    client = NullClient(None, {}, server)
+    upstream = NullUpstream()
+    client._pair = weakref.ref(upstream)
+    requests = [x % (job,) for job in range(jobs) for x in REQUESTS]
+
+    start = time.time()
+    for x in xrange(iterations):
+        for request in requests:
+            client.state = proxy.STATE_HEADER
+            client.handle_header(request)
+    elapsed = time.time() - start
+    server.close()
+    return elapsed, iterations * len(requests)
+
+
+def main(args):
+    iterations = args and int(args[0]) or 2000
+    for name, matcher in [
+            ('PathMatcher', proxy.PathMatcher()),
+            ('linear scan', LinearMatcher()),
+            ]:
+        elapsed, count = run(matcher, iterations)
+        print '%-12s %6.2f us/request  (%d requests in %.2fs)' % (name,
+                elapsed / count * 1e6, count, elapsed)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,489 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Load test for the jobmaster proxy.
+
+Starts the real ProxyServer on loopback, in one process or in several
+SO_REUSEPORT processes like proxyWorkers, along with a stand-in rBuilder. Each
+simulated slave is a process of its own that connects from a different
+127.0.0.x address, registered with addTarget, and issues a mix of build_log
+POSTs, uploadBuild PUTs with Content-Length and chunked bodies, /images/ GETs
+and getTemplate polls for a fixed time.
+
+With --https, the stand-in rBuilder serves TLS with a certificate from a
+throwaway self-signed CA, which the proxy is configured to trust.
+
+Reports requests per second, MB/s through the proxy, p50/p99 latency per
+request kind, and the CPU time used by the proxy processes.
+
+Usage: proxy_load.py [options]
+"""
+
+import asyncore
+import base64
+import BaseHTTPServer
+import cPickle
+import optparse
+import os
+import random
+import shutil
+import signal
+import socket
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from conary import versions
+from conary.deps import deps
+from jobmaster import proxy
+from jobmaster.proxyworker import EpollMap
+from jobmaster.templategen import TemplateGenerator
+
+# Relative frequency of each kind of request
+MIX = [
+        ('build_log', 50),
+        ('upload', 10),
+        ('upload_chunked', 5),
+        ('image_get', 15),
+        ('template', 20),
+        ]
+
+TEMPLATE_TUP = ('anaconda-templates',
+        '/conary.rpath.com@rpl:2/1.0-1-1', 'is: x86')
+
+
+class FakeConfig(object):
+    templateIncremental = False
+
+    def __init__(self, templateCache):
+        self.templateCache = templateCache
+
+    def getTemplateCache(self):
+        return self.templateCache
+
+
+class FakeJobmaster(object):
+    """Just enough of JobMaster for the proxy to answer getTemplate."""
+
+    def __init__(self, templateCache):
+        self.cfg = FakeConfig(templateCache)
+        self.subprocesses = []
+
+    def getConaryConfig(self, rbuilderUrl):
+        return None
+
+    def getChangesetCache(self):
+        return None
+
+
+class RbuilderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in rBuilder: swallows bodies and serves image downloads."""
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response and send it in one go, as a real web server would.
+    wbufsize = -1
+    downloadSize = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    break
+                self.rfile.read(size + 2)
+            while self.rfile.readline() not in ('\r\n', ''):
+                pass
+        else:
+            remaining = int(self.headers.get('content-length', 0))
+            while remaining:
+                data = self.rfile.read(min(remaining, 65536))
+                if not data:
+                    break
+                remaining -= len(data)
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_PUT(self):
+        self._read_body()
+        self._respond('ok')
+
+    do_POST = do_PUT
+
+    def do_GET(self):
+        self._respond('\0' * self.downloadSize)
+
+
+class RbuilderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    tlsContext = None
+
+    def finish_request(self, request, client_address):
+        if self.tlsContext:
+            # Handshake in the request's own thread.
+            request = self.tlsContext.wrap_socket(request, server_side=True)
+        BaseHTTPServer.HTTPServer.finish_request(self, request,
+                client_address)
+
+
+def make_certificates(workDir):
+    """
+    Create a self-signed CA and a certificate for localhost signed by it.
+    Returns the paths of the CA certificate and the server's certificate and
+    key.
+    """
+    def openssl(*args):
+        subprocess.check_call(('openssl',) + args, cwd=workDir,
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=proxy load test CA', '-keyout', 'ca.key',
+            '-out', 'ca.crt')
+    openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=localhost',
+            '-keyout', 'server.key', '-out', 'server.csr')
+    open(os.path.join(workDir, 'server.ext'), 'w').write(
+            'subjectAltName = DNS:localhost\n')
+    openssl('x509', '-req', '-in', 'server.csr', '-CA', 'ca.crt',
+            '-CAkey', 'ca.key', '-CAcreateserial', '-days', '1',
+            '-extfile', 'server.ext', '-out', 'server.crt')
+    return [os.path.join(workDir, x)
+            for x in ('ca.crt', 'server.crt', 'server.key')]
+
+
+class SlaveConnection(object):
+    """Minimal HTTP/1.1 client that reuses its connection when it can."""
+
+    def __init__(self, sourceAddress, port, keepAlive):
+        self.sourceAddress = sourceAddress
+        self.port = port
+        self.keepAlive = keepAlive
+        self.sock = None
+        self.buf = ''
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.bind((self.sourceAddress, 0))
+        self.sock.connect(('127.0.0.1', self.port))
+        self.buf = ''
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error("connection closed")
+        self.buf += data
+
+    def request(self, method, path, body=None, chunkSize=None):
+        """
+        Send a request and read the whole response. Returns the status code
+        and the number of bytes moved in both directions.
+        """
+        if not self.sock:
+            self._connect()
+        headers = ['%s %s HTTP/1.1' % (method, path), 'Host: jobmaster']
+        if body is not None and chunkSize:
+            headers.append('Transfer-Encoding: chunked')
+        elif body is not None:
+            headers.append('Content-Length: %d' % len(body))
+        if not self.keepAlive:
+            headers.append('Connection: close')
+        self.sock.sendall('\r\n'.join(headers) + '\r\n\r\n')
+        moved = 0
+        if body is not None and chunkSize:
+            for x in range(0, len(body), chunkSize):
+                chunk = body[x:x + chunkSize]
+                self.sock.sendall('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.sock.sendall('0\r\n\r\n')
+            moved += len(body)
+        elif body is not None:
+            self.sock.sendall(body)
+            moved += len(body)
+
+        while '\r\n\r\n' not in self.buf:
+            self._recv()
+        header, self.buf = self.buf.split('\r\n\r\n', 1)
+        lines = header.split('\r\n')
+        status = int(lines[0].split()[1])
+        length = 0
+        close = not self.keepAlive
+        for line in lines[1:]:
+            key, value = line.split(':', 1)
+            key = key.lower()
+            if key == 'content-length':
+                length = int(value)
+            elif key == 'connection' and value.strip().lower() == 'close':
+                close = True
+        while len(self.buf) < length:
+            self._recv()
+        self.buf = self.buf[length:]
+        moved += length
+        if close:
+            self.close()
+        return status, moved
+
+
+def run_slave(index, port, options, deadline, resultFD):
+    """Issue requests until C{deadline}, then write the results to a pipe."""
+    rand = random.Random(index)
+    imageId = index + 1
+    conn = SlaveConnection(slave_address(index), port, not options.close)
+    upload = '\0' * (options.upload_size * 1024)
+    buildLog = 'x' * 2048
+    templateParams = base64.urlsafe_b64encode(cPickle.dumps({
+        'templateTup': template_tup(),
+        'kernelTup': None,
+        }, 2))
+    kinds = []
+    for kind, weight in MIX:
+        kinds.extend([kind] * weight)
+
+    results = []
+    while time.time() < deadline:
+        kind = rand.choice(kinds)
+        start = time.time()
+        try:
+            if kind == 'build_log':
+                status, moved = conn.request('POST',
+                        '/api/v1/images/%d/build_log' % imageId, buildLog)
+            elif kind == 'upload':
+                status, moved = conn.request('PUT',
+                        '/uploadBuild/%d/image.tgz' % imageId, upload)
+            elif kind == 'upload_chunked':
+                status, moved = conn.request('PUT',
+                        '/uploadBuild/%d/image.tgz' % imageId, upload,
+                        chunkSize=65536)
+            elif kind == 'image_get':
+                status, moved = conn.request('GET',
+                        '/images/%d/image.iso' % imageId)
+            else:
+                status, moved = conn.request('GET',
+                        '/templates/getTemplate?p=%s&nostart=1'
+                        % templateParams)
+        except socket.error:
+            conn.close()
+            status, moved = None, 0
+        results.append((kind, time.time() - start, moved, status == 200))
+    conn.close()
+
+    data = cPickle.dumps(results, 2)
+    while data:
+        written = os.write(resultFD, data)
+        data = data[written:]
+    os.close(resultFD)
+
+
+def slave_address(index):
+    return '127.0.%d.%d' % (index / 250, index % 250 + 2)
+
+
+def template_tup():
+    name, version, flavor = TEMPLATE_TUP
+    return (name, versions.VersionFromString(version),
+            deps.parseFlavor(flavor))
+
+
+def run_proxy(port, workers, targets, templateCache, caFile):
+    _map = {}
+    # The server only keeps a weak reference.
+    jobmaster = FakeJobmaster(templateCache)
+    server = proxy.ProxyServer(port, _map, jobmaster,
+            reusePort=True, targets=targets, backlog=128, tlsCaFile=caFile)
+    if workers > 1:
+        poller = EpollMap(_map)
+        poll = poller.poll
+    else:
+        # Same loop as the jobmaster's message bus uses.
+        poll = lambda timeout: asyncore.loop(timeout, True, _map, 1)
+    while True:
+        poll(1.0)
+        server.check()
+
+
+def fork(func, *args):
+    pid = os.fork()
+    if not pid:
+        try:
+            try:
+                func(*args)
+            except KeyboardInterrupt:
+                pass
+            except:
+                import traceback
+                traceback.print_exc()
+                os._exit(1)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def cpu_time(pid):
+    """User plus system CPU seconds used so far by process C{pid}."""
+    fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    sock.bind(('::', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def report(results, elapsed, cpu):
+    byKind = {}
+    for kind, latency, moved, ok in results:
+        byKind.setdefault(kind, []).append((latency, moved, ok))
+    total = len(results)
+    totalBytes = sum(x[2] for x in results)
+    errors = sum(1 for x in results if not x[3])
+
+    print '%-16s %8s %8s %10s %10s %7s' % ('request', 'count', 'req/s',
+            'p50 ms', 'p99 ms', 'errors')
+    rows = sorted(byKind.items())
+    rows.append(('all', [x[1:] for x in results]))
+    for kind, items in rows:
+        latencies = sorted(x[0] for x in items)
+        print '%-16s %8d %8.1f %10.2f %10.2f %7d' % (kind, len(items),
+                len(items) / elapsed, percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                sum(1 for x in items if not x[2]))
+    print
+    print 'requests/sec:  %.1f' % (total / elapsed)
+    print 'throughput:    %.1f MB/s' % (totalBytes / elapsed / 1e6)
+    print 'errors:        %d' % errors
+    print 'proxy CPU:     %.2fs (%.0f%% of one core)' % (cpu,
+            cpu / elapsed * 100)
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--slaves', type='int', default=20,
+            help='number of simulated slaves')
+    parser.add_option('-t', '--duration', type='float', default=10,
+            help='seconds to run for')
+    parser.add_option('-w', '--workers', type='int', default=1,
+            help='proxy processes sharing the port')
+    parser.add_option('--upload-size', type='int', default=1024,
+            help='size of each upload in KiB')
+    parser.add_option('--download-size', type='int', default=256,
+            help='size of each image download in KiB')
+    parser.add_option('--close', action='store_true',
+            help='open a new connection for every request')
+    parser.add_option('--https', action='store_true',
+            help='have the proxy talk TLS to the rBuilder')
+    options, args = parser.parse_args(args)
+
+    templateCache = tempfile.mkdtemp(prefix='proxy-load-')
+    RbuilderHandler.downloadSize = options.download_size * 1024
+    rbuilder = RbuilderServer(('127.0.0.1', 0), RbuilderHandler)
+    if options.https:
+        caFile, certFile, keyFile = make_certificates(templateCache)
+        rbuilder.tlsContext = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        rbuilder.tlsContext.load_cert_chain(certFile, keyFile)
+        rbuilderUrl = 'https://localhost:%d/' % rbuilder.server_address[1]
+    else:
+        caFile = None
+        rbuilderUrl = 'http://127.0.0.1:%d/' % rbuilder.server_address[1]
+
+    generator = TemplateGenerator(template_tup(), None, None, templateCache)
+    open(generator.path, 'w').close()
+
+    targets = dict(('::ffff:' + slave_address(x), (rbuilderUrl, 1))
+            for x in range(options.slaves))
+    port = free_port()
+    pids = []
+    try:
+        pids.append(fork(rbuilder.serve_forever))
+        rbuilder.socket.close()
+        proxies = [fork(run_proxy, port, options.workers, targets,
+            templateCache, caFile) for x in range(options.workers)]
+        pids.extend(proxies)
+        wait_listening(port)
+
+        cpuBefore = sum(cpu_time(x) for x in proxies)
+        start = time.time()
+        deadline = start + options.duration
+        slaves = []
+        for index in range(options.slaves):
+            readFD, writeFD = os.pipe()
+            pid = fork(run_slave, index, port, options, deadline, writeFD)
+            os.close(writeFD)
+            slaves.append((pid, readFD))
+
+        results = []
+        for pid, readFD in slaves:
+            data = []
+            while True:
+                chunk = os.read(readFD, 65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            os.close(readFD)
+            os.waitpid(pid, 0)
+            if data:
+                results.extend(cPickle.loads(''.join(data)))
+        elapsed = time.time() - start
+        cpu = sum(cpu_time(x) for x in proxies) - cpuBefore
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        shutil.rmtree(templateCache)
+
+    print '%d slaves, %d proxy process(es), %s, %.0f seconds' % (
+            options.slaves, options.workers,
+            options.https and 'https' or 'http', elapsed)
+    print
+    report(results, elapsed, cpu)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Exercise the proxy's header and chunked-encoding parser.
+
+Usage: proxy_parse.py [--fuzz <iterations>]
+
+By default, times a header arriving a few bytes at a time and a body made of
+many small chunks, with the incremental parser and with a queue that behaves
+like the original one (every search starts over and merges the whole
+buffer).
+
+With --fuzz, feeds random streams of requests, split at random points, through
+both and checks that each one sees the same headers and relays the same bytes
+as the stream it was given.
+"""
+
+import random
+import sys
+import time
+import weakref
+from jobmaster import proxy
+
+
+class RescanQueue(proxy.ByteQueue):
+    """Searches from the front of the merged buffer, like the original."""
+
+    def find(self, sub, start=0):
+        if not self:
+            return -1
+        return self._coalesce(len(self)).find(sub)
+
+    def take_view(self, size):
+        return self.take(size)
+
+
+class FakeServer(object):
+    pass
+
+SERVER = FakeServer()
+
+
+class Sink(object):
+    connected = True
+
+    def __init__(self):
+        self.data = []
+
+    def send(self, data):
+        self.data.append(str(data))
+
+    def copyable(self):
+        return True
+
+
+class Parser(proxy.ProxyDispatcher):
+    """Dispatcher that records the headers it parses."""
+
+    def __init__(self, buffer_class):
+        self.buffer_class = buffer_class
+        proxy.ProxyDispatcher.__init__(self, None, {}, SERVER)
+        self.sink = Sink()
+        self._pair = weakref.ref(self.sink)
+        self.headers = []
+
+    def handle_header(self, header):
+        self.headers.append(header)
+        firstline, headers = self._parse_header(header)
+        self.start_copy(headers)
+
+    def feed(self, data):
+        self.in_buffer.append(data)
+        self._do_recv()
+
+    def relayed(self):
+        return ''.join(self.sink.data)
+
+
+
+
+def make_message(rand):
+    """Return a request, its header, and the bytes that should be relayed."""
+    lines = ['PUT /uploadBuild/%d/x HTTP/1.1' % rand.randint(1, 99)]
+    lines.extend('X-Header-%d: %s' % (x, 'v' * rand.randint(0, 40))
+            for x in range(rand.randint(0, 8)))
+    if rand.random() < 0.5:
+        body = ''.join(chr(rand.randint(0, 255))
+                for x in range(rand.randint(0, 300)))
+        lines.append('Content-Length: %d' % len(body))
+    else:
+        lines.append('Transfer-Encoding: chunked')
+        pieces = []
+        for x in range(rand.randint(0, 6)):
+            chunk = ''.join(rand.choice('ab\r\n0;')
+                    for y in range(rand.randint(1, 50)))
+            ext = rand.choice(['', ';name=value'])
+            pieces.append('%x%s\r\n%s\r\n' % (len(chunk), ext, chunk))
+        pieces.append('0\r\n')
+        if rand.random() < 0.5:
+            pieces.append('X-Trailer: yes\r\n\r\n')
+        else:
+            pieces.append('\r\n')
+        body = ''.join(pieces)
+    header = '\r\n'.join(lines) + '\r\n\r\n'
+    prefix = rand.choice(['', '', '\r\n'])
+    return prefix + header + body, header, body
+
+
+def fuzz(iterations, seed=None):
+    rand = random.Random(seed)
+    for n in xrange(iterations):
+        messages = [make_message(rand) for x in range(rand.randint(1, 5))]
+        stream = ''.join(x[0] for x in messages)
+        cuts = sorted(rand.randint(0, len(stream))
+                for x in range(rand.randint(0, 40)))
+        pieces = [stream[a:b] for (a, b) in zip([0] + cuts, cuts + [None])]
+        for buffer_class in (proxy.ByteQueue, RescanQueue):
+            parser = Parser(buffer_class)
+            for piece in pieces:
+                parser.feed(piece)
+            headers = [x[1] for x in messages]
+            body = ''.join(x[2] for x in messages)
+            if parser.headers != headers or parser.relayed() != body:
+                print 'Mismatch with %s on iteration %d:' % (
+                        buffer_class.__name__, n)
+                print repr(pieces)
+                return 1
+            if parser.state != proxy.STATE_HEADER and not (
+                    parser.state == proxy.STATE_COPY_SIZE
+                    and not parser.copy_remaining):
+                print 'Unfinished message with %s on iteration %d' % (
+                        buffer_class.__name__, n)
+                print repr(pieces)
+                return 1
+    print '%d streams OK' % iterations
+    return 0
+
+
+def time_feed(buffer_class, pieces):
+    parser = Parser(buffer_class)
+    start = time.time()
+    for piece in pieces:
+        parser.feed(piece)
+    return time.time() - start
+
+
+def bench():
+    header = ('PUT /uploadBuild/1/x HTTP/1.1\r\n'
+            + ''.join('X-Header-%d: %s\r\n' % (x, 'v' * 100)
+                for x in range(300))
+            + 'Transfer-Encoding: chunked\r\n\r\n')
+    slow = [header[x:x + 16] for x in range(0, len(header), 16)]
+    slow.append('0\r\n\r\n')
+
+    chunks = ''.join('a\r\n0123456789\r\n' for x in range(100000))
+    stream = 'PUT /uploadBuild/1/x HTTP/1.1\r\n' \
+            'Transfer-Encoding: chunked\r\n\r\n' + chunks + '0\r\n\r\n'
+    size = proxy.ProxyDispatcher.chunk_size
+    small = [stream[x:x + size] for x in range(0, len(stream), size)]
+
+    for name, pieces in [
+            ('%dKB header in 16 byte reads' % (len(header) / 1024), slow),
+            ('100000 chunks of 10 bytes', small),
+            ]:
+        for buffer_class in (proxy.ByteQueue, RescanQueue):
+            elapsed = time_feed(buffer_class, pieces)
+            print '%-32s %-12s %8.3fs' % (name, buffer_class.__name__,
+                    elapsed)
+
+
+def main(args):
+    if args and args[0] == '--fuzz':
+        iterations = len(args) > 1 and int(args[1]) or 1000
+        return fuzz(iterations)
+    bench()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
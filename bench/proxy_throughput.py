@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Push a large fixed-length PUT through ProxyClient/ProxyUpstream over loopback
+and report the relay throughput with splice(2) and with each send/receive
+queue implementation.
+
+Usage: proxy_throughput.py [<megabytes> [<sink recv size>]]
+
+A small sink receive size keeps the proxy's send queue full, which is where
+partial sends made the old string queues copy their whole contents.
+"""
+
+import asyncore
+import socket
+import sys
+import threading
+import time
+from jobmaster import proxy
+
+BLOCK = 1048576
+
+
+class StringQueue(object):
+    """The original str-based queue, kept for comparison."""
+
+    def __init__(self, data=''):
+        self._buf = data
+
+    def __len__(self):
+        return len(self._buf)
+
+    def __nonzero__(self):
+        return bool(self._buf)
+
+    def append(self, data):
+        self._buf += data
+
+    def view(self, size):
+        return self._buf
+
+    def peek(self, size):
+        return self._buf[:size]
+
+    def startswith(self, prefix):
+        return self._buf.startswith(prefix)
+
+    def find(self, sub, start=0):
+        return self._buf.find(sub, start)
+
+    def consume(self, size):
+        self._buf = self._buf[size:]
+
+    def take(self, size):
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    take_view = take
+
+
+def _sink(listener, recvSize, result):
+    """Stand-in rBuilder: swallow one request body and answer 200 OK."""
+    sock, _ = listener.accept()
+    data = ''
+    while '\r\n\r\n' not in data:
+        data += sock.recv(BLOCK)
+    header, body = data.split('\r\n\r\n', 1)
+    for line in header.split('\r\n'):
+        if line.lower().startswith('content-length:'):
+            remaining = long(line.split(':', 1)[1]) - len(body)
+    while remaining > 0:
+        data = sock.recv(recvSize)
+        if not data:
+            break
+        remaining -= len(data)
+    sock.sendall('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+    result.append(remaining)
+    sock.close()
+
+
+def run(bufferClass, useSplice, size, recvSize):
+    listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    listener.bind(('::1', 0))
+    listener.listen(1)
+    result = []
+    sinkThread = threading.Thread(target=_sink, args=(listener, recvSize, result))
+    sinkThread.start()
+
+    _map = {}
+    server = proxy.ProxyServer(0, _map)
+    server.addTarget('::1', 'http://[::1]:%d/' % listener.getsockname()[1])
+    done = []
+
+    def loop():
+        while not done:
+            asyncore.loop(0.1, True, _map, 1)
+    loopThread = threading.Thread(target=loop)
+
+    oldClass = proxy.ProxyDispatcher.buffer_class
+    oldSplice = proxy.SplicePipe.available
+    proxy.ProxyDispatcher.buffer_class = bufferClass
+    proxy.SplicePipe.available = useSplice
+    try:
+        loopThread.start()
+        start = time.time()
+        client = socket.create_connection(('::1', server.port))
+        client.sendall('PUT /uploadBuild/1/bench HTTP/1.1\r\n'
+                'Content-Length: %d\r\n\r\n' % size)
+        block = '\0' * BLOCK
+        remaining = size
+        while remaining:
+            chunk = block[:min(remaining, BLOCK)]
+            client.sendall(chunk)
+            remaining -= len(chunk)
+        response = client.recv(4096)
+        elapsed = time.time() - start
+        client.close()
+    finally:
+        done.append(True)
+        loopThread.join()
+        sinkThread.join()
+        proxy.ProxyDispatcher.buffer_class = oldClass
+        proxy.SplicePipe.available = oldSplice
+        server.close()
+        listener.close()
+
+    assert response.startswith('HTTP/1.1 200'), response
+    assert result == [0], result
+    return elapsed
+
+
+def main(args):
+    megabytes = len(args) > 0 and int(args[0]) or 2048
+    recvSize = len(args) > 1 and int(args[1]) or BLOCK
+    size = megabytes * BLOCK
+    best = {}
+    for attempt in range(3):
+        for name, bufferClass, useSplice in [
+                ('splice', proxy.ByteQueue, True),
+                ('ByteQueue', proxy.ByteQueue, False),
+                ('StringQueue', StringQueue, False),
+                ]:
+            elapsed = run(bufferClass, useSplice, size, recvSize)
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name, elapsed in sorted(best.items()):
+        print '%-12s %8.1f MiB/s  (best of 3, %d MiB in %.2fs)' % (name,
+                megabytes / elapsed, megabytes, elapsed)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
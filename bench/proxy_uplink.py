@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Check that idle keep-alive connections don't take a share of the proxy's
+uplink cap away from uploads.
+
+Usage: proxy_uplink.py [<idle connections> [<limit KiB/s> [<upload MiB>]]]
+
+Uploads a C{build_files} body through a ProxyServer with C{uplinkLimit} set,
+once on its own and once while C{<idle connections>} (default 8) other
+connections sit idle after a GET. Both uploads should get about the whole
+cap; exits non-zero if the second one gets less than 80% of the first.
+"""
+
+import asyncore
+import socket
+import sys
+import threading
+import time
+from jobmaster import proxy
+
+BLOCK = 65536
+
+
+def _serve(sock):
+    """Answer each request on C{sock} with an empty 200 OK."""
+    data = ''
+    try:
+        while True:
+            while '\r\n\r\n' not in data:
+                chunk = sock.recv(BLOCK)
+                if not chunk:
+                    return
+                data += chunk
+            header, data = data.split('\r\n\r\n', 1)
+            remaining = 0
+            for line in header.split('\r\n'):
+                if line.lower().startswith('content-length:'):
+                    remaining = long(line.split(':', 1)[1])
+            remaining -= len(data)
+            data = ''
+            while remaining > 0:
+                chunk = sock.recv(min(remaining, BLOCK))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+            if remaining < 0:
+                data = data[remaining:]
+            sock.sendall('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+    finally:
+        sock.close()
+
+
+def _upstream(listener):
+    """Stand-in rBuilder: serve every connection in its own thread."""
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except socket.error:
+            return
+        thread = threading.Thread(target=_serve, args=(sock,))
+        thread.setDaemon(True)
+        thread.start()
+
+
+def _request(sock, request):
+    sock.sendall(request)
+    response = ''
+    while '\r\n\r\n' not in response:
+        chunk = sock.recv(4096)
+        assert chunk, 'connection closed'
+        response += chunk
+    assert response.startswith('HTTP/1.1 200'), response
+    return response
+
+
+def upload(server, size, idle):
+    """Return the upload rate, in bytes per second, and the most flows."""
+    idlers = []
+    for n in range(idle):
+        sock = socket.create_connection(('::1', server.port))
+        _request(sock, 'GET /images/%d HTTP/1.1\r\n\r\n' % n)
+        idlers.append(sock)
+
+    sock = socket.create_connection(('::1', server.port))
+    start = time.time()
+    sock.sendall('PUT /api/v1/images/1/build_files HTTP/1.1\r\n'
+            'Content-Length: %d\r\n\r\n' % size)
+    block = '\0' * BLOCK
+    remaining = size
+    flows = 0
+    while remaining:
+        chunk = block[:min(remaining, BLOCK)]
+        sock.sendall(chunk)
+        remaining -= len(chunk)
+        flows = max(flows, len(server.uplink.flows))
+    _request(sock, '')
+    elapsed = time.time() - start
+    sock.close()
+    for idler in idlers:
+        idler.close()
+    return size / elapsed, flows
+
+
+def main(args):
+    idle = len(args) > 0 and int(args[0]) or 8
+    limit = (len(args) > 1 and int(args[1]) or 4096) * 1024
+    size = (len(args) > 2 and int(args[2]) or 8) * 1048576
+
+    listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    listener.bind(('::1', 0))
+    listener.listen(64)
+    upstreamThread = threading.Thread(target=_upstream, args=(listener,))
+    upstreamThread.setDaemon(True)
+    upstreamThread.start()
+
+    _map = {}
+    server = proxy.ProxyServer(0, _map, uplinkLimit=limit)
+    server.addTarget('::1', 'http://[::1]:%d/' % listener.getsockname()[1])
+    done = []
+
+    def loop():
+        while not done:
+            asyncore.loop(0.05, True, _map, 1)
+    loopThread = threading.Thread(target=loop)
+    loopThread.start()
+    try:
+        alone, aloneFlows = upload(server, size, 0)
+        shared, sharedFlows = upload(server, size, idle)
+    finally:
+        done.append(True)
+        loopThread.join()
+        server.close()
+        listener.close()
+
+    print 'limit %d KiB/s, %d MiB upload' % (limit / 1024, size / 1048576)
+    print '%-28s %8.0f KiB/s  %d flows' % ('alone', alone / 1024,
+            aloneFlows)
+    print '%-28s %8.0f KiB/s  %d flows' % ('with %d idle connections'
+            % idle, shared / 1024, sharedFlows)
+    if shared < alone * 0.8:
+        print 'FAIL: idle connections took %.0f%% of the upload\'s share' % (
+                100 - 100 * shared / alone)
+        return 1
+    print 'OK'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
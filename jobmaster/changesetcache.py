@@ -0,0 +1,314 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+On-disk cache of conary changesets and trove metadata, shared by everything
+in the jobmaster that fetches troves: template generators, the kernel
+installs they do, and job handlers sizing an image model.
+
+Changesets are stored as C{<key>.ccs}, where the key is a hash of the update
+job they were made for. The trove cache used to realize image models is kept
+in C{troves.cache}. Entries are removed least recently used first when the
+cache grows past its budget; like the template cache, the last use is
+recorded by setting the access time explicitly.
+
+Several processes use the cache at once, so:
+ - an entry is filled while holding the flock on its C{<key>.lock}, into a
+   C{.partial} file that is renamed into place when complete. Anyone else
+   wanting the same entry waits for the lock and then finds it ready;
+ - the evictor only removes entries whose lock it can take without waiting,
+   so nothing being filled is removed;
+ - readers open the entry and keep the open file, so removing it after that
+   does no harm.
+
+Hits and misses are counted in C{stats.json}, under a flock, so that the
+counts cover every process using the cache.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+from conary.lib import digestlib
+from jobmaster.subprocutil import LockError
+from jobmaster.templatecache import FileLock
+
+log = logging.getLogger(__name__)
+
+
+class ChangesetCache(object):
+    """
+    Caches changesets and trove metadata in C{path}, keeping their total size
+    under C{budget} bytes (0 for no limit).
+    """
+    # Seconds to wait for another process to fill an entry
+    fillTimeout = 1800
+    # Entries unused for this long are removed even when under budget.
+    maxAge = 30 * 86400
+    statsName = 'stats.json'
+    troveCacheName = 'troves.cache'
+
+    def __init__(self, path, budget=0):
+        self.path = path
+        self.budget = budget
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def jobKey(jobList):
+        """Return the cache key for the changeset of C{jobList}."""
+        items = []
+        for name, (oldVer, oldFla), (newVer, newFla), absolute in sorted(
+                jobList):
+            items.append(name)
+            for thing in (oldVer, oldFla, newVer, newFla):
+                items.append(thing is not None and thing.freeze() or '')
+            items.append(absolute and '1' or '0')
+        items.append('')
+        return digestlib.sha1('\0'.join(items)).hexdigest()
+
+    def getChangeSet(self, repos, jobList):
+        """
+        Return the changeset for C{jobList}, with the contents of every
+        trove it includes, fetching it from C{repos} if it isn't cached.
+        """
+        name = self.jobKey(jobList) + '.ccs'
+        cs = self._load(name)
+        if cs:
+            self._count('hits')
+            return cs
+
+        lock = FileLock(self._path(_lockName(name)))
+        lock._lockWait(fcntl.LOCK_EX, timeout=self.fillTimeout)
+        try:
+            # Someone else may have fetched it while we waited.
+            cs = self._load(name)
+            if cs:
+                self._count('hits')
+                return cs
+            self._count('misses')
+            partial = self._path(name + '.partial')
+            start = time.time()
+            repos.createChangeSetFile(jobList, partial, recurse=True)
+            os.rename(partial, self._path(name))
+            log.debug("Cached changeset %s (%d bytes) in %.1f seconds",
+                    name, os.stat(self._path(name)).st_size,
+                    time.time() - start)
+            cs = self._load(name)
+        finally:
+            lock._close()
+        self.evict()
+        return cs
+
+    def _load(self, name):
+        from conary.repository.changeset import ChangeSetFromFile
+        path = self._path(name)
+        try:
+            fObj = open(path, 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        os.utime(path, (time.time(), os.fstat(fObj.fileno()).st_mtime))
+        try:
+            return ChangeSetFromFile(fObj)
+        except:
+            log.warning("Discarding unreadable changeset %s:", name,
+                    exc_info=True)
+            _unlink(path)
+            return None
+
+    def loadTroveCache(self, troveCache):
+        """Fill C{troveCache} (a conary C{TroveCache}) from the cache."""
+        path = self._path(self.troveCacheName)
+        if not os.path.exists(path):
+            self._count('troveMisses')
+            return
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            troveCache.load(path)
+        except:
+            log.warning("Could not load the cached trove metadata:",
+                    exc_info=True)
+            self._count('troveMisses')
+        else:
+            self._count('troveHits')
+
+    def saveTroveCache(self, troveCache):
+        """Store the metadata in C{troveCache} for the next user."""
+        lock = FileLock(self._path(self.troveCacheName + '.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            # Someone else is saving theirs.
+            return
+        try:
+            partial = self._path(self.troveCacheName + '.partial')
+            troveCache.save(partial)
+            os.rename(partial, self._path(self.troveCacheName))
+        finally:
+            lock._close()
+        self.evict()
+
+    def _count(self, name, amount=1):
+        self._updateStats(lambda stats: stats.__setitem__(name,
+            stats.get(name, 0) + amount))
+
+    def _updateStats(self, func):
+        path = self._path(self.statsName)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        fObj = os.fdopen(fd, 'r+')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                stats = json.loads(fObj.read() or '{}')
+            except ValueError:
+                stats = {}
+            func(stats)
+            fObj.seek(0)
+            fObj.write(json.dumps(stats))
+            fObj.truncate()
+        finally:
+            fObj.close()
+
+    def stats(self):
+        try:
+            return json.load(open(self._path(self.statsName)))
+        except (IOError, ValueError):
+            return {}
+
+    def scan(self):
+        """Return (name, size, atime) for each entry in the cache."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.partial'):
+                # Left behind by a process that died while filling it.
+                self._removeStale(name)
+                continue
+            if not (name.endswith('.ccs') or name == self.troveCacheName):
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((name, st.st_size, st.st_atime))
+        return entries
+
+    def _removeStale(self, name):
+        lock = FileLock(self._path(_lockName(name[:-8])))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            return
+        try:
+            _unlink(self._path(name))
+        finally:
+            lock._close()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within its
+        budget, plus any that haven't been used for C{maxAge} seconds.
+        Returns the number of entries removed.
+        """
+        lock = FileLock(self._path('.evict.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            return 0
+        try:
+            entries = self.scan()
+            total = sum(x[1] for x in entries)
+            cutoff = time.time() - self.maxAge
+            removed = evictedBytes = 0
+            for name, size, atime in sorted(entries, key=lambda x: x[2]):
+                if ((not self.budget or total <= self.budget)
+                        and atime >= cutoff):
+                    break
+                if self._remove(name):
+                    log.debug("Evicted %s (%d bytes) from the changeset "
+                            "cache", name, size)
+                    total -= size
+                    removed += 1
+                    evictedBytes += size
+            def update(stats):
+                stats['size'] = total
+                stats['entries'] = len(entries) - removed
+                stats['evictions'] = stats.get('evictions', 0) + removed
+                stats['evictedBytes'] = (stats.get('evictedBytes', 0)
+                        + evictedBytes)
+            self._updateStats(update)
+            return removed
+        finally:
+            lock._close()
+
+    def _remove(self, name):
+        lock = FileLock(self._path(_lockName(name)))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            # It's being filled or saved.
+            return False
+        try:
+            _unlink(self._path(name))
+            lock._deleteLock()
+            return True
+        finally:
+            lock._close()
+
+    def asDict(self):
+        stats = self.stats()
+        result = {'budget': self.budget}
+        for kind, prefix in (('changesets', ''), ('troves', 'trove')):
+            hits = stats.get(prefix and prefix + 'Hits' or 'hits', 0)
+            misses = stats.get(prefix and prefix + 'Misses' or 'misses', 0)
+            result[kind] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': (hits + misses) and float(hits) / (
+                        hits + misses) or None,
+                    }
+        result['size'] = stats.get('size')
+        result['entries'] = stats.get('entries')
+        result['evictions'] = stats.get('evictions', 0)
+        result['evicted_bytes'] = stats.get('evictedBytes', 0)
+        return result
+
+
+def _lockName(name):
+    if name.endswith('.ccs'):
+        name = name[:-4]
+    return name + '.lock'
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -30,18 +30,35 @@ class MasterConfig(config.MCPConfig):
     basePath = '/srv/rbuilder/jobmaster'
     pidFile = '/var/run/jobmaster.pid'
     templateCache = 'anaconda-templates'
+    changesetCache = 'changesets'
+    uploadSpool = 'upload-spool'
     logPath = '/var/log/rbuilder/jobmaster.log'
 
     # Runtime settings
     slaveLimit = (cfgtypes.CfgInt, 5)
 
     # Misc settings
+    changesetCacheLimit = (cfgtypes.CfgInt, 4096) # MiB, 0 disables the cache
     conaryProxyPort = (cfgtypes.CfgInt, 80)
     debugMode       = (cfgtypes.CfgBool, False)
     lvmVolumeName   = 'vg00'
     masterProxyPort = (cfgtypes.CfgInt, 7770)
     minSlaveSize    = (cfgtypes.CfgInt, 1024) # scratch space in MB
     pairSubnet      = 'fdf0:dbe6:3760::/48'
+    proxyAllowPath  = (cfgtypes.CfgList(cfgtypes.CfgString), []) # METHOD regex
+    proxyBacklog    = (cfgtypes.CfgInt, 128)
+    proxyPoolSize   = (cfgtypes.CfgInt, 8) # idle upstream connections
+    proxyPoolTimeout = (cfgtypes.CfgInt, 4) # seconds
+    proxyResolverTtl = (cfgtypes.CfgInt, 60) # seconds
+    proxySpoolUploads = (cfgtypes.CfgBool, False)
+    proxyTlsCaFile  = (cfgtypes.CfgPath, None) # CA bundle for https targets
+    proxyTlsVerify  = (cfgtypes.CfgBool, True)
+    proxyUplinkLimit = (cfgtypes.CfgInt, 0) # KiB/s to rBuilders, 0 for no cap
+    proxyWorkers    = (cfgtypes.CfgInt, 0) # 0 serves from the jobmaster
+    templateCacheLimit = (cfgtypes.CfgInt, 0) # MiB of templates, 0 for no cap
+    templateIncremental = (cfgtypes.CfgBool, False) # update the last root
+    templatePrewarmJobs = (cfgtypes.CfgInt, 0) # 0 to only build on demand
+    templateWorkers = (cfgtypes.CfgInt, 2) # templates built at once
     useNetContainer = (cfgtypes.CfgBool, True)
 
     # DEPRECATED
@@ -53,6 +70,15 @@ class MasterConfig(config.MCPConfig):
     def getTemplateCache(self):
         return os.path.join(self.basePath, self.templateCache)
 
+    def getTemplateQueue(self):
+        return os.path.join(self.getTemplateCache(), 'queue')
+
+    def getChangesetCache(self):
+        return os.path.join(self.basePath, self.changesetCache)
+
+    def getUploadSpool(self):
+        return os.path.join(self.basePath, self.uploadSpool)
+
     def getLogLevel(self):
         level = self.logLevel
         if isinstance(level, basestring):
@@ -0,0 +1,276 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Writes gzipped cpio archives, e.g. initrds, without C{cpio} and C{gzip}.
+
+L{CpioWriter} produces the SVR4 "newc" format that C{cpio -c} does, and
+L{ParallelGzipWriter} compresses it the way C{pigz} does: the input is cut
+into blocks that a pool of threads compress at the same time (zlib releases
+the GIL while it works), and the compressed blocks are joined into a single
+deflate stream. Every block but the last is ended with a sync flush so that
+it finishes on a byte boundary, which is what lets them be concatenated. The
+result is an ordinary single-member gzip file.
+"""
+
+import os
+import Queue
+import stat
+import struct
+import threading
+import zlib
+from jobmaster.util import cpuCount, listTree
+
+NEWC_MAGIC = '070701'
+TRAILER = 'TRAILER!!!'
+
+
+def _pad(size, align=4):
+    return '\0' * (-size % align)
+
+
+class CpioWriter(object):
+    """Write files from a directory tree into a newc cpio archive."""
+    # cpio pads the whole archive to a multiple of this
+    blockSize = 512
+
+    def __init__(self, fObj):
+        self.fObj = fObj
+        self.size = 0
+        self._nextIno = 1
+        self._inodes = {}
+
+    def _write(self, data):
+        self.fObj.write(data)
+        self.size += len(data)
+
+    def _header(self, name, st, ino, nlink, size):
+        mode = st.st_mode
+        if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            rdev = st.st_rdev
+        else:
+            rdev = 0
+        name += '\0'
+        header = '%s%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X' % (
+                NEWC_MAGIC, ino, mode, st.st_uid, st.st_gid, nlink,
+                int(st.st_mtime) & 0xffffffff, size,
+                0, 0, os.major(rdev), os.minor(rdev), len(name), 0)
+        self._write(header + name + _pad(len(header) + len(name)))
+
+    def _inode(self, st):
+        # Number inodes from 1, so that hard links within the archive share
+        # one, unrelated files never do, and the archive doesn't depend on
+        # where the tree lives.
+        key = (st.st_dev, st.st_ino)
+        ino = self._inodes.get(key)
+        if ino is None:
+            ino = self._inodes[key] = self._nextIno
+            self._nextIno += 1
+        return ino
+
+    def addTree(self, top):
+        """Add everything under C{top}, named relative to it like C{find .}"""
+        paths = listTree(top)
+        stats = [os.lstat(os.path.join(top, x)) for x in paths]
+
+        # Hard links are written together when the last one is reached, and
+        # only that one carries the file's contents.
+        links = {}
+        for path, st in zip(paths, stats):
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                links.setdefault((st.st_dev, st.st_ino), []).append(path)
+
+        for path, st in zip(paths, stats):
+            name = path == '.' and '.' or path[2:]
+            group = links.get((st.st_dev, st.st_ino))
+            if group and stat.S_ISREG(st.st_mode):
+                if path != group[-1]:
+                    continue
+                ino = self._inode(st)
+                for other in group[:-1]:
+                    self._header(other[2:], st, ino, len(group), 0)
+                nlink = len(group)
+            else:
+                ino = self._inode(st)
+                nlink = stat.S_ISDIR(st.st_mode) and st.st_nlink or 1
+            self._addFile(os.path.join(top, path), name, st, ino, nlink)
+
+    def _addFile(self, path, name, st, ino, nlink):
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path)
+            self._header(name, st, ino, nlink, len(target))
+            self._write(target + _pad(len(target)))
+        elif stat.S_ISREG(st.st_mode):
+            self._header(name, st, ino, nlink, st.st_size)
+            fObj = open(path, 'rb')
+            size = 0
+            while True:
+                data = fObj.read(1048576)
+                if not data:
+                    break
+                self._write(data)
+                size += len(data)
+            fObj.close()
+            if size != st.st_size:
+                raise RuntimeError("File %s changed size while archiving"
+                        % (path,))
+            self._write(_pad(size))
+        else:
+            self._header(name, st, ino, nlink, 0)
+
+    def close(self):
+        """Write the trailer, but leave the output file open."""
+        header = '%s%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X' % (
+                NEWC_MAGIC, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0,
+                len(TRAILER) + 1, 0)
+        name = TRAILER + '\0'
+        self._write(header + name + _pad(len(header) + len(name)))
+        self._write(_pad(self.size, self.blockSize))
+
+
+class _Block(object):
+    __slots__ = ('data', 'last', 'result', 'error', 'done')
+
+    def __init__(self, data, last):
+        self.data = data
+        self.last = last
+        self.result = self.error = None
+        self.done = threading.Event()
+
+
+class ParallelGzipWriter(object):
+    """
+    File-like object that gzips what is written to it into C{fObj}, using
+    C{threads} threads.
+    """
+    blockSize = 1 << 20
+
+    def __init__(self, fObj, level=9, threads=0):
+        self.fObj = fObj
+        self.level = level
+        self.threads = threads or cpuCount()
+        self.crc = 0
+        self.size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = []
+        self._work = Queue.Queue()
+        self._workers = []
+        for n in range(self.threads):
+            thread = threading.Thread(target=self._compressLoop,
+                    name='gzip-%d' % n)
+            thread.setDaemon(True)
+            thread.start()
+            self._workers.append(thread)
+
+        if level >= 9:
+            xfl = 2
+        elif level <= 1:
+            xfl = 4
+        else:
+            xfl = 0
+        # No name and no timestamp, so the output only depends on the input.
+        self.fObj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, xfl, 3))
+
+    def _compressLoop(self):
+        while True:
+            block = self._work.get()
+            if block is None:
+                return
+            try:
+                comp = zlib.compressobj(self.level, zlib.DEFLATED,
+                        -zlib.MAX_WBITS)
+                data = comp.compress(block.data)
+                if block.last:
+                    data += comp.flush(zlib.Z_FINISH)
+                else:
+                    data += comp.flush(zlib.Z_SYNC_FLUSH)
+                block.result = data
+            except Exception, err:
+                block.error = err
+            block.done.set()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.blockSize:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            for n in range(0, len(data) - self.blockSize + 1,
+                    self.blockSize):
+                self._submit(data[n:n + self.blockSize], False)
+            rest = len(data) % self.blockSize
+            if rest:
+                self._buffer.append(data[-rest:])
+                self._buffered = rest
+
+    def _submit(self, data, last):
+        # The checksum covers the uncompressed stream in order, so it is
+        # kept here rather than by the workers.
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        block = _Block(data, last)
+        self._pending.append(block)
+        self._work.put(block)
+        # Bound the memory used by blocks waiting to be written.
+        while len(self._pending) > self.threads * 2:
+            self._flushOne()
+        while self._pending and self._pending[0].done.isSet():
+            self._flushOne()
+
+    def _flushOne(self):
+        block = self._pending.pop(0)
+        while not block.done.isSet():
+            block.done.wait(1.0)
+        if block.error:
+            raise block.error
+        self.fObj.write(block.result)
+
+    def close(self):
+        """Finish the gzip stream, but leave the output file open."""
+        try:
+            self._submit(''.join(self._buffer), True)
+            self._buffer = []
+            while self._pending:
+                self._flushOne()
+            self.fObj.write(struct.pack('<II', self.crc & 0xffffffff,
+                self.size & 0xffffffff))
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Let the worker threads exit."""
+        for thread in self._workers:
+            self._work.put(None)
+        self._workers = []
+
+
+def writeCpioGz(top, path, level=9, threads=0):
+    """Archive the tree C{top} into a gzipped newc cpio file at C{path}."""
+    fObj = open(path, 'wb')
+    gz = None
+    try:
+        gz = ParallelGzipWriter(fObj, level, threads)
+        cpio = CpioWriter(gz)
+        cpio.addTree(top)
+        cpio.close()
+        gz.close()
+    finally:
+        if gz:
+            gz.stop()
+        fObj.close()
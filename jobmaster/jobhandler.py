@@ -61,6 +61,7 @@ class JobHandler(Subprocess):
         self.response = ResponseProxy(self.job.rbuilder_url, self.job_data)
 
         self.conaryCfg = master.getConaryConfig(job.rbuilder_url, cache=False)
+        self.changesetCache = master.getChangesetCache()
         self.conaryClient = None
         self.loopManager = master.loopManager
 
@@ -168,13 +169,23 @@ class JobHandler(Subprocess):
             ccfg.root = tempDir
             ccli = conaryclient.ConaryClient(ccfg)
             tc = modelupdate.CMLTroveCache(ccli.db, ccli.repos)
+            if self.changesetCache:
+                self.changesetCache.loadTroveCache(tc)
             ts = ccli.cmlGraph(cml)
             ts.g.realize(modelupdate.CMLActionData(tc, ccfg.flavor[0],
                 ccli.repos, ccfg))
             primaryTups = list(ts.installSet)
             size = 0
-            for trv in ccli.repos.getTroves(primaryTups, withFiles=False):
+            if self.changesetCache:
+                # The trove cache already holds them, and will be saved for
+                # the next job.
+                troves = tc.getTroves(primaryTups)
+            else:
+                troves = ccli.repos.getTroves(primaryTups, withFiles=False)
+            for trv in troves:
                 size += trv.troveInfo.size()
+            if self.changesetCache:
+                self.changesetCache.saveTroveCache(tc)
             ccli.close()
         finally:
             util.rmtree(tempDir)
@@ -0,0 +1,156 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Builds anaconda templates before any job asks for them.
+
+The proxy adds every C{getTemplate} request to the template cache's history.
+Every so often, while the jobmaster has idle slots, a pass works out which
+template and kernel troves were asked for most recently and most often, asks
+their repository for the newest version of each on the same branch, and
+queues the template for the newest pair if it isn't in the cache yet. The
+first job for a new group version then finds its template ready.
+
+Passes run in a subprocess, because looking troves up blocks on the network,
+and queue at most C{templatePrewarmJobs} templates each. They are queued
+behind any template a job is waiting for, see L{jobmaster.templatequeue}.
+"""
+
+import logging
+import time
+import weakref
+from conary.conaryclient import ConaryClient
+from jobmaster.subprocutil import Subprocess
+from jobmaster.templategen import TemplateGenerator
+from jobmaster.templatequeue import Priority, TemplateQueue
+from jobmaster.util import thawTroveTup
+
+log = logging.getLogger(__name__)
+
+
+class TemplatePrewarmer(object):
+    """Starts a L{PrewarmPass} from the jobmaster's main loop when it's due."""
+    # Seconds between passes
+    interval = 900
+
+    def __init__(self, jobmaster, maxJobs):
+        self.jobmaster = weakref.ref(jobmaster)
+        self.maxJobs = maxJobs
+        self.lastRun = 0
+        self.current = None
+
+    def check(self):
+        if not self.maxJobs:
+            return
+        if self.current and self.current.check():
+            return
+        self.current = None
+        if time.time() - self.lastRun < self.interval:
+            return
+        jobmaster = self.jobmaster()
+        idle = jobmaster.cfg.slaveLimit - len(jobmaster.handlers)
+        if idle <= 0:
+            return
+        self.lastRun = time.time()
+        self.current = PrewarmPass(jobmaster, min(idle, self.maxJobs))
+        self.current.start()
+
+    def close(self):
+        if self.current:
+            self.current.kill()
+            self.current = None
+
+
+class PrewarmPass(Subprocess):
+    procName = 'template prewarmer'
+    # Requests older than this, in seconds, are forgotten.
+    window = 7 * 86400
+    # How many of the most requested template/kernel pairs to follow
+    popular = 5
+
+    def __init__(self, jobmaster, maxJobs):
+        self.jobmaster = jobmaster
+        self.maxJobs = maxJobs
+
+    def run(self):
+        jobmaster = self.jobmaster
+        cache = jobmaster.getTemplateCache()
+        history = cache.trimHistory(time.time() - self.window)
+
+        queue = TemplateQueue(jobmaster.cfg.getTemplateQueue())
+        queued = 0
+        for key in self.popularPairs(history):
+            if queued >= self.maxJobs:
+                break
+            url, template, kernel = key
+            try:
+                conaryCfg = jobmaster.getConaryConfig(url)
+                repos = ConaryClient(conaryCfg).getRepos()
+                template = findLatest(repos, template)
+                kernel = kernel and findLatest(repos, kernel)
+            except:
+                log.exception("Could not look up newer troves for %s=%s[%s]",
+                        *key[1])
+                continue
+            if not template or (key[2] and not kernel):
+                continue
+            generator = TemplateGenerator(template, kernel, conaryCfg,
+                    cache.path)
+            if generator._exists() or queue.isQueued(generator.hash):
+                continue
+            log.info("Queueing template %s for %s=%s[%s]", generator.hash,
+                    *template)
+            queue.add(generator.hash, url, template, kernel,
+                    Priority.PREWARM)
+            queued += 1
+        return 0
+
+    def popularPairs(self, history):
+        """
+        Return the most requested (rBuilder URL, template, kernel) keys in
+        C{history}, most popular first. Troves are (name, branch, flavor) so
+        that requests for different versions of a group count together, and
+        ties go to the most recent request.
+        """
+        counts = {}
+        for entry in history:
+            template = thawTroveTup(entry['template'])
+            kernel = entry['kernel'] and thawTroveTup(entry['kernel']) or None
+            key = (str(entry['url']), _branchTup(template),
+                    kernel and _branchTup(kernel))
+            count, latest = counts.get(key, (0, 0))
+            counts[key] = (count + 1, max(latest, entry['time']))
+        ranked = sorted(counts, key=lambda x: counts[x], reverse=True)
+        return ranked[:self.popular]
+
+
+def findLatest(repos, branchTup):
+    """
+    Return the newest trove on the branch in C{branchTup} with exactly its
+    flavor, or C{None}.
+    """
+    name, branch, flavor = branchTup
+    found = repos.findTrove(None, (name, branch, None))
+    found = [x for x in found if x[2] == flavor]
+    if not found:
+        return None
+    return max(found, key=lambda x: x[1])
+
+
+def _branchTup(troveTup):
+    name, version, flavor = troveTup
+    return (name, version.branch().asString(), flavor)
@@ -30,104 +30,552 @@ rBuilder.
 import asyncore
 import base64
 import cgi
+import collections
 import cPickle
 import errno
+import json
 import logging
 import os
 import re
 import socket
+import ssl
 import sys
 import threading
+import time
 import urllib
 import urlparse
 import weakref
 from conary.lib.log import setupLogging
+from jobmaster import osutil
+from jobmaster.proxystats import ProxyStats
+from jobmaster.resolver import Resolver
+from jobmaster.templatecache import TemplateCache
 from jobmaster.templategen import TemplateGenerator
+from jobmaster.templatequeue import Priority, TemplateQueue
+from jobmaster.uploadspool import UploadSpool
 
 log = logging.getLogger(__name__)
 
 
+# Default whitelist of request paths that may be proxied upstream, by method.
+# More can be added with the proxyAllowPath configuration option.
 ALLOWED_PATHS = {
         'GET': [
-            re.compile('^/downloadImage?.*'),
-            re.compile('^/images/'),
+            r'^/downloadImage?.*',
+            r'^/images/',
             ],
         'POST': [
-            re.compile('^/api/v1/images/\d+/build_log$'),
+            r'^/api/v1/images/\d+/build_log$',
             ],
         'PUT': [
-            re.compile('^/uploadBuild/\d+/'),
-            re.compile('^/api/v1/images/\d+/?$'),
-            re.compile('^/api/v1/images/\d+/build_files$'),
+            r'^/uploadBuild/\d+/',
+            r'^/api/v1/images/\d+/?$',
+            r'^/api/v1/images/\d+/build_files$',
             ],
         }
 
+# Relative shares of the uplink cap for request bodies, by the PathMatcher
+# rule that allowed the request. Rules not listed get a weight of 1. A weight
+# of None marks control traffic that is always relayed at once.
+UPLINK_WEIGHTS = {
+        r'POST ^/api/v1/images/\d+/build_log$': None,
+        r'PUT ^/api/v1/images/\d+/?$': None,
+        r'PUT ^/api/v1/images/\d+/build_files$': 2,
+        }
+
+
+# Not exported by the socket module in python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Flags for splice(2)
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
+
+# Peers allowed to read the status report
+LOCAL_ADDRESSES = set(['::1', '127.0.0.1', '::ffff:127.0.0.1'])
+
 
 class ConnectionClosed(Exception):
     pass
 
 
-class ProxyServer(asyncore.dispatcher):
-    def __init__(self, port=0, _map=None, jobmaster=None):
-        asyncore.dispatcher.__init__(self, None, _map)
-        self.jobmaster = jobmaster and weakref.ref(jobmaster)
+def _would_block(err):
+    """
+    Return True if a socket error from a non-blocking send or recv, plain or
+    TLS, just means to try again later.
+    """
+    if isinstance(err, ssl.SSLError):
+        return err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                ssl.SSL_ERROR_WANT_WRITE)
+    return err.args[0] == errno.EAGAIN
+
+
+class ByteQueue(object):
+    """
+    FIFO byte buffer used for the proxy send and receive queues.
+
+    Appended strings are kept as a queue of chunks plus an offset into the
+    first one, so neither appending nor consuming copies the unconsumed
+    remainder and relaying costs stay linear in the number of bytes moved.
+    Chunks that are consumed whole are handed back without copying.
+    """
+    # Appended strings are merged into the last chunk while it is shorter
+    # than this.
+    merge_size = 4096
+
+    def __init__(self, data=''):
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._size = 0
+        self.append(data)
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def append(self, data):
+        """Add C{data} to the end of the queue."""
+        if not data:
+            return
+        chunks = self._chunks
+        if (chunks and len(chunks[-1]) < self.merge_size
+                and type(data) is str and type(chunks[-1]) is str):
+            # Merge small pieces as they come in so that searches for a
+            # delimiter that arrives a few bytes at a time see few chunks.
+            chunks[-1] += data
+        else:
+            chunks.append(data)
+        self._size += len(data)
 
-        self.create_socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.bind(('::', port))
-        self.port = self.socket.getsockname()[1]
-        self.listen(5)
+    def _coalesce(self, size):
+        """
+        Merge chunks at the front of the queue until the first one holds at
+        least C{size} bytes (or everything), and return it.
+        """
+        chunks = self._chunks
+        first = chunks[0][self._offset:]
+        if len(first) < size and len(chunks) > 1:
+            pieces = [first]
+            have = len(first)
+            chunks.popleft()
+            while chunks and have < size:
+                have += len(chunks[0])
+                pieces.append(str(chunks.popleft()))
+            first = ''.join(pieces)
+            chunks.appendleft(first)
+        elif self._offset:
+            chunks[0] = first
+        self._offset = 0
+        return first
+
+    def view(self, size):
+        """
+        Return a view of at least C{size} bytes (or everything) at the front
+        of the queue, merging small chunks first so that callers can make
+        fewer, larger system calls.
+        """
+        if not self._chunks:
+            return ''
+        if len(self._chunks[0]) - self._offset >= size:
+            return buffer(self._chunks[0], self._offset)
+        return buffer(self._coalesce(size))
 
-        self.lock = threading.Lock()
-        self.targetMap = {}
+    def peek(self, size):
+        """Return up to C{size} bytes from the front without consuming them."""
+        if not self._chunks:
+            return ''
+        chunk = self._chunks[0]
+        if len(chunk) - self._offset >= size:
+            return chunk[self._offset:self._offset + size]
+        return self._coalesce(size)[:size]
 
-    def serve_forever(self):
-        asyncore.loop(use_poll=True, map=self._map)
+    def startswith(self, prefix):
+        return self.peek(len(prefix)) == prefix
 
-    def handle_accept(self):
-        while True:
+    def find(self, sub, start=0):
+        """
+        Return the offset of C{sub} from the front of the queue, or -1 if it is
+        not found. The search begins at C{start}, so callers waiting for a
+        delimiter can skip what they have already scanned. Chunks are searched
+        in place rather than merged.
+        """
+        overlap = len(sub) - 1
+        pos = 0
+        tail = ''
+        offset = self._offset
+        for chunk in self._chunks:
+            end = pos + len(chunk) - offset
+            if end > start:
+                if tail:
+                    # Matches straddling the previous chunk boundary
+                    joined = tail + chunk[offset:offset + overlap]
+                    index = joined.find(sub,
+                            max(start - (pos - len(tail)), 0))
+                    if index >= 0:
+                        return pos - len(tail) + index
+                index = chunk.find(sub, offset + max(start - pos, 0))
+                if index >= 0:
+                    return pos + index - offset
+            if overlap:
+                tail = (tail + chunk[max(offset, len(chunk) - overlap):]
+                        )[-overlap:]
+            pos = end
+            offset = 0
+        return -1
+
+    def consume(self, size):
+        """Discard up to C{size} bytes from the front of the queue."""
+        chunks = self._chunks
+        size = min(size, self._size)
+        self._size -= size
+        while size:
+            left = len(chunks[0]) - self._offset
+            if size < left:
+                self._offset += size
+                break
+            chunks.popleft()
+            self._offset = 0
+            size -= left
+
+    def take(self, size):
+        """Remove and return up to C{size} bytes from the front."""
+        if not self._chunks:
+            return ''
+        chunk = self._chunks[0]
+        if not self._offset and len(chunk) == min(size, self._size):
+            # Hand back whole chunks without copying them.
+            self._chunks.popleft()
+            self._size -= len(chunk)
+            return chunk
+        data = self.peek(size)
+        self.consume(len(data))
+        return data
+
+    def take_view(self, size):
+        """
+        Like L{take}, but return part of a chunk as a buffer referring to it
+        instead of a copy.
+        """
+        if not self._chunks:
+            return ''
+        chunk = self._chunks[0]
+        left = len(chunk) - self._offset
+        if size >= left:
+            if not self._offset:
+                self._chunks.popleft()
+                self._size -= len(chunk)
+                return chunk
+            data = buffer(chunk, self._offset)
+        else:
+            data = buffer(chunk, self._offset, size)
+        self.consume(len(data))
+        return data
+
+
+class SplicePipe(object):
+    """
+    Kernel pipe used to relay entity bodies between two sockets with
+    C{splice(2)}, without copying the data through userspace.
+    """
+    # Default pipe capacity on Linux.
+    capacity = 65536
+
+    # Cleared when the kernel refuses to splice our sockets so that later
+    # transfers go straight to the userspace path.
+    available = hasattr(osutil, 'splice')
+
+    def __init__(self):
+        self.reader, self.writer = os.pipe()
+        self.pending = 0
+
+    def fill(self, fd, size):
+        """
+        Move up to C{size} bytes from C{fd} into the pipe. Returns the number
+        of bytes moved, 0 at end of file, or C{None} if C{fd} would block.
+        """
+        size = min(size, self.capacity - self.pending)
+        if not size:
+            return None
+        try:
+            moved = osutil.splice(fd, self.writer, size,
+                    SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return None
+            raise
+        self.pending += moved
+        return moved
+
+    def drain(self, fd):
+        """
+        Move as much pending data as possible from the pipe to C{fd}. Returns
+        C{False} if C{fd} would block before the pipe was empty.
+        """
+        while self.pending:
             try:
-                sock, _ = self.socket.accept()
-            except socket.error, err:
-                if err.args[0] == errno.EAGAIN:
-                    break
+                moved = osutil.splice(self.reader, fd, self.pending,
+                        SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+            except OSError, err:
+                if err.errno == errno.EAGAIN:
+                    return False
                 raise
+            self.pending -= moved
+        return True
+
+    def close(self):
+        os.close(self.reader)
+        os.close(self.writer)
+        self.reader = self.writer = None
+
+
+class PathMatcher(object):
+    """
+    Decide whether a request may be proxied, using one combined regex per
+    method and a bounded cache of recent decisions.
+    """
+    cacheSize = 1024
+
+    def __init__(self, allowed=None, extra=()):
+        """
+        @param allowed: Mapping of method to a list of path regexes.
+        @param extra: Further rules, each a string C{"METHOD regex"}.
+        """
+        rules = {}
+        for method, patterns in (allowed or ALLOWED_PATHS).iteritems():
+            rules[method] = list(patterns)
+        for line in extra:
+            method, pattern = line.split(None, 1)
+            rules.setdefault(method.upper(), []).append(pattern)
+
+        self.rules = {}
+        self.matchers = {}
+        for method, patterns in rules.iteritems():
+            names = ['%s %s' % (method, x) for x in patterns]
+            self.rules[method] = names
+            self.matchers[method] = re.compile('|'.join(
+                '(?P<r%d>%s)' % (x, pattern)
+                for (x, pattern) in enumerate(patterns)))
+        self.cache = collections.OrderedDict()
+
+    def match(self, method, path):
+        """
+        Return the name of the rule permitting C{method} on C{path}, or
+        C{None} if it is not permitted.
+        """
+        key = method, path
+        try:
+            rule = self.cache.pop(key)
+        except KeyError:
+            rule = None
+            matcher = self.matchers.get(method)
+            if matcher:
+                match = matcher.match(path)
+                if match:
+                    rule = self.rules[method][int(match.lastgroup[1:])]
+            if len(self.cache) >= self.cacheSize:
+                self.cache.popitem(last=False)
+        self.cache[key] = rule
+        return rule
+
+
+class TemplateTracker(object):
+    """
+    Tracks clients that are long-polling C{getTemplate} until a template is
+    done, so that all the clients waiting on one template are answered
+    together.
+
+    With a template queue, the proxy only queues templates and the
+    jobmaster's scheduler builds them; a template that is still queued counts
+    as in progress. Without one, the proxy starts generators itself.
+    """
+    # Upper bound on how long a client may ask to wait, in seconds.
+    maxWait = 300
+    # Seconds between checks on templates that someone is waiting for
+    interval = 1.0
+
+    def __init__(self, queue=None):
+        self.queue = queue
+        self.generators = {}
+        self.waiters = {}
+        self.lastCheck = 0
+
+    def started(self, generator):
+        self.generators[generator.hash] = generator
+
+    def status(self, generator):
+        """Return the status and path of C{generator}'s template."""
+        status, path = generator.getTemplate(start=False)
+        if (status == TemplateGenerator.Status.NOT_FOUND and self.queue
+                and self.queue.isQueued(generator.hash)):
+            status = TemplateGenerator.Status.IN_PROGRESS
+        return status, path
+
+    def wait(self, client, generator, timeout):
+        """
+        Answer C{client} with the status of C{generator}'s template once it
+        is no longer in progress, or after C{timeout} seconds.
+        """
+        deadline = time.time() + min(timeout, self.maxWait)
+        self.waiters.setdefault(generator.hash, []).append(
+                (deadline, weakref.ref(client), generator))
+
+    def check(self):
+        now = time.time()
+        polling = now - self.lastCheck >= self.interval
+        if polling:
+            self.lastCheck = now
+        for hash, waiters in self.waiters.items():
+            running = self.generators.get(hash)
+            if running is not None and running.check():
+                # Still building; only answer clients whose time is up.
+                expired = [x for x in waiters if x[0] <= now]
+                if not expired:
+                    continue
+                status = TemplateGenerator.Status.IN_PROGRESS
+                path = expired[0][2].path
+            elif running is None and not polling:
+                continue
             else:
-                ProxyClient(sock, self._map, self)
+                # The generator exited, or was started elsewhere and so has
+                # to be checked on. One check answers all the waiters.
+                self.generators.pop(hash, None)
+                status, path = self.status(waiters[0][2])
+                if status == TemplateGenerator.Status.IN_PROGRESS:
+                    expired = [x for x in waiters if x[0] <= now]
+                else:
+                    expired = list(waiters)
 
-    def addTarget(self, address, targetUrl):
+            for waiter in expired:
+                waiters.remove(waiter)
+                client = waiter[1]()
+                if client is None or not client.connected:
+                    continue
+                try:
+                    client.send_template_status(status, path)
+                except ConnectionClosed:
+                    client.close()
+            if not waiters:
+                del self.waiters[hash]
+
+        # Forget about generators nobody is waiting on once they exit.
+        for hash, generator in self.generators.items():
+            if hash not in self.waiters and not generator.check():
+                del self.generators[hash]
+
+
+class UpstreamPool(object):
+    """
+    Idle keep-alive connections to rBuilders, keyed by target URL, so that
+    later requests to the same target can skip the TCP handshake.
+    """
+
+    def __init__(self, maxSize=8, idleTimeout=4):
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.idle = {}
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return sum(len(x) for x in self.idle.itervalues())
+
+    def get(self, targetUrl):
+        """
+        Return an idle connection to C{targetUrl}, or C{None} if there isn't
+        one.
+        """
+        self.expire()
+        conns = self.idle.get(targetUrl)
+        while conns:
+            upstream, _ = conns.pop()
+            if upstream.connected:
+                self.hits += 1
+                return upstream
+        self.misses += 1
+        return None
+
+    def put(self, targetUrl, upstream):
+        """
+        Keep C{upstream} for reuse. Returns C{False} if the pool is full, in
+        which case the caller should close the connection.
+        """
+        self.expire()
+        if len(self) >= self.maxSize:
+            return False
+        self.idle.setdefault(targetUrl, []).append((upstream, time.time()))
+        return True
+
+    def expire(self):
+        """Close connections that have been idle for too long."""
+        cutoff = time.time() - self.idleTimeout
+        for targetUrl, conns in self.idle.items():
+            keep = []
+            for upstream, released in conns:
+                if not upstream.connected:
+                    continue
+                elif released < cutoff:
+                    upstream.close()
+                else:
+                    keep.append((upstream, released))
+            if keep:
+                self.idle[targetUrl] = keep
+            else:
+                del self.idle[targetUrl]
+
+    def close(self):
+        idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for upstream, _ in conns:
+                upstream.close()
+
+
+class TargetMap(object):
+    """
+    Reference-counted mapping of slave addresses to the URL of the rBuilder
+    that each one's requests are proxied to.
+    """
+
+    def __init__(self, targets=None):
+        self.lock = threading.Lock()
+        self.targets = dict(targets or {})
+
+    def add(self, address, targetUrl):
         if not isinstance(address, basestring):
             address = address.format(useMask=False)
         self.lock.acquire()
         try:
-            (existing, refs) = self.targetMap.get(address, (None, 0))
+            (existing, refs) = self.targets.get(address, (None, 0))
             if existing and existing != targetUrl:
                 raise RuntimeError("You must use network containers when "
                         "sharing a jobmaster between head nodes")
             refs += 1
-            self.targetMap[address] = (targetUrl, refs)
+            self.targets[address] = (targetUrl, refs)
         finally:
             self.lock.release()
+        return address
 
-    def removeTarget(self, address):
+    def remove(self, address):
         if not isinstance(address, basestring):
             address = address.format(useMask=False)
         self.lock.acquire()
         try:
-            (targetUrl, refs) = self.targetMap[address]
+            (targetUrl, refs) = self.targets[address]
             assert refs > 0
             refs -= 1
             if refs:
-                self.targetMap[address] = (targetUrl, refs)
+                self.targets[address] = (targetUrl, refs)
             else:
-                del self.targetMap[address]
+                del self.targets[address]
         finally:
             self.lock.release()
+        return address
 
-    def findTarget(self, address):
+    def find(self, address):
         self.lock.acquire()
         try:
-            target = self.targetMap.get(address)
+            target = self.targets.get(address)
             if target is None:
                 return None
             (targetUrl, refs) = target
@@ -136,6 +584,195 @@ class ProxyServer(asyncore.dispatcher):
         finally:
             self.lock.release()
 
+    def copy(self):
+        self.lock.acquire()
+        try:
+            return dict(self.targets)
+        finally:
+            self.lock.release()
+
+
+class UplinkFlow(object):
+    __slots__ = ('weight', 'tokens', 'mark')
+
+    def __init__(self, weight, mark):
+        self.weight = weight
+        self.tokens = 0
+        self.mark = mark
+
+
+class UplinkScheduler(object):
+    """
+    Shares a global cap on request bodies relayed upstream between the
+    clients currently sending one. Each flow has a token bucket that is
+    refilled with its weighted share of the cap; flows with no weight are
+    control traffic, which is never held back but whose bytes still count
+    against the cap.
+
+    Bytes are accounted for from each client's C{bytes_received} counter, so
+    the receive paths only have to ask for their L{allowance}.
+    """
+    # Minimum time between refills, in seconds.
+    interval = 0.01
+    # Bucket depth, in seconds worth of a flow's share.
+    burst = 1.0
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.flows = weakref.WeakKeyDictionary()
+        self.last = time.time()
+        self.throttled = 0
+
+    def register(self, client, weight):
+        """Start shaping the request body C{client} is about to send."""
+        if not self.rate:
+            return
+        self._refill()
+        self.flows[client] = UplinkFlow(weight, client.bytes_received)
+
+    def allowance(self, client):
+        """
+        Return how many bytes C{client} may read now, or C{None} if it isn't
+        limited.
+        """
+        flow = self.flows.get(client)
+        if flow is None or flow.weight is None:
+            return None
+        self._refill()
+        tokens = flow.tokens - (client.bytes_received - flow.mark)
+        if tokens <= 0:
+            self.throttled += 1
+            return 0
+        return int(tokens)
+
+    def _refill(self):
+        now = time.time()
+        elapsed = now - self.last
+        if elapsed < self.interval:
+            return
+        self.last = now
+
+        budget = self.rate * min(elapsed, self.burst)
+        shaped = []
+        for client, flow in self.flows.items():
+            used = client.bytes_received - flow.mark
+            flow.mark = client.bytes_received
+            if not client.connected or client.state not in (STATE_COPY_ALL,
+                    STATE_COPY_SIZE, STATE_COPY_CHUNKED, STATE_COPY_TRAILER):
+                # The body is done.
+                del self.flows[client]
+                budget -= used
+            elif flow.weight is None:
+                budget -= used
+            else:
+                flow.tokens -= used
+                shaped.append(flow)
+        if not shaped or budget <= 0:
+            return
+        total = float(sum(x.weight for x in shaped))
+        for flow in shaped:
+            share = flow.weight / total
+            flow.tokens = min(flow.tokens + budget * share,
+                    self.rate * share * self.burst)
+
+    def asDict(self):
+        return {
+                'limit': self.rate,
+                'flows': len(self.flows),
+                'throttled': self.throttled,
+                }
+
+
+class ProxyServer(asyncore.dispatcher):
+    def __init__(self, port=0, _map=None, jobmaster=None, poolSize=8,
+            poolTimeout=4, resolverTtl=60, backlog=5, reusePort=False,
+            targets=None, allowPaths=(), uplinkLimit=0, spoolDir=None,
+            tlsCaFile=None, tlsVerify=True, templateDir=None,
+            templateBudget=0, templateQueue=None, jobs=None, worker=None):
+        asyncore.dispatcher.__init__(self, None, _map)
+        self.jobmaster = jobmaster and weakref.ref(jobmaster)
+        # Index of the worker process this runs in, if there are several.
+        self.worker = worker
+        self.pathMatcher = PathMatcher(extra=allowPaths)
+        self.upstreamPool = UpstreamPool(poolSize, poolTimeout)
+        self.resolver = Resolver(_map, ttl=resolverTtl)
+        self.stats = ProxyStats()
+        for address, jobId in (jobs or {}).items():
+            self.stats.setJob(address, jobId)
+        self.templateQueue = templateQueue and TemplateQueue(templateQueue)
+        self.templates = TemplateTracker(self.templateQueue)
+        self.uplink = UplinkScheduler(uplinkLimit)
+        self.tlsCaFile = tlsCaFile
+        self.tlsVerify = tlsVerify
+        self._tlsContext = None
+        self.spool = spoolDir and UploadSpool(spoolDir, self) or None
+        self.templateCache = (templateDir
+                and TemplateCache(templateDir, templateBudget,
+                    # Never hold up the event loop for a busy catalog.
+                    catalogTimeout=0) or None)
+
+        self.create_socket(socket.AF_INET6, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            # Let several worker processes accept on the same port.
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.bind(('::', port))
+        self.port = self.socket.getsockname()[1]
+        self.listen(backlog)
+
+        self.targets = TargetMap(targets)
+
+    def serve_forever(self):
+        asyncore.loop(use_poll=True, map=self._map)
+
+    def check(self):
+        """Periodic housekeeping, called from the main loop."""
+        self.upstreamPool.expire()
+        self.templates.check()
+        if self.spool:
+            self.spool.check()
+        if self.templateCache:
+            self.templateCache.check()
+
+    @property
+    def tlsContext(self):
+        """Client-side TLS settings for C{https} targets."""
+        if self._tlsContext is None:
+            context = ssl.create_default_context(cafile=self.tlsCaFile)
+            if not self.tlsVerify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self._tlsContext = context
+        return self._tlsContext
+
+    def handle_accept(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error, err:
+                if err.args[0] == errno.EAGAIN:
+                    break
+                raise
+            else:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.stats.clients.add(ProxyClient(sock, self._map, self))
+
+    def addTarget(self, address, targetUrl, jobId=None):
+        address = self.targets.add(address, targetUrl)
+        self.stats.setJob(address, jobId)
+
+    def removeTarget(self, address):
+        address = self.targets.remove(address)
+        if not self.targets.find(address):
+            self.stats.forget(address)
+            if self.templateCache:
+                # The slave's container is gone, and with it its view of
+                # the template cache.
+                self.templateCache.release(address)
+
+    def findTarget(self, address):
+        return self.targets.find(address)
+
 
 (STATE_HEADER, STATE_COPY_ALL, STATE_COPY_SIZE, STATE_COPY_CHUNKED,
         STATE_COPY_TRAILER, STATE_CLOSING) = range(6)
@@ -145,13 +782,23 @@ class ProxyDispatcher(asyncore.dispatcher):
     """asyncore handler for the jobmaster proxy server"""
     chunk_size = 8192
     buffer_threshold = chunk_size * 8
+    buffer_class = ByteQueue
+    # Fixed-length entities at least this large are relayed with splice(2).
+    splice_threshold = 1048576
 
     def __init__(self, sock, _map, server, pair=None):
         asyncore.dispatcher.__init__(self, sock, _map)
         self._server = weakref.ref(server)
-        self.in_buffer = self.out_buffer = ''
+        self.in_buffer = self.buffer_class()
+        self.out_buffer = self.buffer_class()
         self.state = STATE_HEADER
         self.copy_remaining = 0L
+        # How far into in_buffer the current delimiter search has got
+        self.scan_offset = 0
+        self.bytes_received = self.bytes_sent = 0
+        self.splice_ok = False
+        self.out_pipe = None
+        self.tls = False
         self._remote = None
         self._pair = pair and weakref.ref(pair) or None
 
@@ -196,7 +843,7 @@ class ProxyDispatcher(asyncore.dispatcher):
         """
         Send C{data} as soon as possible, without blocking.
         """
-        self.out_buffer += data
+        self.out_buffer.append(data)
         self._do_send()
 
     def _do_send(self):
@@ -205,11 +852,25 @@ class ProxyDispatcher(asyncore.dispatcher):
         """
         if not self.connected:
             return
+        if self.out_pipe and self.out_pipe.pending:
+            # Spliced data was queued before anything now in out_buffer.
+            pending = self.out_pipe.pending
+            try:
+                drained = self.out_pipe.drain(self.socket.fileno())
+            except OSError, err:
+                if err.errno not in (errno.ECONNRESET, errno.EPIPE):
+                    log.debug("Closing socket due to splice error %s",
+                            str(err))
+                raise ConnectionClosed
+            self.bytes_sent += pending - self.out_pipe.pending
+            if not drained:
+                return
         while self.out_buffer:
             try:
-                sent = self.socket.send(self.out_buffer)
+                sent = self.socket.send(
+                        self.out_buffer.view(self.buffer_threshold))
             except socket.error, err:
-                if err.args[0] == errno.EAGAIN:
+                if _would_block(err):
                     # OS send queue is full; save the rest for later.
                     break
                 else:
@@ -218,7 +879,11 @@ class ProxyDispatcher(asyncore.dispatcher):
                                 str(err))
                     raise ConnectionClosed
             else:
-                self.out_buffer = self.out_buffer[sent:]
+                if not sent:
+                    # TLS needs the socket to become ready again.
+                    break
+                self.out_buffer.consume(sent)
+                self.bytes_sent += sent
 
         if self.state == STATE_CLOSING:
             # Write buffer is flushed; close it now.
@@ -228,14 +893,27 @@ class ProxyDispatcher(asyncore.dispatcher):
         self._do_send()
 
     def writable(self):
-        return (not self.connected) or len(self.out_buffer)
+        return (not self.connected) or self.send_pending()
+
+    def send_pending(self):
+        """Return the number of bytes waiting to be sent."""
+        pending = len(self.out_buffer)
+        if self.out_pipe:
+            pending += self.out_pipe.pending
+        return pending
 
     # Receiving machinery
     def handle_read(self):
+        if self.spliceable():
+            return self.handle_splice()
+        size = self.chunk_size
+        allowance = self.recv_allowance()
+        if allowance is not None:
+            size = max(min(size, allowance), 1)
         try:
-            data = self.socket.recv(self.chunk_size)
+            data = self.socket.recv(size)
         except socket.error, err:
-            if err.args[0] == errno.EAGAIN:
+            if _would_block(err):
                 # OS recv queue is empty.
                 return
             else:
@@ -243,8 +921,9 @@ class ProxyDispatcher(asyncore.dispatcher):
                     log.debug("Closing socket due to read error %s", str(err))
                 raise ConnectionClosed
 
+        self.bytes_received += len(data)
         if True or self.state != STATE_CLOSING:
-            self.in_buffer += data
+            self.in_buffer.append(data)
             self._do_recv()
 
         if not data:
@@ -265,14 +944,17 @@ class ProxyDispatcher(asyncore.dispatcher):
                 # Skip blank lines like those Conary likes to send when it
                 # hasn't received any data for a while.
                 while self.in_buffer.startswith('\r\n'):
-                    self.in_buffer = self.in_buffer[2:]
-                end = self.in_buffer.find('\r\n\r\n')
+                    self.in_buffer.consume(2)
+                    self.scan_offset = 0
+                end = self.in_buffer.find('\r\n\r\n', self.scan_offset)
                 if end > -1:
-                    end += 4
-                    header, self.in_buffer = (self.in_buffer[:end],
-                            self.in_buffer[end:])
+                    self.scan_offset = 0
+                    header = self.in_buffer.take(end + 4)
                     self.handle_header(header)
-                elif len(self.in_buffer) > self.buffer_threshold:
+                    continue
+                # Resume the search where it left off when more arrives.
+                self.scan_offset = max(len(self.in_buffer) - 3, 0)
+                if len(self.in_buffer) > self.buffer_threshold:
                     log.warning("Dropping connection due to excessively large "
                             "header.")
                     raise ConnectionClosed
@@ -281,9 +963,16 @@ class ProxyDispatcher(asyncore.dispatcher):
 
     def readable(self):
         # Read data if we're processing headers (not copying), or we're copying
-        # and the pair socket is not full.
+        # and the pair socket is not full and there is bandwidth to spare.
         return ((not self.connected) or self.state == STATE_HEADER
-                or self.pair_copyable())
+                or (self.pair_copyable() and self.recv_allowance() != 0))
+
+    def recv_allowance(self):
+        """
+        Return how many bytes may be read right now, or C{None} if there is no
+        limit.
+        """
+        return None
 
     def handle_header(self, header):
         raise NotImplementedError
@@ -291,7 +980,17 @@ class ProxyDispatcher(asyncore.dispatcher):
     # Copying machinery
     def copyable(self):
         """Return True if the output buffer can accept more bytes."""
-        return len(self.out_buffer) < self.buffer_threshold
+        return self.send_pending() < self.buffer_threshold
+
+    def entity_complete(self):
+        """
+        Return True if the last message has been received in full and nothing
+        else has arrived since.
+        """
+        if self.in_buffer:
+            return False
+        return (self.state == STATE_HEADER or
+                (self.state == STATE_COPY_SIZE and not self.copy_remaining))
 
     def pair_copyable(self):
         """Return True if there is a pair socket and it is copyable."""
@@ -300,6 +999,7 @@ class ProxyDispatcher(asyncore.dispatcher):
     def start_copy(self, headers):
         """Set copy mode based on the info in the given headers."""
         assert self.state == STATE_HEADER
+        self.scan_offset = 0
         if 'transfer-encoding' in headers:
             if headers['transfer-encoding'] != 'chunked':
                 log.error("Don't know how to copy transfer encoding %r",
@@ -310,6 +1010,8 @@ class ProxyDispatcher(asyncore.dispatcher):
         elif 'content-length' in headers:
             self.copy_remaining = long(headers['content-length'])
             self.state = STATE_COPY_SIZE
+            self.splice_ok = (SplicePipe.available
+                    and self.copy_remaining >= self.splice_threshold)
         else:
             self.state = STATE_COPY_ALL
 
@@ -332,16 +1034,18 @@ class ProxyDispatcher(asyncore.dispatcher):
         elif self.state == STATE_COPY_CHUNKED:
             if not self.copy_remaining:
                 # Read the size of the next chunk.
-                end = self.in_buffer.find('\r\n')
+                end = self.in_buffer.find('\r\n', self.scan_offset)
                 if end < 0:
+                    self.scan_offset = max(len(self.in_buffer) - 1, 0)
                     if len(self.in_buffer) > self.buffer_threshold:
                         log.warning("Very large chunk header; "
                                 "closing connection.")
                         raise ConnectionClosed
                     # No chunk header yet.
                     return
+                self.scan_offset = 0
 
-                header = self.in_buffer[:end].split(';')[0]
+                header = self.in_buffer.peek(end).split(';')[0]
                 try:
                     next_size = int(header, 16)
                 except ValueError:
@@ -362,13 +1066,15 @@ class ProxyDispatcher(asyncore.dispatcher):
             if len(self.in_buffer) < 2:
                 # Not enough bytes to determine whether there is a trailer.
                 return
-            elif self.in_buffer[:2] == '\r\n':
+            elif self.in_buffer.startswith('\r\n'):
                 # No trailer.
                 copyBytes = 2
             else:
-                end = self.in_buffer.find('\r\n\r\n')
+                end = self.in_buffer.find('\r\n\r\n', self.scan_offset)
                 if end < 0:
+                    self.scan_offset = max(len(self.in_buffer) - 3, 0)
                     return
+                self.scan_offset = 0
 
                 # Trailer found.
                 copyBytes = end + 4
@@ -378,12 +1084,66 @@ class ProxyDispatcher(asyncore.dispatcher):
         else:
             assert False
 
-        buf = self.in_buffer[:copyBytes]
-        self.in_buffer = self.in_buffer[copyBytes:]
-        self.pair.send(buf)
+        if self.state in (STATE_COPY_ALL, STATE_COPY_SIZE, STATE_COPY_CHUNKED):
+            # Entity data is passed on as views of the received chunks. If
+            # that stops short of copyBytes, the rest goes on the next pass.
+            data = self.in_buffer.take_view(copyBytes)
+        else:
+            # Delimiters that end a state change have to go in one piece.
+            data = self.in_buffer.take(copyBytes)
+        self.pair.send(data)
 
         if self.state in (STATE_COPY_SIZE, STATE_COPY_CHUNKED):
-            self.copy_remaining -= copyBytes
+            self.copy_remaining -= len(data)
+
+    def spliceable(self):
+        """
+        Return True if the rest of a fixed-length entity can be spliced
+        straight into the pair socket.
+        """
+        if not (self.splice_ok and self.state == STATE_COPY_SIZE
+                and self.copy_remaining and not self.in_buffer
+                and not self.tls):
+            return False
+        # Anything already queued in userspace has to go out first, and TLS
+        # connections have to be written through the TLS layer.
+        pair = self.pair
+        return (pair and pair.connected and not pair.tls
+                and not pair.out_buffer)
+
+    def handle_splice(self):
+        """Relay entity bytes from our socket to the pair via a pipe."""
+        pair = self.pair
+        if not pair.out_pipe:
+            pair.out_pipe = SplicePipe()
+        size = self.copy_remaining
+        allowance = self.recv_allowance()
+        if allowance is not None:
+            size = max(min(size, allowance), 1)
+        try:
+            moved = pair.out_pipe.fill(self.socket.fileno(), size)
+        except OSError, err:
+            if err.errno in (errno.EINVAL, errno.ENOSYS):
+                # Not supported for these descriptors; nothing was moved, so
+                # fall back to copying.
+                log.debug("splice not available, copying instead: %s", err)
+                SplicePipe.available = self.splice_ok = False
+                return
+            if err.errno not in (errno.ECONNRESET, errno.EPIPE):
+                log.debug("Closing socket due to splice error %s", str(err))
+            raise ConnectionClosed
+        if moved is None:
+            return
+        elif not moved:
+            raise ConnectionClosed
+
+        self.bytes_received += moved
+        self.copy_remaining -= moved
+        if not self.copy_remaining:
+            # Done copying fixed-length entity; back to reading headers.
+            self.state = STATE_HEADER
+            self.splice_ok = False
+        pair._do_send()
 
     # Cleanup machinery
     def handle_close(self):
@@ -403,6 +1163,9 @@ class ProxyDispatcher(asyncore.dispatcher):
     def close(self):
         """Close the dispatcher object and its socket."""
         asyncore.dispatcher.close(self)
+        if self.out_pipe:
+            self.out_pipe.close()
+            self.out_pipe = None
         pair, self._pair = self.pair, None
         if pair:
             pair.pair_closed()
@@ -413,10 +1176,40 @@ class ProxyDispatcher(asyncore.dispatcher):
 
 class ProxyClient(ProxyDispatcher):
     upstream = None
+    spool_writer = None
+    _peer_address = None
+
+    @property
+    def peer_address(self):
+        if self._peer_address is None:
+            try:
+                self._peer_address = self.socket.getpeername()[0]
+            except:
+                self._peer_address = ''
+        return self._peer_address
+
+    def close(self):
+        pair = self.pair
+        if pair and pair is self.spool_writer:
+            # Discard the partial entry.
+            self.spool_writer = None
+        elif pair and not self.entity_complete():
+            # The request was cut off, so the upstream can't be reused.
+            pair.keep_alive = False
+        server = self.server
+        if server:
+            server.stats.clientClosed(self)
+        ProxyDispatcher.close(self)
+
+    def recv_allowance(self):
+        server = self.server
+        if server is None or self.state == STATE_HEADER:
+            return None
+        return server.uplink.allowance(self)
 
     def pair_closed(self):
         """Handle the upstream socket closing by changing to CLOSED state."""
-        if self.out_buffer:
+        if self.send_pending():
             # Don't close the connection until the send queue is empty.
             self.state = STATE_CLOSING
         else:
@@ -443,7 +1236,10 @@ class ProxyClient(ProxyDispatcher):
         log.debug('%s "%s"', self.name, requestline)
 
         if path.startswith('/templates/'):
+            self.server.stats.countRequest('/templates/')
             return self.do_templates(method, path, headers)
+        elif path == '/status':
+            return self.do_status(method)
         else:
             return self.do_proxy(request, method, path, headers)
 
@@ -459,60 +1255,141 @@ class ProxyClient(ProxyDispatcher):
 
     def do_proxy(self, request, method, path, headers):
         """Attempt to proxy a request upstream."""
-        proxyOK = False
-        paths = ALLOWED_PATHS.get(method)
-        if paths:
-            for pattern in paths:
-                if pattern.match(path):
-                    proxyOK = True
-                    break
-        if not proxyOK:
+        server = self.server
+        rule = server.pathMatcher.match(method, path)
+        if rule is None:
+            server.stats.countRequest('forbidden')
             return self.send_text('403 Forbidden',
                     'Proxying not permitted\r\n')
-
-        if self.pair:
-            self.pair.send(request)
-        else:
-            # Note that we don't need to keep a strong reference to the paired
-            # connection because one is kept in the asyncore poll map.
-            upstream = ProxyUpstream(None, self._map, self._server(), self)
-            upstream._pair = weakref.ref(self)
+        server.stats.countRequest(rule)
+
+        if server.spool and not (self.pair and self.pair.outstanding):
+            imageId = server.spool.wants(method, path, headers)
+            if imageId:
+                return self.do_spool(request, imageId, headers)
+
+        upstream = self.pair or self._connect()
+        if upstream:
+            upstream.request_times.append(time.time())
+            upstream.outstanding += 1
+            if headers.get('connection', '').lower() == 'close':
+                upstream.keep_alive = False
             upstream.send(request)
-            self._connect(upstream)
 
         self.start_copy(headers)
+        if self.state != STATE_HEADER and _has_body(headers):
+            # A request without a body would otherwise hold a share of the
+            # cap for as long as its connection stays open.
+            server.uplink.register(self, UPLINK_WEIGHTS.get(rule, 1))
+
+    def do_spool(self, request, imageId, headers):
+        """Write a request to the upload spool, to be forwarded later."""
+        server = self.server
+        targetUrl = server.findTarget(self.peer_address)
+        if not targetUrl:
+            return self.send_text('403 Forbidden', 'Peer not recognized\r\n')
+
+        upstream = self.pair
+        if upstream:
+            # Hand the idle upstream connection back to the pool.
+            self._pair = None
+            upstream.pair_closed()
+
+        self.spool_writer = server.spool.create(imageId, targetUrl, request)
+        self._pair = weakref.ref(self.spool_writer)
+        self.start_copy(headers)
+        self.splice_ok = False
+        self.finish_spool()
+
+    def handle_copy(self):
+        ProxyDispatcher.handle_copy(self)
+        if self.spool_writer:
+            self.finish_spool()
+
+    def finish_spool(self):
+        """Commit the spooled request and ack it once the body is in."""
+        if not (self.state == STATE_HEADER or
+                (self.state == STATE_COPY_SIZE and not self.copy_remaining)):
+            return
+        writer, self.spool_writer = self.spool_writer, None
+        self._pair = None
+        self.state = STATE_HEADER
+        writer.commit()
+        self.server.stats.countRequest('spooled')
+        self.send_text('200 OK', '')
 
-    def _connect(self, upstream):
+    def _connect(self):
         # Figure out who we're proxying to.
         peer = self.socket.getpeername()[0]
-        url = self.server.findTarget(peer)
-        if not url:
+        targetUrl = self.server.findTarget(peer)
+        if not targetUrl:
             return self.send_text('403 Forbidden', 'Peer not recognized\r\n')
 
+        # Reuse an idle connection to the same target if there is one.
+        upstream = self.server.upstreamPool.get(targetUrl)
+        if upstream:
+            log.debug("%s reusing upstream connection %s", self.name,
+                    upstream.name)
+            return self._pair_with(upstream)
+
         # Split the URL to get the hostname.
-        scheme, url = urllib.splittype(url)
-        if scheme != 'http':
+        scheme, url = urllib.splittype(targetUrl)
+        if scheme not in ('http', 'https'):
             return self.send_text('504 Gateway Timeout',
                     'Invalid target URL\r\n')
-        host, port = _split_hostport(urllib.splithost(url)[0])
-
-        # Resolve the hostname to an address.
-        try:
-            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
-        except socket.gaierror, err:
-            log.error("Error resolving target URL: %s", err)
-            addresses = []
-        if not addresses:
-            return self.send_text('504 Gateway Timeout',
-                    'Unknown target URL\r\n')
-
-        # Create the right socket type and initiate the connection (which may
-        # not complete immediately).
-        family, socktype, _, _, address = addresses[0]
-        upstream.create_socket(family, socktype)
-        upstream.connect(address)
-
+        host, port = _split_hostport(urllib.splithost(url)[0],
+                scheme == 'https' and 443 or 80)
+
+        # Resolve the hostname to an address in the background. Requests are
+        # queued on the upstream until it connects. Note that we don't need
+        # to keep a strong reference to the paired connection because the
+        # resolver and later the asyncore poll map keep one.
+        upstream = ProxyUpstream(None, self._map, self._server())
+        upstream.target_url = targetUrl
+        if scheme == 'https':
+            upstream.tls_hostname = host
+        self.server.stats.upstreams.add(upstream)
+        self._pair_with(upstream)
+        self.server.resolver.resolve(host, port, upstream.resolved)
+        return upstream
+
+    def _pair_with(self, upstream):
+        upstream._pair = weakref.ref(self)
         self._pair = weakref.ref(upstream)
+        return upstream
+
+    def send_template_status(self, status, path):
+        self.send_text('200 OK', '%s\r\n%s\r\n' % (
+            TemplateGenerator.Status.values[status], os.path.basename(path)))
+
+    def do_status(self, method):
+        """Report proxy statistics to local callers."""
+        if self.peer_address not in LOCAL_ADDRESSES:
+            return self.send_text('403 Forbidden', 'Status not available\r\n')
+        if method != 'GET':
+            return self.send_text('405 Method Not Allowed',
+                    'Unsupported method\r\n')
+        server = self.server
+        status = {
+                'proxy': server.stats.asDict(server.upstreamPool),
+                'uplink': server.uplink.asDict(),
+                }
+        if server.spool:
+            status['spool'] = server.spool.asDict()
+        if server.templateCache:
+            status['templates'] = server.templateCache.asDict()
+        if server.templateQueue:
+            status['template_queue'] = server.templateQueue.asDict()
+        if server.worker is not None:
+            # Each worker keeps its own counters, so say whose these are.
+            status['worker'] = {'index': server.worker, 'pid': os.getpid()}
+        jobmaster = server.jobmaster and server.jobmaster()
+        csCache = jobmaster and jobmaster.getChangesetCache()
+        if csCache:
+            status['changesets'] = csCache.asDict()
+        return self.send_response('200 OK',
+                ['Content-Type: application/json'],
+                json.dumps(status, indent=2, sort_keys=True) + '\n')
 
     def do_templates(self, method, path, headers):
         """Handle a request to get anaconda templates."""
@@ -553,55 +1430,298 @@ class ProxyClient(ProxyDispatcher):
             conaryCfg = jobmaster.getConaryConfig(url)
             workDir = jobmaster.cfg.getTemplateCache()
             generator = TemplateGenerator(params['templateTup'],
-                    params['kernelTup'], conaryCfg, workDir)
-
-            status, path = generator.getTemplate(start)
-            path = os.path.basename(path)
+                    params['kernelTup'], conaryCfg, workDir,
+                    incremental=jobmaster.cfg.templateIncremental,
+                    changesetCache=jobmaster.getChangesetCache(),
+                    catalog=(self.server.templateCache
+                        and self.server.templateCache.catalog))
+
+            cache = self.server.templateCache
+            if cache:
+                # Lease it before looking, so it can't be evicted between
+                # here and the slave reading it.
+                cache.hold(generator.hash, peer)
+            queue = self.server.templateQueue
+            if queue:
+                # The jobmaster's scheduler builds it when a worker is free.
+                status, path = self.server.templates.status(generator)
+                if start and (status == generator.Status.NOT_FOUND
+                        or queue.isQueued(generator.hash)):
+                    # Queue it, or move it ahead of pre-warm requests.
+                    queue.add(generator.hash, url, params['templateTup'],
+                            params['kernelTup'], Priority.JOB)
+                    status = generator.Status.IN_PROGRESS
+            else:
+                status, path = generator.getTemplate(start)
+            if cache and start:
+                cache.record(url, params['templateTup'], params['kernelTup'])
+                if status == generator.Status.DONE:
+                    cache.hit(generator.hash)
+                else:
+                    cache.miss(generator.hash)
             if generator.pid:
                 # Make sure the main event loop will reap the generator when it
                 # quits.
                 jobmaster.subprocesses.append(generator)
-            return self.send_text('200 OK', '%s\r\n%s\r\n' % (
-                generator.Status.values[status], path))
+                self.server.templates.started(generator)
+
+            # With wait=N, hold the request open for up to N seconds until
+            # the template is no longer in progress.
+            try:
+                wait = float(query.get('wait', [0])[0])
+            except ValueError:
+                wait = 0
+            if wait > 0 and status == generator.Status.IN_PROGRESS:
+                self.server.templates.wait(self, generator, wait)
+                return
+            return self.send_template_status(status, path)
 
         else:
             return self.send_text('404 Not Found', 'Unknown function\r\n')
 
 
 class ProxyUpstream(ProxyDispatcher):
+    target_url = None
+    addresses = ()
+    connect_started = None
+    keep_alive = True
+    # Set for https targets; the TLS handshake starts once TCP connects.
+    tls_hostname = None
+    handshaking = False
+    handshake_want = None
+    # Requests sent that haven't had a final response yet
+    outstanding = 0
+
+    def __init__(self, sock, _map, server, pair=None):
+        ProxyDispatcher.__init__(self, sock, _map, server, pair)
+        # Start times of requests awaiting a response
+        self.request_times = collections.deque()
+
+    def close(self):
+        server = self.server
+        if server:
+            server.stats.upstreamClosed(self)
+        if self.tls and not self.handshaking and self.socket:
+            # Say goodbye properly, without waiting for the reply.
+            try:
+                self.socket.unwrap()
+            except socket.error:
+                pass
+        ProxyDispatcher.close(self)
+
     def pair_closed(self):
+        """
+        Return the connection to the pool if it finished its last exchange
+        cleanly, otherwise close it.
+        """
+        self._pair = None
+        if self.socket is None:
+            # Still resolving; resolved() will drop it.
+            return
+        if (self.keep_alive and self.connected and not self.outstanding
+                and self.entity_complete() and not self.send_pending()):
+            server = self.server
+            if server and server.upstreamPool.put(self.target_url, self):
+                self.state = STATE_HEADER
+                self.copy_remaining = 0L
+                return
         self.close()
 
+    def resolved(self, addresses):
+        """Start connecting once the target hostname has been resolved."""
+        client = self.pair
+        if not client:
+            # Client went away while we were resolving.
+            return
+        self.addresses = list(addresses)
+        if self.connect_next():
+            return
+
+        # Nothing to connect to.
+        self.give_up('Unknown target URL')
+
+    def give_up(self, reason):
+        """Answer the client with a gateway error in place of a response."""
+        client = self.pair
+        if not client:
+            return
+        client._pair = self._pair = None
+        try:
+            client.send_text('504 Gateway Timeout', reason + '\r\n')
+            client.pair_closed()
+        except ConnectionClosed:
+            client.close()
+
+    def connect_next(self):
+        """
+        Start connecting to the next resolved address. Returns C{False} if
+        there are none left to try.
+        """
+        while self.addresses:
+            family, socktype, _, _, address = self.addresses.pop(0)
+            if self.socket:
+                self.del_channel()
+                self.socket.close()
+                self.socket = None
+            self.create_socket(family, socktype)
+            # Requests are relayed piecemeal as they arrive; don't let Nagle
+            # hold the body back until the header is acked.
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connect_started = time.time()
+            try:
+                self.connect(address)
+            except socket.error, err:
+                log.debug("Failed to connect to %s: %s", address[0], err)
+                continue
+            return True
+        return False
+
     def handle_connect(self):
+        if self.connect_started:
+            server = self.server
+            if server:
+                server.stats.connectTime.add(
+                        time.time() - self.connect_started)
+            self.connect_started = None
         if not self.pair:
             raise ConnectionClosed
+        self.addresses = []
+        if self.tls_hostname:
+            server = self.server
+            self.del_channel()
+            self.set_socket(server.tlsContext.wrap_socket(self.socket,
+                server_hostname=self.tls_hostname,
+                do_handshake_on_connect=False), self._map)
+            self.tls = self.handshaking = True
+            self.connect_started = time.time()
+            self._do_handshake()
+        else:
+            self._do_send()
+
+    def _do_handshake(self):
+        """Advance the TLS handshake as far as it goes without blocking."""
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.handshake_want = 'read'
+                return
+            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.handshake_want = 'write'
+                return
+            log.error("TLS handshake with %s failed: %s", self.target_url,
+                    err)
+            self.give_up('TLS handshake failed')
+            raise ConnectionClosed
+        except socket.error, err:
+            log.debug("TLS handshake with %s failed: %s", self.target_url,
+                    err)
+            self.give_up('TLS handshake failed')
+            raise ConnectionClosed
+        self.handshaking = False
+        self.handshake_want = None
+        server = self.server
+        if server:
+            server.stats.tlsHandshakeTime.add(
+                    time.time() - self.connect_started)
+        self.connect_started = None
         self._do_send()
 
+    def _do_send(self):
+        if self.handshaking:
+            return
+        ProxyDispatcher._do_send(self)
+
+    def readable(self):
+        if self.handshaking:
+            return self.handshake_want == 'read'
+        return ProxyDispatcher.readable(self)
+
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_want == 'write'
+        return ProxyDispatcher.writable(self)
+
+    def handle_write(self):
+        if self.handshaking:
+            return self._do_handshake()
+        ProxyDispatcher.handle_write(self)
+
+    def handle_error(self):
+        if not self.connected and self.pair:
+            # The connection attempt failed; try the next address.
+            log.debug("Failed to connect to %s: %s", self.name,
+                    sys.exc_info()[1])
+            self._remote = None
+            if self.connect_next():
+                return
+            self.give_up('Could not connect to target')
+            self.close()
+            return
+        ProxyDispatcher.handle_error(self)
+
     def handle_read(self):
+        if self.handshaking:
+            return self._do_handshake()
         if not self.pair:
+            if self.tls:
+                # Idle in the pool. TLS can have records to process that
+                # carry no data, like session tickets; only data or EOF
+                # means the connection is finished.
+                try:
+                    self.socket.recv(1)
+                except socket.error, err:
+                    if _would_block(err):
+                        return
             raise ConnectionClosed
         ProxyDispatcher.handle_read(self)
+        # Records already decrypted by the TLS layer won't wake up the poll
+        # loop, so read them now.
+        while self.tls and self.socket and self.socket.pending():
+            ProxyDispatcher.handle_read(self)
 
     def handle_header(self, response):
         responseline, headers = self._parse_header(response)
-        code = responseline.split(' ', 2)[1]
+        version, code = responseline.split(' ', 2)[:2]
         code = int(code)
         if 100 <= code < 200:
             # 1xx codes don't have an entity.
             pass
         else:
+            self.outstanding -= 1
+            if self.request_times:
+                server = self.server
+                if server:
+                    server.stats.firstByteTime.add(
+                            time.time() - self.request_times.popleft())
+            if (version != 'HTTP/1.1'
+                    or headers.get('connection', '').lower() == 'close'):
+                self.keep_alive = False
             self.start_copy(headers)
+            if self.state == STATE_COPY_ALL:
+                # Entity is delimited by the connection closing.
+                self.keep_alive = False
         self.pair.send(response)
 
 
-def _split_hostport(host):
+def _has_body(headers):
+    """Return C{True} if a request with C{headers} carries a body."""
+    if 'transfer-encoding' in headers:
+        return True
+    try:
+        return long(headers.get('content-length', 0)) > 0
+    except ValueError:
+        return False
+
+
+def _split_hostport(host, defaultPort=80):
     i = host.rfind(':')
     j = host.rfind(']')
     if i > j:
         port = int(host[i+1:])
         host = host[:i]
     else:
-        port = 80
+        port = defaultPort
     if host and host[0] == '[' and host[-1] == ']':
         host = host[1:-1]
     return host, port
@@ -0,0 +1,130 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Live statistics for the jobmaster proxy.
+
+Dispatchers only bump plain integer attributes in their send and receive
+paths; the per-slave totals are summed up from the live connections when a
+report is requested, and folded into a per-address tally when a connection
+closes.
+"""
+
+import bisect
+import time
+import weakref
+
+
+class Histogram(object):
+    """Counts of observed durations in fixed buckets, in seconds."""
+    bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+            1, 2, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def asDict(self):
+        buckets = [[bound, count]
+                for (bound, count) in zip(self.bounds, self.counts)]
+        buckets.append(['inf', self.counts[-1]])
+        return {
+                'count': self.count,
+                'sum': round(self.total, 6),
+                'buckets': buckets,
+                }
+
+
+class ProxyStats(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.clients = weakref.WeakSet()
+        self.upstreams = weakref.WeakSet()
+        # address -> [bytes from slave, bytes to slave] of closed connections
+        self.closedBytes = {}
+        self.jobs = {}
+        self.requests = {}
+        self.connectTime = Histogram()
+        self.firstByteTime = Histogram()
+        self.tlsHandshakeTime = Histogram()
+
+    def countRequest(self, kind):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def setJob(self, address, jobId):
+        if jobId:
+            self.jobs[address] = jobId
+
+    def forget(self, address):
+        """Drop totals for a slave address that is no longer in use."""
+        self.jobs.pop(address, None)
+        self.closedBytes.pop(address, None)
+
+    def clientClosed(self, client):
+        self.clients.discard(client)
+        address = client.peer_address
+        if not address:
+            return
+        totals = self.closedBytes.setdefault(address, [0, 0])
+        totals[0] += client.bytes_received
+        totals[1] += client.bytes_sent
+
+    def upstreamClosed(self, upstream):
+        self.upstreams.discard(upstream)
+
+    def asDict(self, upstreamPool=None):
+        slaves = {}
+        for address, (received, sent) in self.closedBytes.iteritems():
+            slaves[address] = [received, sent]
+        for client in list(self.clients):
+            address = client.peer_address
+            if not address:
+                continue
+            totals = slaves.setdefault(address, [0, 0])
+            totals[0] += client.bytes_received
+            totals[1] += client.bytes_sent
+
+        ret = {
+                'uptime': round(time.time() - self.started, 3),
+                'connections': {
+                    'client': len(self.clients),
+                    'upstream': len(self.upstreams),
+                    },
+                'slaves': dict((address, {
+                    'job': self.jobs.get(address),
+                    'bytes_from_slave': received,
+                    'bytes_to_slave': sent,
+                    }) for (address, (received, sent)) in slaves.iteritems()),
+                'requests': dict(self.requests),
+                'upstream_connect_time': self.connectTime.asDict(),
+                'time_to_first_byte': self.firstByteTime.asDict(),
+                'tls_handshake_time': self.tlsHandshakeTime.asDict(),
+                }
+        if upstreamPool is not None:
+            ret['upstream_pool'] = {
+                    'idle': len(upstreamPool),
+                    'hits': upstreamPool.hits,
+                    'misses': upstreamPool.misses,
+                    }
+        return ret
@@ -0,0 +1,257 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Runs the jobmaster proxy in several worker processes.
+
+Each worker binds its own listening socket to the proxy port with
+C{SO_REUSEPORT}, so the kernel spreads incoming slave connections between
+them, and serves them from an epoll loop that is independent of the message
+bus. The jobmaster process keeps the authoritative target map and streams
+every change to the workers over a pipe, one line per change.
+"""
+
+import asyncore
+import errno
+import logging
+import os
+import select
+import weakref
+from jobmaster.proxy import ProxyServer, TargetMap
+from jobmaster.subprocutil import Pipe, Subprocess
+
+log = logging.getLogger(__name__)
+
+
+class EpollMap(object):
+    """
+    Poll an asyncore socket map with epoll. Registrations persist between
+    calls to L{poll}, so only dispatchers whose interest changed cost a system
+    call.
+    """
+
+    def __init__(self, _map):
+        self.map = _map
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def _update(self):
+        for fd, obj in self.map.items():
+            flags = 0
+            if obj.readable():
+                flags |= select.EPOLLIN | select.EPOLLPRI
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                flags |= select.EPOLLOUT
+            old = self.registered.get(fd)
+            if old and old[0] is obj and old[1] == flags:
+                continue
+            if old:
+                self._unregister(fd)
+            if flags:
+                self.epoll.register(fd, flags)
+                self.registered[fd] = (obj, flags)
+        for fd in set(self.registered) - set(self.map):
+            self._unregister(fd)
+
+    def _unregister(self, fd):
+        del self.registered[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError), err:
+            # Closed descriptors drop out of the epoll set by themselves.
+            if err.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def poll(self, timeout=-1):
+        self._update()
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, err:
+            if err.errno == errno.EINTR:
+                return
+            raise
+        for fd, flags in events:
+            obj = self.map.get(fd)
+            if obj is None:
+                continue
+            # epoll and poll event bits are the same, so asyncore can
+            # dispatch them.
+            asyncore.readwrite(obj, flags)
+
+    def close(self):
+        self.epoll.close()
+
+
+class TargetFeed(asyncore.file_dispatcher):
+    """Applies target map changes sent by the jobmaster to a worker."""
+
+    def __init__(self, fObj, _map, server):
+        asyncore.file_dispatcher.__init__(self, fObj, _map)
+        self.server = server
+        self.buffer = ''
+        self.eof = False
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data:
+            return
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            words = line.split('\t')
+            if words[0] == 'add':
+                self.server.addTarget(words[1], words[2], words[3] or None)
+            elif words[0] == 'remove':
+                self.server.removeTarget(words[1])
+            else:
+                log.error("Unknown target map update %r", line)
+
+    def handle_close(self):
+        # The jobmaster went away.
+        self.eof = True
+        self.close()
+
+
+class ProxyWorker(Subprocess):
+    procName = 'proxy worker'
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.pipe = None
+
+    def start(self):
+        if self.pipe:
+            self.pipe.close()
+        self.pipe = Pipe()
+        Subprocess.start(self)
+        self.pipe.closeReader()
+        # Otherwise jobs and other workers hold it open, and the worker
+        # would outlive the jobmaster.
+        self.pipe.keepWriter()
+
+    def send(self, line):
+        if not self.pipe or self.pipe.writer.closed:
+            return
+        try:
+            self.pipe.write(line + '\n')
+            self.pipe.writer.flush()
+        except IOError, err:
+            if err.errno != errno.EPIPE:
+                raise
+            # The worker died; it gets a fresh copy of the map on restart.
+            self.pipe.closeWriter()
+
+    def run(self):
+        self.pipe.closeWriter()
+        self._close_fds((self.pipe.reader,))
+        pool = self.pool
+        jobmaster = pool.jobmaster()
+        cfg = jobmaster.cfg
+
+        _map = {}
+        server = ProxyServer(pool.port, _map, jobmaster,
+                poolSize=cfg.proxyPoolSize,
+                poolTimeout=cfg.proxyPoolTimeout,
+                resolverTtl=cfg.proxyResolverTtl,
+                backlog=cfg.proxyBacklog,
+                reusePort=True,
+                targets=pool.targets.copy(),
+                jobs=dict(pool.jobs),
+                worker=self.index,
+                allowPaths=cfg.proxyAllowPath,
+                # The cap is for the whole jobmaster, so split it evenly.
+                uplinkLimit=cfg.proxyUplinkLimit * 1024 / len(pool.workers),
+                spoolDir=(cfg.proxySpoolUploads and cfg.getUploadSpool()
+                    or None),
+                tlsCaFile=cfg.proxyTlsCaFile,
+                tlsVerify=cfg.proxyTlsVerify,
+                templateDir=cfg.getTemplateCache(),
+                templateBudget=cfg.templateCacheLimit * 1048576,
+                templateQueue=cfg.getTemplateQueue(),
+                )
+        feed = TargetFeed(self.pipe.reader, _map, server)
+        self.pipe.closeReader()
+        poller = EpollMap(_map)
+        log.info("Proxy worker %d started with pid %d", self.index,
+                os.getpid())
+
+        # Subprocesses from before the fork belong to the jobmaster.
+        del jobmaster.subprocesses[:]
+        while not feed.eof:
+            poller.poll(1.0)
+            server.check()
+            for proc in jobmaster.subprocesses[:]:
+                if not proc.check():
+                    jobmaster.subprocesses.remove(proc)
+        return 0
+
+
+class ProxyWorkerPool(object):
+    """
+    Stands in for L{ProxyServer} in the jobmaster process when the proxy runs
+    in worker processes.
+    """
+
+    def __init__(self, jobmaster, count, port):
+        self.jobmaster = weakref.ref(jobmaster)
+        self.port = port
+        self.targets = TargetMap()
+        # Job of each slave address, for workers started later.
+        self.jobs = {}
+        self.workers = [ProxyWorker(self, x) for x in range(count)]
+
+    def check(self):
+        """Start workers that aren't running yet or have died."""
+        for worker in self.workers:
+            if worker.check():
+                continue
+            if worker.exitPid:
+                log.error("Proxy worker %d exited with status %s; restarting",
+                        worker.index, worker.exitStatus)
+            worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.kill()
+            if worker.pipe:
+                worker.pipe.close()
+                worker.pipe = None
+
+    def _broadcast(self, *words):
+        line = '\t'.join(words)
+        for worker in self.workers:
+            worker.send(line)
+
+    def addTarget(self, address, targetUrl, jobId=None):
+        address = self.targets.add(address, targetUrl)
+        if jobId:
+            self.jobs[address] = jobId
+        self._broadcast('add', address, targetUrl, jobId or '')
+
+    def removeTarget(self, address):
+        address = self.targets.remove(address)
+        if not self.targets.find(address):
+            self.jobs.pop(address, None)
+        self._broadcast('remove', address)
+
+    def findTarget(self, address):
+        return self.targets.find(address)
@@ -0,0 +1,143 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Hostname resolution for the asyncore loop.
+
+C{getaddrinfo} blocks, so lookups are run by a small pool of worker threads.
+Each worker hands its answer back through a queue and pokes a pipe that is
+watched by the asyncore loop, which then runs the callbacks in the loop's own
+thread. Answers are cached per host and port for a fixed time. Cached
+answers are also delivered from the loop rather than straight away, because
+the caller is usually still setting up the request that needs the address.
+"""
+
+import asyncore
+import errno
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Resolver(asyncore.file_dispatcher):
+    workers = 4
+
+    def __init__(self, _map=None, ttl=60, negativeTtl=5):
+        readFD, self._wakeFD = os.pipe()
+        asyncore.file_dispatcher.__init__(self, readFD, _map)
+        # file_dispatcher keeps a dup of the descriptor.
+        os.close(readFD)
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+
+        self._cache = {}
+        self._waiting = {}
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._deferred = []
+        # Threads are started on the first lookup so that they belong to the
+        # process that serves requests, not one that daemonized afterwards.
+        self._threads = []
+
+    def resolve(self, host, port, callback):
+        """
+        Look up C{host} and call C{callback} with a (possibly empty) list of
+        C{getaddrinfo} results. The callback is always called later, from the
+        asyncore loop, even on a cache hit.
+        """
+        key = host, port
+        cached = self._cache.get(key)
+        if cached:
+            expires, addresses = cached
+            if expires > time.time():
+                self._deferred.append((callback, addresses))
+                os.write(self._wakeFD, 'x')
+                return
+            del self._cache[key]
+
+        if key in self._waiting:
+            # Already being looked up.
+            self._waiting[key].append(callback)
+            return
+        self._waiting[key] = [callback]
+
+        if not self._threads:
+            for x in range(self.workers):
+                thread = threading.Thread(target=self._worker,
+                        name='resolver-%d' % x)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        self._requests.put(key)
+
+    def _worker(self):
+        while True:
+            host, port = key = self._requests.get()
+            try:
+                addresses = socket.getaddrinfo(host, port, 0,
+                        socket.SOCK_STREAM)
+            except socket.gaierror, err:
+                log.error("Error resolving %s: %s", host, err)
+                addresses = []
+            except:
+                log.exception("Unhandled error resolving %s:", host)
+                addresses = []
+            self._results.put((key, addresses))
+            os.write(self._wakeFD, 'x')
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            os.read(self._fileno, 4096)
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+        while True:
+            try:
+                key, addresses = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            ttl = addresses and self.ttl or self.negativeTtl
+            self._cache[key] = (time.time() + ttl, addresses)
+            for callback in self._waiting.pop(key, ()):
+                self._call(callback, addresses)
+        deferred, self._deferred = self._deferred, []
+        for callback, addresses in deferred:
+            self._call(callback, addresses)
+
+    def _call(self, callback, addresses):
+        try:
+            callback(addresses)
+        except:
+            log.exception("Unhandled error in resolver callback:")
+
+    def handle_error(self):
+        log.exception("Unhandled error in resolver:")
+
+    def handle_close(self):
+        # Only the write end could close the pipe, and we never do that.
+        pass
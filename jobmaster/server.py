@@ -34,12 +34,17 @@ from rmake.lib import procutil
 from jobmaster import config
 from jobmaster import jobhandler
 from jobmaster import util
+from jobmaster.changesetcache import ChangesetCache
 from jobmaster.networking import AddressGenerator
+from jobmaster.prewarm import TemplatePrewarmer
 from jobmaster.proxy import ProxyServer
+from jobmaster.proxyworker import ProxyWorkerPool
 from jobmaster.resources.devfs import LoopManager
 from jobmaster.resources.block import get_scratch_lvs
 from jobmaster.response import ResponseProxy
 from jobmaster.subprocutil import setDebugHook
+from jobmaster.templatecache import TemplateCache
+from jobmaster.templatequeue import TemplateScheduler
 
 # Register image job message type with rMake
 from mcp import image_job
@@ -66,6 +71,7 @@ class JobMaster(bus_node.BusNode):
         self.subprocesses = []
         self._cfgCache = {}
         self._map = self.bus.session._map
+        self.changesetCache = None
 
     def getConaryConfig(self, rbuilderUrl, cache=True):
         if cache and rbuilderUrl in self._cfgCache:
@@ -86,8 +92,42 @@ class JobMaster(bus_node.BusNode):
         self.addressGenerator = AddressGenerator(self.cfg.pairSubnet)
         self.loopManager = LoopManager(
                 os.path.join(self.cfg.basePath, 'locks/loop'))
-        self.proxyServer = ProxyServer(self.cfg.masterProxyPort, self._map,
-                self)
+        if self.cfg.changesetCacheLimit:
+            self.changesetCache = ChangesetCache(self.cfg.getChangesetCache(),
+                    self.cfg.changesetCacheLimit * 1048576)
+        if self.cfg.proxyWorkers:
+            # Workers are started from the main loop, after daemonizing.
+            self.proxyServer = ProxyWorkerPool(self, self.cfg.proxyWorkers,
+                    self.cfg.masterProxyPort)
+        else:
+            self.proxyServer = ProxyServer(self.cfg.masterProxyPort,
+                    self._map, self, poolSize=self.cfg.proxyPoolSize,
+                    poolTimeout=self.cfg.proxyPoolTimeout,
+                    resolverTtl=self.cfg.proxyResolverTtl,
+                    backlog=self.cfg.proxyBacklog,
+                    allowPaths=self.cfg.proxyAllowPath,
+                    uplinkLimit=self.cfg.proxyUplinkLimit * 1024,
+                    spoolDir=(self.cfg.proxySpoolUploads
+                        and self.cfg.getUploadSpool() or None),
+                    tlsCaFile=self.cfg.proxyTlsCaFile,
+                    tlsVerify=self.cfg.proxyTlsVerify,
+                    templateDir=self.cfg.getTemplateCache(),
+                    templateBudget=self.cfg.templateCacheLimit * 1048576,
+                    templateQueue=self.cfg.getTemplateQueue())
+        # No containers are running yet, so no template is in use or waited
+        # for.
+        self.getTemplateCache().clearLeases()
+        self.templateScheduler = TemplateScheduler(self,
+                self.cfg.templateWorkers)
+        self.templateScheduler.queue.clear()
+        self.prewarmer = TemplatePrewarmer(self, self.cfg.templatePrewarmJobs)
+
+    def getTemplateCache(self):
+        return TemplateCache(self.cfg.getTemplateCache(),
+                self.cfg.templateCacheLimit * 1048576)
+
+    def getChangesetCache(self):
+        return self.changesetCache
 
     def run(self):
         log.info("Started with pid %d.", os.getpid())
@@ -96,6 +136,8 @@ class JobMaster(bus_node.BusNode):
             self.serve_forever()
         finally:
             self.killHandlers()
+            self.prewarmer.close()
+            self.proxyServer.close()
 
     def killHandlers(self):
         handlers, self.handlers = self.handlers, {}
@@ -126,7 +168,8 @@ class JobMaster(bus_node.BusNode):
         job = msg.payload.job
         try:
             handler = jobhandler.JobHandler(self, job)
-            self.proxyServer.addTarget(handler.network.slaveAddr, job.rbuilder_url)
+            self.proxyServer.addTarget(handler.network.slaveAddr,
+                    job.rbuilder_url, job.uuid)
             handler.start()
             self.handlers[job.uuid] = handler
         except:
@@ -166,6 +209,9 @@ class JobMaster(bus_node.BusNode):
         for proc in self.subprocesses[:]:
             if not proc.check():
                 self.subprocesses.remove(proc)
+        self.proxyServer.check()
+        self.templateScheduler.check()
+        self.prewarmer.check()
 
     def handlerStopped(self, handler):
         """
@@ -238,6 +284,18 @@ class JobMaster(bus_node.BusNode):
             log.info("Deleting old contents root %s", name)
             rmtree(path)
 
+    def clean_templates(self):
+        # Normally done by the proxy as it runs; this catches up after a
+        # config change and applies the age limit while the jobmaster is down.
+        cache = self.getTemplateCache()
+        removed = cache.evict()
+        log.info("Evicted %d templates; %d left using %s bytes", removed,
+                cache.count or 0, cache.size or 0)
+        added, dropped = cache.catalog.rebuild()
+        if added or dropped:
+            log.info("Added %d templates to the catalog and dropped %d",
+                    added, dropped)
+
 
 def main(args):
     parser = optparse.OptionParser()
@@ -247,12 +305,14 @@ def main(args):
             help='Clean up stray mount points and logical volumes')
     parser.add_option('--clean-roots', action='store_true',
             help='Clean up old jobslave roots')
+    parser.add_option('--clean-templates', action='store_true',
+            help='Evict unused anaconda templates beyond the cache limit')
     options, args = parser.parse_args(args)
 
     cfg = config.MasterConfig()
     cfg.read(options.config_file)
 
-    if options.clean_mounts or options.clean_roots:
+    if options.clean_mounts or options.clean_roots or options.clean_templates:
         options.no_daemon = True
 
     level = cfg.getLogLevel()
@@ -264,6 +324,8 @@ def main(args):
         return master.clean_mounts()
     elif options.clean_roots:
         return master.clean_roots()
+    elif options.clean_templates:
+        return master.clean_templates()
     elif options.no_daemon:
         master.pre_start()
         master.run()
@@ -21,7 +21,9 @@ import fcntl
 import logging
 import os
 import random
+import select
 import signal
+import threading
 import time
 from jobmaster.util import close_fds
 
@@ -37,15 +39,29 @@ class LockTimeoutError(LockError):
 
 
 class Lockable(object):
+    """
+    A flock on C{_lockPath}.
+
+    L{_lockWait} has a helper thread sleep in a blocking flock, so a waiter
+    gets the lock as soon as it is released, while the caller can still give
+    up at the deadline or check C{breakIf} every C{_breakInterval} seconds.
+    Changing a lock that is already held can't be handed off like that, so
+    it falls back to polling.
+    """
     _lockFile = None
     _lockLevel = fcntl.LOCK_UN
     _lockPath = None
+    # Seconds between calls to breakIf while waiting
+    _breakInterval = 1.0
 
     @staticmethod
     def _sleep():
         time.sleep(random.uniform(0.1, 0.5))
 
     def _lock(self, mode=fcntl.LOCK_SH):
+        return self._flock(mode, fcntl.LOCK_NB)
+
+    def _flock(self, mode, flags):
         assert self._lockPath
 
         # Short-circuit if we already have the lock
@@ -59,10 +75,11 @@ class Lockable(object):
 
         try:
             try:
-                fcntl.flock(self._lockFile.fileno(), mode | fcntl.LOCK_NB)
+                fcntl.flock(self._lockFile.fileno(), mode | flags)
             except IOError, err:
-                if err.errno in (errno.EACCES, errno.EAGAIN):
-                    # Already locked, retry later.
+                if err.errno in (errno.EACCES, errno.EAGAIN, errno.EINTR):
+                    # Already locked, or the wait was interrupted; retry
+                    # later.
                     raise LockError('Could not acquire lock')
                 raise
             else:
@@ -82,26 +99,52 @@ class Lockable(object):
         return True
 
     def _lockWait(self, mode=fcntl.LOCK_SH, timeout=600.0, breakIf=None):
-        logged = False
-        runUntil = time.time() + timeout
-        while True:
-            # First, try to lock.
-            try:
-                return self._lock(mode)
-            except LockError:
-                pass
-
-            if breakIf and breakIf():
-                return False
+        # First, try to lock.
+        try:
+            return self._lock(mode)
+        except LockError:
+            pass
 
-            if time.time() > runUntil:
-                raise LockTimeoutError('Timed out waiting for lock')
+        runUntil = time.time() + timeout
+        if timeout > 0 and self._lockLevel == fcntl.LOCK_UN:
+            waiter = _LockWaiter(self._lockPath, mode)
+        else:
+            # Converting our own lock has to happen on our own file.
+            waiter = None
+        logged = False
+        try:
+            while True:
+                if breakIf and breakIf():
+                    return False
 
-            if not logged:
-                logged = True
-                log.debug("Waiting for lock")
+                now = time.time()
+                if now >= runUntil:
+                    raise LockTimeoutError('Timed out waiting for lock')
+
+                if not logged:
+                    logged = True
+                    log.debug("Waiting for lock")
+
+                if waiter:
+                    interval = runUntil - now
+                    if breakIf:
+                        interval = min(interval, self._breakInterval)
+                    lockFile = waiter.wait(interval)
+                    if lockFile:
+                        self._close()
+                        self._lockFile = lockFile
+                        self._lockLevel = mode
+                        return True
+                    continue
 
-            self._sleep()
+                self._sleep()
+                try:
+                    return self._lock(mode)
+                except LockError:
+                    pass
+        finally:
+            if waiter:
+                waiter.close()
 
     def _deleteLock(self):
         self._lock(fcntl.LOCK_EX)
@@ -115,16 +158,101 @@ class Lockable(object):
         self._lockLevel = fcntl.LOCK_UN
 
 
+class _LockWaiter(object):
+    """
+    Takes a flock in a helper thread, on a file of its own, so that whoever
+    wants the lock can wait for it with a timeout. If they give up, the
+    thread drops the lock as soon as it gets it.
+    """
+
+    def __init__(self, path, mode):
+        self.lockFile = open(path, 'w')
+        self.error = None
+        self.done = self.closed = False
+        self._guard = threading.Lock()
+        self._wakeRead, self._wakeWrite = os.pipe()
+        thread = threading.Thread(target=self._run, args=(mode,),
+                name='lock-wait')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self, mode):
+        while True:
+            try:
+                fcntl.flock(self.lockFile.fileno(), mode)
+            except IOError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                self.error = err
+            break
+        self._guard.acquire()
+        try:
+            self.done = True
+            if self.closed:
+                self.lockFile.close()
+            else:
+                os.write(self._wakeWrite, 'x')
+            os.close(self._wakeWrite)
+        finally:
+            self._guard.release()
+
+    def wait(self, timeout):
+        """
+        Return the locked file, or C{None} if the lock wasn't granted within
+        C{timeout} seconds.
+        """
+        try:
+            select.select([self._wakeRead], [], [], timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+        self._guard.acquire()
+        try:
+            if not self.done:
+                return None
+            if self.error:
+                raise self.error
+            lockFile, self.lockFile = self.lockFile, None
+            return lockFile
+        finally:
+            self._guard.release()
+
+    def close(self):
+        self._guard.acquire()
+        try:
+            self.closed = True
+            if self.done and self.lockFile:
+                self.lockFile.close()
+            os.close(self._wakeRead)
+        finally:
+            self._guard.release()
+
+
+# Pipe ends that children of this process must not inherit.
+_privateFiles = set()
+
+
 class Pipe(object):
     def __init__(self):
         readFD, writeFD = os.pipe()
         self.reader = os.fdopen(readFD, 'rb')
         self.writer = os.fdopen(writeFD, 'wb')
 
+    def keepWriter(self):
+        """
+        Keep the write end out of other children, so that the reader sees EOF
+        as soon as this process exits.
+        """
+        fd = self.writer.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        _privateFiles.add(self.writer)
+
     def closeReader(self):
         self.reader.close()
 
     def closeWriter(self):
+        _privateFiles.discard(self.writer)
         self.writer.close()
 
     def close(self):
@@ -166,6 +294,9 @@ class Subprocess(object):
             #pylint: disable-msg=W0702,W0212
             try:
                 try:
+                    for fObj in list(_privateFiles):
+                        fObj.close()
+                    _privateFiles.clear()
                     if self.setsid:
                         os.setsid()
                     if self.closefds:
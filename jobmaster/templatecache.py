@@ -0,0 +1,564 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Size-budgeted eviction for the anaconda template cache.
+
+Each template is a C{<hash>.tar} file plus its C{.metadata} (and the C{.log}
+of a kernel script, if there was one). Its last use is the access time of the
+tarball, which is set explicitly whenever the proxy hands the template out so
+that it doesn't depend on the filesystem's atime mount options. When the cache
+grows past its budget the least recently used templates are removed first.
+
+A template is never removed while:
+ - someone holds the flock on its C{<hash>.lock} file, which the template
+   generator does for as long as it builds; or
+ - a slave that asked for it is still running. The template directory is
+   bind-mounted into every container, so the proxy records a lease under
+   C{in-use/} for each slave address that requests a template and drops the
+   slave's leases when its job ends.
+
+To close the race with a slave asking for a template just as it is picked for
+eviction, the evictor first renames the tarball aside and only then checks
+for leases, while the proxy creates the lease before looking for the tarball.
+Either the proxy finds no tarball, or the evictor sees the lease and puts the
+tarball back.
+
+Each eviction pass also removes what failed builds leave behind: the
+C{tempdir-<hash>-*} work directory of a generator that was killed, and the
+C{<hash>.lock} of a build that never produced a tarball. Both are only
+removed once they are C{staleAge} old and nobody holds the template's lock.
+
+The cache also keeps a history of which templates were requested, one JSON
+line per request, which L{jobmaster.prewarm} uses to build templates before
+they are needed.
+
+Installed kernel trees live under C{kernels/}, see L{KernelCache}. They
+count against the same budget and are evicted by the same LRU pass as the
+templates.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+from conary.lib import util
+from jobmaster.subprocutil import Lockable, LockError
+from jobmaster.templatecatalog import TemplateCatalog
+from jobmaster.util import freezeTroveTup, specHash
+
+log = logging.getLogger(__name__)
+
+
+class FileLock(Lockable):
+
+    def __init__(self, path):
+        self._lockPath = path
+
+
+class CachedTemplate(object):
+    __slots__ = ('hash', 'size', 'atime', 'kind')
+
+    def __init__(self, hash, size, atime, kind='template'):
+        self.hash = hash
+        self.size = size
+        self.atime = atime
+        self.kind = kind
+
+
+class KernelCache(object):
+    """
+    Installed kernel trees in C{path}, so that templates built with the same
+    kernel don't each install it again.
+
+    Each tree is C{<hash>/}, named for the C{specHash} of the kernel trove
+    tuple, plus C{<hash>.info} with its size; the access time of the info
+    file is the tree's last use. Trees are read-only once stored: they are
+    copied out with reflinks or hard links, so nothing may change them in
+    place. A tree is stored under an exclusive flock on C{<hash>.lock} into
+    C{<hash>.partial} and renamed into place; it is copied out under a
+    shared lock, and eviction only takes trees whose lock it can take
+    exclusively without waiting.
+    """
+    # Seconds to wait for someone else to finish storing a tree
+    timeout = 600
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, hash, suffix=''):
+        return os.path.join(self.path, hash + suffix)
+
+    def get(self, kernelTup, dest, copier):
+        """
+        Copy the cached tree for C{kernelTup} into C{dest} with C{copier},
+        a L{jobmaster.util.FileCopier}. Returns C{False} if it isn't cached.
+        """
+        hash = specHash([kernelTup])
+        if not os.path.isdir(self._path(hash)):
+            return False
+        lock = FileLock(self._path(hash, '.lock'))
+        try:
+            lock._lockWait(fcntl.LOCK_SH, timeout=self.timeout)
+            info = self._path(hash, '.info')
+            try:
+                os.utime(info, (time.time(), os.stat(info).st_mtime))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                # Evicted while we waited.
+                return False
+            copier.copyTree(self._path(hash), dest, symlinks=True,
+                    readOnly=True)
+            return True
+        finally:
+            lock._close()
+
+    def put(self, kernelTup, source, copier):
+        """Store the installed kernel tree in C{source} for later builds."""
+        hash = specHash([kernelTup])
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        lock = FileLock(self._path(hash, '.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            # Someone else is storing or using it.
+            return
+        try:
+            if os.path.isdir(self._path(hash)):
+                return
+            partial = self._path(hash, '.partial')
+            if os.path.exists(partial):
+                util.rmtree(partial)
+            os.mkdir(partial)
+            copier.copyTree(source, partial, symlinks=True)
+            size = 0
+            for dirPath, dirNames, fileNames in os.walk(partial):
+                for name in fileNames + dirNames:
+                    size += os.lstat(os.path.join(dirPath, name)).st_size
+            json.dump({'size': size, 'kernel': '%s=%s[%s]' % kernelTup},
+                    open(self._path(hash, '.info'), 'w'))
+            os.rename(partial, self._path(hash))
+        finally:
+            lock._close()
+
+    def scan(self):
+        """Return the stored trees as L{CachedTemplate} objects."""
+        try:
+            names = os.listdir(self.path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        trees = []
+        for name in names:
+            if name.endswith('.partial') or name.endswith('.evicting'):
+                # Left behind by a process that died.
+                self._removeStale(name.rsplit('.', 1)[0], name)
+                continue
+            if not name.endswith('.info'):
+                continue
+            hash = name[:-5]
+            path = self._path(hash, '.info')
+            try:
+                size = json.load(open(path))['size']
+                atime = os.stat(path).st_atime
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            if os.path.isdir(self._path(hash)):
+                trees.append(CachedTemplate(hash, size, atime, 'kernel'))
+        return trees
+
+    def _removeStale(self, hash, name):
+        lock = FileLock(self._path(hash, '.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            return
+        try:
+            util.rmtree(self._path(name))
+        finally:
+            lock._close()
+
+    def remove(self, tree):
+        hash = tree.hash
+        lock = FileLock(self._path(hash, '.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            # Being stored or copied out.
+            return False
+        try:
+            path = self._path(hash, '.info')
+            try:
+                if os.stat(path).st_atime != tree.atime:
+                    # Used since the scan.
+                    return False
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                return False
+            os.rename(self._path(hash), self._path(hash, '.evicting'))
+            _unlink(path)
+            util.rmtree(self._path(hash, '.evicting'))
+            lock._deleteLock()
+            return True
+        finally:
+            lock._close()
+
+
+class TemplateCache(object):
+    """
+    Tracks the templates in C{path} and evicts the least recently used ones
+    to keep their total size under C{budget} bytes (0 for no limit).
+    """
+    # Seconds between eviction passes from check()
+    interval = 60
+    # Seconds between writing the hits counted by hit() to the catalog
+    hitInterval = 10
+    # Templates unused for this long are removed even when under budget.
+    maxAge = 90 * 86400
+    # Seconds before the leftovers of a failed build are removed
+    staleAge = 86400
+    # Files that belong to a template, besides the tarball itself
+    extraSuffixes = ('.tar.metadata', '.log')
+    # Requests made for templates, see record()
+    historyName = 'requests.log'
+
+    def __init__(self, path, budget=0, catalogTimeout=None):
+        self.path = path
+        self.budget = budget
+        self.leaseDir = os.path.join(path, 'in-use')
+        self.catalog = TemplateCatalog(path, catalogTimeout)
+        # Hits not written to the catalog yet, as hash: (count, last use)
+        self.pendingHits = {}
+        self.lastHitFlush = time.time()
+        self.kernels = KernelCache(os.path.join(path, 'kernels'))
+        self.hits = self.misses = 0
+        self.evictions = self.evictedBytes = 0
+        self.size = self.count = self.kernelCount = None
+        self.lastCheck = 0
+
+    def _path(self, hash, suffix):
+        return os.path.join(self.path, hash + suffix)
+
+    def hit(self, hash):
+        """
+        Count a request for a template that was ready, and touch it. The
+        catalog is updated later, by L{flushHits}.
+        """
+        self.hits += 1
+        count, _ = self.pendingHits.get(hash, (0, 0))
+        self.pendingHits[hash] = (count + 1, time.time())
+        path = self._path(hash, '.tar')
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def miss(self, hash):
+        """Count a request for a template that had to be built."""
+        self.misses += 1
+
+    def hold(self, hash, owner):
+        """Keep C{hash} from being evicted until C{owner} is released."""
+        if not os.path.isdir(self.leaseDir):
+            os.makedirs(self.leaseDir)
+        path = os.path.join(self.leaseDir, '%s.%s' % (hash, owner))
+        if not os.path.exists(path):
+            open(path, 'w').close()
+
+    def release(self, owner):
+        """Drop all of C{owner}'s leases."""
+        suffix = '.' + owner
+        for name in self._leases():
+            if name.endswith(suffix):
+                _unlink(os.path.join(self.leaseDir, name))
+
+    def clearLeases(self):
+        """Drop all leases, e.g. at startup when no containers are running."""
+        for name in self._leases():
+            _unlink(os.path.join(self.leaseDir, name))
+
+    def _leases(self):
+        try:
+            return os.listdir(self.leaseDir)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+
+    def inUse(self):
+        return set(x.split('.', 1)[0] for x in self._leases())
+
+    def record(self, rbuilderUrl, troveTup, kernelTup):
+        """Add a request for a template to the history."""
+        entry = {
+                'time': int(time.time()),
+                'url': rbuilderUrl,
+                'template': freezeTroveTup(troveTup),
+                'kernel': kernelTup and freezeTroveTup(kernelTup) or None,
+                }
+        fObj = open(os.path.join(self.path, self.historyName), 'a')
+        try:
+            fcntl.flock(fObj.fileno(), fcntl.LOCK_EX)
+            fObj.write(json.dumps(entry) + '\n')
+        finally:
+            fObj.close()
+
+    def trimHistory(self, since):
+        """
+        Forget requests made before C{since} and return the rest, oldest
+        first.
+        """
+        path = os.path.join(self.path, self.historyName)
+        try:
+            fObj = open(path, 'r+')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        try:
+            fcntl.flock(fObj.fileno(), fcntl.LOCK_EX)
+            entries = []
+            for line in fObj:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('time', 0) >= since:
+                    entries.append(entry)
+            fObj.seek(0)
+            for entry in entries:
+                fObj.write(json.dumps(entry) + '\n')
+            fObj.truncate()
+        finally:
+            fObj.close()
+        return entries
+
+    def scan(self):
+        """Return the templates in the cache."""
+        templates = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tar.evicting'):
+                # Left behind by an evictor that died.
+                _unlink(os.path.join(self.path, name))
+                continue
+            if not name.endswith('.tar'):
+                continue
+            hash = name[:-4]
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            size = stat.st_size
+            for suffix in self.extraSuffixes:
+                try:
+                    size += os.stat(self._path(hash, suffix)).st_size
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+            templates.append(CachedTemplate(hash, size, stat.st_atime))
+        return templates
+
+    def flushHits(self):
+        """
+        Write the hits counted since the last call to the catalog. They are
+        kept for next time if the catalog is busy.
+        """
+        self.lastHitFlush = time.time()
+        hits, self.pendingHits = self.pendingHits, {}
+        if not self.catalog.addHits(hits):
+            for hash, (count, when) in hits.items():
+                newCount, newWhen = self.pendingHits.get(hash, (0, 0))
+                self.pendingHits[hash] = (count + newCount,
+                        max(when, newWhen))
+
+    def check(self):
+        """Periodic housekeeping, called from the main loop."""
+        if time.time() - self.lastHitFlush >= self.hitInterval:
+            self.flushHits()
+        if time.time() - self.lastCheck < self.interval:
+            return
+        self.lastCheck = time.time()
+        try:
+            self.evict()
+        except:
+            log.exception("Error trimming the template cache:")
+
+    def evict(self):
+        """
+        Remove the least recently used templates until the cache is within
+        its budget, plus any that haven't been used for C{maxAge} seconds.
+        Returns the number of templates removed.
+        """
+        if not os.path.isdir(self.path):
+            return 0
+        # Only one process trims the cache at a time.
+        lock = FileLock(os.path.join(self.path, '.evict.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            return 0
+        try:
+            self._removeStale()
+            templates = self.scan() + self.kernels.scan()
+            total = sum(x.size for x in templates)
+            count = len(templates)
+            cutoff = time.time() - self.maxAge
+            inUse = self.inUse()
+            removed = kernelsRemoved = 0
+            for template in sorted(templates, key=lambda x: x.atime):
+                if ((not self.budget or total <= self.budget)
+                        and template.atime >= cutoff):
+                    break
+                if template.kind == 'kernel':
+                    ok = self.kernels.remove(template)
+                elif template.hash in inUse:
+                    continue
+                else:
+                    ok = self._remove(template)
+                if ok:
+                    if template.kind == 'kernel':
+                        kernelsRemoved += 1
+                    log.info("Evicted %s %s (%d bytes)", template.kind,
+                            template.hash, template.size)
+                    total -= template.size
+                    count -= 1
+                    removed += 1
+                    self.evictions += 1
+                    self.evictedBytes += template.size
+            if self.budget and total > self.budget:
+                log.warning("Template cache is %d bytes over its budget but "
+                        "the remaining templates are in use",
+                        total - self.budget)
+            self.size, self.count = total, count
+            self.kernelCount = len([x for x in templates
+                if x.kind == 'kernel']) - kernelsRemoved
+            return removed
+        finally:
+            lock._close()
+
+    def _removeStale(self):
+        """
+        Remove work directories and lock files left by builds that died or
+        failed.
+        """
+        # Ages are taken first, because locking touches the lock file.
+        cutoff = time.time() - self.staleAge
+        stale = []
+        for name in os.listdir(self.path):
+            if name.startswith('tempdir-'):
+                # tempdir-<hash>-XXXXXX, or tempdir-XXXXXX from older
+                # versions, which only the age can tell about.
+                hash = name.split('-')[1]
+                if len(hash) != 40:
+                    hash = None
+            elif name.endswith('.lock') and not name.startswith('.'):
+                hash = name[:-5]
+            else:
+                continue
+            try:
+                if os.lstat(os.path.join(self.path, name)).st_mtime < cutoff:
+                    stale.append((name, hash))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+        for name, hash in stale:
+            isLock = name.endswith('.lock')
+            if isLock and os.path.exists(self._path(hash, '.tar')):
+                continue
+            lock = hash and FileLock(self._path(hash, '.lock'))
+            if lock:
+                try:
+                    lock._lock(fcntl.LOCK_EX)
+                except LockError:
+                    # It's being built right now.
+                    continue
+            try:
+                if not isLock:
+                    log.info("Removing %s left by a failed template build",
+                            name)
+                    util.rmtree(os.path.join(self.path, name))
+                if lock and not os.path.exists(self._path(hash, '.tar')):
+                    lock._deleteLock()
+            finally:
+                if lock:
+                    lock._close()
+
+    def _remove(self, template):
+        hash = template.hash
+        lock = FileLock(self._path(hash, '.lock'))
+        try:
+            lock._lock(fcntl.LOCK_EX)
+        except LockError:
+            # A generator is working on it.
+            return False
+        try:
+            path = self._path(hash, '.tar')
+            try:
+                if os.stat(path).st_atime != template.atime:
+                    # Used since the scan.
+                    return False
+                os.rename(path, path + '.evicting')
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                return False
+            if hash in self.inUse():
+                os.rename(path + '.evicting', path)
+                return False
+            _unlink(path + '.evicting')
+            for suffix in self.extraSuffixes:
+                _unlink(self._path(hash, suffix))
+            self.catalog.remove(hash)
+            lock._deleteLock()
+            return True
+        finally:
+            lock._close()
+
+    def asDict(self):
+        return {
+                'budget': self.budget,
+                'size': self.size,
+                'templates': self.count,
+                'kernel_trees': self.kernelCount,
+                'in_use': len(self.inUse()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evictedBytes,
+                }
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
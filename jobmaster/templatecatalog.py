@@ -0,0 +1,392 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Indexed catalog of the anaconda template cache.
+
+The files in the cache stay authoritative -- the jobslave reads the tarball
+and its C{.metadata} pickle -- but answering questions from them means
+listing the directory and unpickling every template's metadata. The catalog
+is an SQLite database, C{catalog.db} in the cache, that records for each
+template its trove and kernel specs, size, sha1, how long it took to build,
+when it was built, how often it was handed out and when it was last used.
+
+The generator adds a template once it is committed, along with how long
+each phase and MANIFEST command of the build took, the proxy counts hits,
+and eviction removes the template again. Timings are kept after eviction,
+for C{timingsAge} seconds, so builds of a trove can be compared over time.
+Templates built before the catalog existed are added the first time they are
+asked for, or all at once with C{rebuild}. A broken or locked catalog is
+logged and otherwise ignored, so it can never keep a template from being
+served.
+
+Run this module to query the catalog::
+
+    python -m jobmaster.templatecatalog list [--sort FIELD] [-n N]
+    python -m jobmaster.templatecatalog top [--by hits|size|duration] [-n N]
+    python -m jobmaster.templatecatalog show <hash>
+    python -m jobmaster.templatecatalog timings [--trove NAME]
+    python -m jobmaster.templatecatalog rebuild
+"""
+
+import cPickle
+import errno
+import logging
+import os
+import sqlite3
+import sys
+import time
+from jobmaster.util import prettySize
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    hash        TEXT PRIMARY KEY,
+    trove_name  TEXT NOT NULL,
+    trovespec   TEXT NOT NULL,
+    kernelspec  TEXT,
+    size        INTEGER NOT NULL,
+    sha1        TEXT,
+    duration    REAL,
+    created     REAL NOT NULL,
+    hits        INTEGER NOT NULL DEFAULT 0,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS templates_trove_name ON templates (trove_name);
+CREATE INDEX IF NOT EXISTS templates_created ON templates (created);
+CREATE INDEX IF NOT EXISTS templates_hits ON templates (hits);
+CREATE INDEX IF NOT EXISTS templates_last_access ON templates (last_access);
+CREATE INDEX IF NOT EXISTS templates_size ON templates (size);
+CREATE TABLE IF NOT EXISTS timings (
+    hash        TEXT NOT NULL,
+    trove_name  TEXT NOT NULL,
+    step        TEXT NOT NULL,
+    created     REAL NOT NULL,
+    wall        REAL NOT NULL,
+    cpu         REAL NOT NULL,
+    read_bytes  INTEGER NOT NULL,
+    write_bytes INTEGER NOT NULL,
+    shared      INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_trove_step
+    ON timings (trove_name, step, created);
+"""
+
+FIELDS = ('hash', 'trove_name', 'trovespec', 'kernelspec', 'size', 'sha1',
+        'duration', 'created', 'hits', 'last_access')
+
+
+class TemplateCatalog(object):
+    """The catalog of the template cache in C{path}."""
+    fileName = 'catalog.db'
+    # Seconds to wait for another process's write to finish
+    timeout = 30
+    # Build timings older than this, in seconds, are forgotten.
+    timingsAge = 180 * 86400
+    # A step whose last build took this many times its earlier average is
+    # flagged as a regression.
+    regressionFactor = 1.5
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        if timeout is not None:
+            self.timeout = timeout
+        self.dbPath = os.path.join(path, self.fileName)
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # Connections can't be shared with forked children, and generators
+        # and proxy workers are forked from the jobmaster.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.dbPath, timeout=self.timeout)
+            conn.row_factory = sqlite3.Row
+            conn.executescript(SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _write(self, sql, args=(), more=()):
+        """
+        Run C{sql} with C{args}, then each (sql, args) in C{more}, in one
+        transaction. Returns C{False} if the catalog couldn't be updated.
+        """
+        try:
+            conn = self._db()
+            try:
+                conn.execute(sql, args)
+                for extraSql, extraArgs in more:
+                    conn.execute(extraSql, extraArgs)
+            except:
+                conn.rollback()
+                raise
+            conn.commit()
+        except sqlite3.Error, err:
+            if str(err) == 'database is locked':
+                log.debug("Template catalog is busy; not updated")
+            else:
+                log.warning("Could not update the template catalog:",
+                        exc_info=True)
+                self._conn = None
+            return False
+        return True
+
+    def add(self, hash, troveSpec, kernelSpec, size, sha1, duration=None,
+            created=None, timings=()):
+        """
+        Record a newly built template, and the C{timings} of its build as
+        kept by L{jobmaster.templategen.StepTimings}.
+        """
+        troveName = troveSpec.split('=')[0]
+        created = created or time.time()
+        more = [("DELETE FROM timings WHERE created < ?",
+            (time.time() - self.timingsAge,))]
+        for entry in timings:
+            more.append(("INSERT INTO timings (hash, trove_name, step, "
+                "created, wall, cpu, read_bytes, write_bytes, shared) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (hash, troveName, entry['name'], created, entry['wall'],
+                    entry['cpu'], entry['read'], entry['written'],
+                    entry['shared'] and 1 or 0)))
+        self._write("INSERT OR REPLACE INTO templates (hash, trove_name, "
+                "trovespec, kernelspec, size, sha1, duration, created, hits, "
+                "last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, NULL)",
+                (hash, troveName, troveSpec, kernelSpec, size, sha1, duration,
+                    created), more)
+
+    def addFromFiles(self, hash):
+        """
+        Record the template C{hash} from its files in the cache, e.g. one
+        built before the catalog existed. Returns C{False} if it isn't
+        there.
+        """
+        tarPath = os.path.join(self.path, hash + '.tar')
+        try:
+            st = os.stat(tarPath)
+            metadata = cPickle.load(open(tarPath + '.metadata', 'rb'))
+        except (IOError, OSError), err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        kernel = metadata.get('kernel')
+        if kernel == '<none>':
+            kernel = None
+        self.add(hash, metadata['trovespec'], kernel, st.st_size,
+                metadata.get('sha1sum'), created=st.st_mtime)
+        return True
+
+    def hit(self, hash, when=None):
+        """Count a use of the template C{hash}."""
+        return self.addHits({hash: (1, when or time.time())})
+
+    def addHits(self, hits):
+        """
+        Count uses of templates, given as a dict of C{hash: (count, time of
+        last use)}.
+        """
+        if not hits:
+            return True
+        statements = [("UPDATE templates SET hits = hits + ?, "
+            "last_access = MAX(IFNULL(last_access, 0), ?) WHERE hash = ?",
+            (count, when, hash)) for hash, (count, when) in hits.items()]
+        return self._write(*statements[0], more=statements[1:])
+
+    def remove(self, hash):
+        self._write("DELETE FROM templates WHERE hash = ?", (hash,))
+
+    def get(self, hash):
+        """Return the catalog entry for C{hash} as a dict, or C{None}."""
+        try:
+            row = self._db().execute("SELECT * FROM templates WHERE hash = ?",
+                    (hash,)).fetchone()
+        except sqlite3.Error, err:
+            if str(err) == 'database is locked':
+                log.debug("Template catalog is busy; not read")
+            else:
+                log.warning("Could not read the template catalog:",
+                        exc_info=True)
+                self._conn = None
+            return None
+        return row and dict(row) or None
+
+    def list(self, orderBy='created', descending=True, limit=None):
+        """Return catalog entries as dicts, sorted by the field C{orderBy}."""
+        if orderBy not in FIELDS:
+            raise ValueError("Unknown field %r" % (orderBy,))
+        sql = "SELECT * FROM templates ORDER BY %s %s" % (orderBy,
+                descending and 'DESC' or 'ASC')
+        args = ()
+        if limit:
+            sql += " LIMIT ?"
+            args = (limit,)
+        return [dict(x) for x in self._db().execute(sql, args)]
+
+    def find(self, prefix):
+        """Return the entries whose hash starts with C{prefix}."""
+        return [dict(x) for x in self._db().execute(
+            "SELECT * FROM templates WHERE hash LIKE ?",
+            (prefix.replace('%', '').replace('_', '') + '%',))]
+
+    def stepTimings(self, troveName=None):
+        """
+        Return build timings aggregated per trove name and step, in the
+        order the steps ran. Each has the number of builds, the average and
+        last wall time, average CPU time and bytes read and written, and
+        whether the last build was a regression.
+        """
+        sql = ("SELECT trove_name, step, COUNT(*) AS builds, "
+                "SUM(wall) AS wall_total, AVG(cpu) AS cpu, "
+                "AVG(read_bytes) AS read_bytes, "
+                "AVG(write_bytes) AS write_bytes, "
+                "(SELECT wall FROM timings AS last "
+                "  WHERE last.trove_name = timings.trove_name "
+                "  AND last.step = timings.step "
+                "  ORDER BY created DESC LIMIT 1) AS last_wall "
+                "FROM timings ")
+        args = ()
+        if troveName:
+            sql += "WHERE trove_name = ? "
+            args = (troveName,)
+        sql += "GROUP BY trove_name, step ORDER BY trove_name, MIN(rowid)"
+        results = []
+        for row in self._db().execute(sql, args):
+            row = dict(row)
+            builds = row['builds']
+            row['wall'] = row['wall_total'] / builds
+            row['regression'] = False
+            if builds > 1:
+                earlier = (row['wall_total'] - row['last_wall']) / (builds - 1)
+                row['regression'] = (row['last_wall']
+                        > earlier * self.regressionFactor)
+            del row['wall_total']
+            results.append(row)
+        return results
+
+    def summary(self):
+        row = self._db().execute("SELECT COUNT(*), TOTAL(size), TOTAL(hits) "
+                "FROM templates").fetchone()
+        return {'templates': row[0], 'size': int(row[1]),
+                'hits': int(row[2])}
+
+    def rebuild(self):
+        """
+        Bring the catalog in line with the files in the cache: add templates
+        it is missing and drop entries whose tarball is gone. Returns the
+        number added and removed.
+        """
+        present = set(x[:-4] for x in os.listdir(self.path)
+                if x.endswith('.tar'))
+        known = set(x['hash'] for x in self.list())
+        added = removed = 0
+        for hash in sorted(present - known):
+            if self.addFromFiles(hash):
+                added += 1
+        for hash in sorted(known - present):
+            self.remove(hash)
+            removed += 1
+        return added, removed
+
+
+def _formatTime(when):
+    if not when:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(when))
+
+
+def _printEntries(entries):
+    print '%-12s %10s %6s %9s %-16s %-16s %s' % ('HASH', 'SIZE', 'HITS',
+            'BUILD', 'CREATED', 'LAST USED', 'TROVE')
+    for entry in entries:
+        duration = entry['duration']
+        print '%-12s %10s %6d %9s %-16s %-16s %s' % (entry['hash'][:12],
+                prettySize(entry['size']), entry['hits'],
+                duration is not None and '%.1fs' % duration or '-',
+                _formatTime(entry['created']),
+                _formatTime(entry['last_access']), entry['trovespec'])
+
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage=
+            "%prog [options] list|top|show <hash>|timings|rebuild")
+    parser.add_option('-c', '--config-file',
+            help="Jobmaster configuration to find the template cache in")
+    parser.add_option('-d', '--dir',
+            help="Template cache to use instead of the configured one")
+    parser.add_option('-n', '--limit', type='int', default=0,
+            help="Show at most this many templates (default: all, or 10 "
+            "for top)")
+    parser.add_option('--sort', default='created', choices=FIELDS,
+            help="Field to sort the list by (default: created)")
+    parser.add_option('--trove', metavar='NAME',
+            help="Only show timings for builds of this trove")
+    parser.add_option('--by', default='hits',
+            choices=('hits', 'size', 'duration', 'last_access'),
+            help="Field to rank templates by for top (default: hits)")
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("No command given")
+    command, args = args[0], args[1:]
+
+    if options.dir:
+        path = options.dir
+    else:
+        from jobmaster import config
+        cfg = config.MasterConfig()
+        cfg.read(options.config_file or config.CONFIG_PATH)
+        path = cfg.getTemplateCache()
+    catalog = TemplateCatalog(path)
+
+    if command == 'list' and not args:
+        _printEntries(catalog.list(options.sort, limit=options.limit))
+        summary = catalog.summary()
+        print '%d templates, %s, %d hits' % (summary['templates'],
+                prettySize(summary['size']), summary['hits'])
+    elif command == 'top' and not args:
+        _printEntries(catalog.list(options.by, limit=options.limit or 10))
+    elif command == 'show' and len(args) == 1:
+        matches = catalog.find(args[0])
+        if len(matches) != 1:
+            print >> sys.stderr, "%d templates match %s" % (len(matches),
+                    args[0])
+            return 1
+        for field in FIELDS:
+            value = matches[0][field]
+            if field in ('created', 'last_access'):
+                value = _formatTime(value)
+            print '%-12s %s' % (field + ':', value)
+    elif command == 'timings' and not args:
+        print '%-24s %-40s %6s %9s %9s %9s %10s %10s' % ('TROVE', 'STEP',
+                'BUILDS', 'WALL', 'LAST', 'CPU', 'READ', 'WRITTEN')
+        for row in catalog.stepTimings(options.trove):
+            print '%-24s %-40s %6d %8.1fs %8.1fs %8.1fs %10s %10s%s' % (
+                    row['trove_name'], row['step'][:40], row['builds'],
+                    row['wall'], row['last_wall'], row['cpu'],
+                    prettySize(row['read_bytes']),
+                    prettySize(row['write_bytes']),
+                    row['regression'] and '  slower' or '')
+    elif command == 'rebuild' and not args:
+        added, removed = catalog.rebuild()
+        print 'Added %d templates, removed %d' % (added, removed)
+    else:
+        parser.error("Bad command")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
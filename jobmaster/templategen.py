@@ -19,19 +19,29 @@ import copy
 import cPickle
 import errno
 import fcntl
+import json
 import logging
 import os
+import Queue
 import re
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from conary.conaryclient import ConaryClient
 from conary.lib import digestlib
 from conary.lib import util
 from conary.lib.log import setupLogging
 from conary.deps import deps
+from jobmaster.changesetcache import ChangesetCache
+from jobmaster.cpiogz import writeCpioGz
 from jobmaster.subprocutil import Lockable, LockError, Subprocess
-from jobmaster.util import call, logCall, makeConstants, specHash
+from jobmaster.templatecache import KernelCache
+from jobmaster.templatecatalog import TemplateCatalog
+from jobmaster.util import (call, cpuCount, freezeTroveTup, listTree,
+        logCall, makeConstants, resourceUsage, specHash, thawTroveTup,
+        FileCopier)
 
 log = logging.getLogger(__name__)
 
@@ -39,41 +49,156 @@ log = logging.getLogger(__name__)
 TemplateStatus = makeConstants('TemplateStatus', 'IN_PROGRESS NOT_FOUND DONE')
 
 
+class ManifestStep(object):
+    """
+    One MANIFEST command, with the paths it reads and writes so that it can
+    be ordered against the others.
+    """
+    index = None
+    line = None
+
+    def __init__(self, func, args=(), reads=(), writes=(), exclusive=False):
+        self.func = func
+        self.args = args
+        self.reads = list(reads)
+        self.writes = list(writes)
+        # Steps whose effects aren't known run with nothing else going on.
+        self.exclusive = exclusive
+        self.after = set()
+
+    def run(self):
+        return self.func(*self.args)
+
+    def dependsOn(self, other):
+        """Return C{True} if this step must wait for C{other} to finish."""
+        if self.exclusive or other.exclusive:
+            return True
+        return (_overlaps(other.writes, self.reads + self.writes)
+                or _overlaps(other.reads, self.writes))
+
+
+class StepTimings(object):
+    """
+    Wall time, CPU time and bytes read and written for each phase of a
+    template build and each MANIFEST command. The CPU and I/O figures are for
+    the whole generator process, including the commands it runs, so when
+    MANIFEST commands run side by side each one's figures include the
+    others'; such entries are marked as shared.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._running = []
+        self._lock = threading.Lock()
+        self._begin = resourceUsage()
+
+    def start(self, name):
+        record = {'name': name, 'shared': False}
+        self._lock.acquire()
+        try:
+            if self._running:
+                record['shared'] = True
+                for other in self._running:
+                    other['shared'] = True
+            self._running.append(record)
+        finally:
+            self._lock.release()
+        record['_start'] = resourceUsage()
+        return record
+
+    def stop(self, record):
+        end = resourceUsage()
+        self._lock.acquire()
+        try:
+            self._running.remove(record)
+            self._add(record, record.pop('_start'), end)
+        finally:
+            self._lock.release()
+
+    def _add(self, record, start, end):
+        record['wall'], record['cpu'], record['read'], record['written'] = [
+                b - a for a, b in zip(start, end)]
+        self.records.append(record)
+
+    def total(self):
+        """Add an entry for the whole build so far and return the list."""
+        self._add({'name': 'total', 'shared': False}, self._begin,
+                resourceUsage())
+        return self.records
+
+
 class TemplateGenerator(Lockable, Subprocess):
     procName = 'template generator'
 
     Status = TemplateStatus
 
-    def __init__(self, troveTup, kernelTup, conaryCfg, workDir):
+    # How many MANIFEST commands may run at once, 0 for one per CPU
+    manifestJobs = 0
+    # gzip level for cpiogz images, unless the MANIFEST sets one
+    compressLevel = 9
+    # Threads compressing each cpiogz image, 0 for one per CPU
+    compressThreads = 0
+
+    def __init__(self, troveTup, kernelTup, conaryCfg, workDir,
+            incremental=False, changesetCache=None, catalog=None):
         self._troveTup = troveTup
         self._kernelTup = kernelTup
         self._cfg = conaryCfg
+        self._csCache = changesetCache
+        # Start from, and afterwards keep, the contents root of the last
+        # build with the same trove name.
+        self._incremental = incremental
 
         self._hash = specHash([troveTup] + (kernelTup and [kernelTup] or []))
         self._basePath = os.path.join(os.path.abspath(workDir), self._hash)
         self._outputPath = self._basePath + '.tar'
+        # The proxy passes its own catalog, which doesn't wait for a busy
+        # database.
+        self._catalog = catalog or TemplateCatalog(
+                os.path.dirname(self._outputPath))
+        self._kernels = KernelCache(os.path.join(
+            os.path.dirname(self._outputPath), 'kernels'))
         self._lockPath = self._basePath + '.lock'
 
         self._workDir = self._contentsDir = self._outputDir = None
+        self._copier = None
+        self._timings = None
+        self._dirLock = threading.Lock()
+        self._createdDirs = []
+        self._keepRoot = incremental
 
         self._log = logging.getLogger(__name__ + '.' + self._hash[:4])
 
     def __del__(self):
         self._close()
 
+    @property
+    def hash(self):
+        return self._hash
+
+    @property
+    def path(self):
+        return self._outputPath
+
     def _exists(self):
         return os.path.exists(self._outputPath)
 
     def getTemplate(self, start=True):
-        # First try to open the file and return it. Opening ensures that the
-        # atime is touched, thus preventing tmpwatch from deleting the file
-        # between now and when the jobslave retrieves it.
+        # First try to open the file and return it. The caller is expected to
+        # hold a lease on the template cache entry by now, so it can't be
+        # evicted between here and when the jobslave retrieves it. The
+        # catalog is kept in step with what's on disk.
+        entry = self._catalog.get(self._hash)
         try:
             open(self._outputPath, 'rb')
         except IOError, err:
             if err.errno != errno.ENOENT:
                 raise
+            if entry:
+                self._catalog.remove(self._hash)
         else:
+            if not entry:
+                self._catalog.addFromFiles(self._hash)
             return self.Status.DONE, self._outputPath
 
         # Now we know the template doesn't exist. Get an exclusive lock to
@@ -102,12 +227,22 @@ class TemplateGenerator(Lockable, Subprocess):
         assert self._lockLevel == fcntl.LOCK_EX
         self._lock(fcntl.LOCK_EX)
         try:
-            self._workDir = tempfile.mkdtemp(prefix='tempdir-',
+            # The hash lets the cache's evictor tell whether the build that
+            # left a work directory behind is still running.
+            self._workDir = tempfile.mkdtemp(
+                    prefix='tempdir-%s-' % self._hash,
                     dir=os.path.dirname(self._outputPath))
             self._contentsDir = self._workDir + '/root'
             self._outputDir = self._workDir + '/output'
             self._kernelDir = self._workDir + '/kernel'
-            self._generate()
+            self._timings = StepTimings()
+            # The build has its own process, so it can wait for the catalog.
+            self._catalog = TemplateCatalog(os.path.dirname(self._outputPath))
+            try:
+                self._generate()
+            except:
+                self._logTimings(self._timings.total(), 'failed')
+                raise
             self._deleteLock()
         finally:
             self._lock(fcntl.LOCK_UN)
@@ -116,6 +251,14 @@ class TemplateGenerator(Lockable, Subprocess):
     run = generate
 
     def _installContents(self, root, troves):
+        self._applyJob(root, [(x[0], (None, None), (x[1], x[2]), True)
+            for x in troves])
+
+    def _updateContents(self, root, oldTup, newTup):
+        self._applyJob(root, [(newTup[0], (oldTup[1], oldTup[2]),
+            (newTup[1], newTup[2]), False)])
+
+    def _applyJob(self, root, jobList):
         cfg = copy.deepcopy(self._cfg)
         cfg.root = root
         cfg.autoResolve = False
@@ -125,9 +268,11 @@ class TemplateGenerator(Lockable, Subprocess):
         try:
             self._log.debug("Preparing update job")
             job = cli.newUpdateJob()
-            jobList = [(x[0], (None, None), (x[1], x[2]), True)
-                    for x in troves]
-            cli.prepareUpdateJob(job, jobList, resolveDeps=False)
+            kwargs = {}
+            if self._csCache:
+                kwargs['fromChangesets'] = [
+                        self._csCache.getChangeSet(cli.getRepos(), jobList)]
+            cli.prepareUpdateJob(job, jobList, resolveDeps=False, **kwargs)
 
             self._log.debug("Applying update job")
             cli.applyUpdateJob(job, noScripts = True)
@@ -136,17 +281,37 @@ class TemplateGenerator(Lockable, Subprocess):
             job = None
             cli.close()
 
+    def _timed(self, name, func, *args):
+        if self._timings is None:
+            return func(*args)
+        record = self._timings.start(name)
+        try:
+            return func(*args)
+        finally:
+            self._timings.stop(record)
+
+    def _logTimings(self, timings, status):
+        # One line per build, for log processing
+        self._log.info("Template timings: %s", json.dumps({
+            'hash': self._hash,
+            'trove': self._troveTup[0],
+            'status': status,
+            'steps': timings,
+            }, sort_keys=True))
+
     def _generate(self):
         self._log.info("Generating template %s from trove %s=%s[%s]",
                 self._hash, *self._troveTup)
 
-        self._installContents(self._contentsDir, [self._troveTup])
-
-        # Copy "unified" directly into the output.
-        os.mkdir(self._outputDir)
-        util.copytree(self._contentsDir + '/unified', self._outputDir + '/')
+        reused = (self._incremental
+                and self._timed('update contents', self._reuseRoot))
+        if not reused:
+            self._timed('install contents', self._installContents,
+                    self._contentsDir, [self._troveTup])
+        self._copier = FileCopier()
 
         # Process the MANIFEST file.
+        steps = []
         for line in open(self._contentsDir + '/MANIFEST'):
             line = line.rstrip()
             if not line or line[0] == '#':
@@ -157,16 +322,24 @@ class TemplateGenerator(Lockable, Subprocess):
             if not commandFunc:
                 raise RuntimeError("Unknown command %r in MANIFEST"
                         % (command,))
-            commandFunc(args)
+            step = commandFunc(args)
+            if step is None:
+                # Only affects how later commands are set up.
+                continue
+            step.index = len(steps)
+            step.line = line
+            steps.append(step)
 
-        # Archive the results.
-        digest = digestlib.sha1()
-        outFile = util.AtomicFile(self._outputPath)
+        # Copy "unified" directly into the output.
+        os.mkdir(self._outputDir)
+        self._timed('copy unified', self._copier.copyTree,
+                self._contentsDir + '/unified', self._outputDir)
 
-        proc = call(['/bin/tar', '-cC', self._outputDir, '.'],
-                stdout=subprocess.PIPE, captureOutput=False, wait=False)
-        util.copyfileobj(proc.stdout, outFile, digest=digest)
-        proc.wait()
+        self._runSteps(steps)
+        self._log.debug("Copied files by %s", self._copier.summary())
+
+        outFile, digest = self._timed('archive', self._archive)
+        timings = self._timings.total()
 
         # Write metadata.
         metaFile = util.AtomicFile(self._outputPath + '.metadata')
@@ -180,12 +353,199 @@ class TemplateGenerator(Lockable, Subprocess):
             # jobslave to generate old filecontainers that are compatible
             # with all versions of Conary. (See RBL-1552.)
             'netclient_protocol_version': '38',
+            'timings': timings,
             }, metaFile)
 
         metaFile.commit()
         outFile.commit()
+        self._catalog.add(self._hash, '%s=%s[%s]' % self._troveTup,
+                self._kernelTup and ('%s=%s[%s]' % self._kernelTup) or None,
+                os.stat(self._outputPath).st_size, digest.hexdigest(),
+                duration=timings[-1]['wall'], timings=timings)
 
         self._log.info("Template %s created", self._hash)
+        self._logTimings(timings, 'done')
+        if self._keepRoot:
+            self._saveRoot(steps)
+
+    def _archive(self):
+        """
+        Tar the output directory into an uncommitted C{AtomicFile}, returning
+        it and the sha1 digest of the tarball.
+        """
+        # The file list is sorted so that the archive doesn't depend on the
+        # order in which the steps finished.
+        listPath = self._workDir + '/filelist'
+        listFile = open(listPath, 'w')
+        for path in listTree(self._outputDir):
+            listFile.write(path + '\0')
+        listFile.close()
+
+        digest = digestlib.sha1()
+        outFile = util.AtomicFile(self._outputPath)
+
+        proc = call(['/bin/tar', '-cC', self._outputDir, '--no-recursion',
+            '--null', '-T', listPath],
+                stdout=subprocess.PIPE, captureOutput=False, wait=False)
+        util.copyfileobj(proc.stdout, outFile, digest=digest)
+        proc.wait()
+        return outFile, digest
+
+    def _rootPath(self):
+        return os.path.join(os.path.dirname(self._outputPath), 'roots',
+                self._troveTup[0])
+
+    def _reuseRoot(self):
+        """
+        Take the contents root kept from the last build of this trove name,
+        if there is one, and update it to this build's trove. Returns
+        C{False} if the contents still need to be installed.
+        """
+        # Claim it by moving it into our work directory, so that two builds
+        # never share one.
+        previous = self._workDir + '/previous'
+        try:
+            os.rename(self._rootPath(), previous)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            oldTup = thawTroveTup(json.load(open(previous + '/trove.json')))
+            os.rename(previous + '/root', self._contentsDir)
+            if oldTup != self._troveTup:
+                self._log.info("Updating contents from %s=%s[%s]", *oldTup)
+                self._updateContents(self._contentsDir, oldTup,
+                        self._troveTup)
+            return True
+        except:
+            self._log.warning("Could not reuse the previous contents root; "
+                    "installing from scratch", exc_info=True)
+            if os.path.exists(self._contentsDir):
+                util.rmtree(self._contentsDir)
+            return False
+
+    def _saveRoot(self, steps):
+        """
+        Remove what the MANIFEST added to the contents root, then keep it for
+        the next build of this trove name.
+        """
+        for step in reversed(steps):
+            for path in step.writes:
+                if path.startswith(self._contentsDir + '/'):
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        util.rmtree(path)
+                    elif os.path.lexists(path):
+                        os.unlink(path)
+        for path in reversed(self._createdDirs):
+            if not path.startswith(self._contentsDir + '/'):
+                continue
+            try:
+                os.rmdir(path)
+            except OSError, err:
+                if err.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+                    raise
+
+        keep = self._workDir + '/keep'
+        os.mkdir(keep)
+        json.dump(freezeTroveTup(self._troveTup),
+                open(keep + '/trove.json', 'w'))
+        os.rename(self._contentsDir, keep + '/root')
+        target = self._rootPath()
+        util.mkdirChain(os.path.dirname(target))
+        try:
+            # Replace the root of an older build that wasn't reused.
+            os.rename(target, self._workDir + '/replaced')
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        try:
+            os.rename(keep, target)
+        except OSError, err:
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Another build saved its root meanwhile; keep that one.
+            return
+        self._log.debug("Kept contents root for incremental builds")
+
+    def _runSteps(self, steps):
+        """
+        Run MANIFEST steps, each one as soon as the earlier steps it depends
+        on have finished, with up to C{manifestJobs} of them at once.
+        """
+        for step in steps:
+            step.after = set(x.index for x in steps[:step.index]
+                    if step.dependsOn(x))
+        maxJobs = self.manifestJobs or cpuCount()
+
+        pending = list(steps)
+        done = set()
+        running = 0
+        results = Queue.Queue()
+        failure = None
+        while (pending and not failure) or running:
+            if not failure:
+                for step in [x for x in pending if x.after <= done]:
+                    if running >= maxJobs:
+                        break
+                    pending.remove(step)
+                    if step.exclusive:
+                        # Everything before it has finished and nothing
+                        # after it can start, so it runs alone.
+                        self._runStep(step)
+                        done.add(step.index)
+                        break
+                    thread = threading.Thread(target=self._runStep,
+                            args=(step, results))
+                    thread.setDaemon(True)
+                    thread.start()
+                    running += 1
+            if not running:
+                continue
+            index, excInfo = results.get()
+            running -= 1
+            if excInfo:
+                failure = failure or excInfo
+            else:
+                done.add(index)
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+    def _runStep(self, step, results=None):
+        self._log.debug("Running MANIFEST command: %s", step.line)
+        if results is None:
+            self._timed(step.line, step.run)
+            return
+        try:
+            self._timed(step.line, step.run)
+        except:
+            self._log.error("MANIFEST command failed: %s", step.line)
+            results.put((step.index, sys.exc_info()))
+        else:
+            results.put((step.index, None))
+
+    def _mkdirChain(self, path):
+        # Steps running side by side may share parent directories.
+        self._dirLock.acquire()
+        try:
+            missing = []
+            parent = path
+            while not os.path.isdir(parent):
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            util.mkdirChain(path)
+            # Remembered so that a kept contents root can be cleaned up.
+            self._createdDirs.extend(reversed(missing))
+        finally:
+            self._dirLock.release()
+
+    def _checkOutput(self, path):
+        # A step that replaces a file from the trove leaves the contents root
+        # unfit to be updated by later builds.
+        if self._keepRoot and os.path.lexists(path):
+            self._log.debug("%s already exists; not keeping the contents "
+                    "root", path)
+            self._keepRoot = False
 
     def _DO_image(self, args):
         command = args.pop(0)
@@ -213,27 +573,37 @@ class TemplateGenerator(Lockable, Subprocess):
         assert outputPath.startswith(self._contentsDir + '/')
         assert finalPath.startswith(self._outputDir + '/')
 
+        # Options in effect at this point in the MANIFEST
+        kwargs = {}
+        if command == 'cpiogz':
+            kwargs['level'] = self.compressLevel
+        elif command == 'cp':
+            kwargs['mode'] = mode
+
+        return ManifestStep(self._runImage,
+                (command, commandFunc, inputPath, outputPath, finalPath,
+                    mode, kwargs),
+                reads=[inputPath], writes=[outputPath, finalPath])
+
+    def _runImage(self, command, commandFunc, inputPath, outputPath,
+            finalPath, mode, kwargs):
         if not os.path.exists(inputPath):
             raise RuntimeError("Input file %r for image command %r is missing"
-                    % (inputName, command))
+                    % (inputPath[len(self._contentsDir) + 1:], command))
 
-        util.mkdirChain(os.path.dirname(outputPath))
-        util.mkdirChain(os.path.dirname(finalPath))
-        commandFunc(inputPath, outputPath)
+        self._checkOutput(outputPath)
+        self._mkdirChain(os.path.dirname(outputPath))
+        self._mkdirChain(os.path.dirname(finalPath))
+        commandFunc(inputPath, outputPath, **kwargs)
 
         os.chmod(outputPath, mode)
         os.link(outputPath, finalPath)
 
-    def _RUN_cpiogz(self, inputDir, output):
-        oldCwd = os.getcwd()
-        os.chdir(inputDir)
-        try:
-            logCall("find . | cpio --quiet -c -o | gzip -9 > %s" % output)
-        finally:
-            try:
-                os.chdir(oldCwd)
-            except:
-                pass
+    def _RUN_cpiogz(self, inputDir, output, level=9):
+        start = time.time()
+        writeCpioGz(inputDir, output, level, self.compressThreads)
+        self._log.debug("Wrote %s (%d bytes, level %d) in %.1f seconds",
+                output, os.stat(output).st_size, level, time.time() - start)
 
     def _RUN_mkisofs(self, inputDir, output):
         logCall(['/usr/bin/mkisofs',
@@ -266,12 +636,29 @@ class TemplateGenerator(Lockable, Subprocess):
         logCall(['/sbin/mksquashfs', inputDir, output,
             '-no-fragments'])
 
-    def _RUN_cp(self, inPath, outPath):
-        util.copyfile(inPath, outPath)
+    def _RUN_cp(self, inPath, outPath, mode=None):
+        self._copier.copyFile(inPath, outPath, mode)
 
     def _RUN_ln(self, inPath, outPath):
         os.link(inPath, outPath)
 
+    def _DO_option(self, args):
+        """
+        Set an option for the MANIFEST commands after this one, e.g.
+        C{option,compressLevel,6}.
+        """
+        if len(args) != 2:
+            raise RuntimeError("Can't handle option command %r" % (args,))
+        name, value = args
+        if name == 'compressLevel':
+            level = int(value)
+            if not 0 <= level <= 9:
+                raise RuntimeError("Invalid compressLevel %r in MANIFEST"
+                        % (value,))
+            self.compressLevel = level
+        else:
+            raise RuntimeError("Unknown option %r in MANIFEST" % (name,))
+
     def _DO_kernel(self, args):
         if not self._kernelTup:
             raise RuntimeError("Encountered 'kernel' manifest command but "
@@ -279,17 +666,8 @@ class TemplateGenerator(Lockable, Subprocess):
         
         command = args.pop(0)
         if command == 'install':
-            self._installContents(self._kernelDir, [self._kernelTup])
-            # XXX - SLES 11 needs kernel-base
-            kernels = []
-            if os.path.exists(os.path.join(self._kernelDir, 'boot')):
-                kernels = [ x for x in 
-                            os.listdir(os.path.join(self._kernelDir, 'boot')) if
-                            x.startswith('vmlinuz') ]               
-            if len(kernels) == 0:
-                self._installContents(self._kernelDir,
-                    [ ('kernel-base', self._kernelTup[1], self._kernelTup[2]) ])
-            return
+            # Conary isn't safe to run alongside other steps.
+            return ManifestStep(self._installKernel, exclusive=True)
         commandFunc = getattr(self, '_KERNEL_' + command, None)
         if not commandFunc:
             raise RuntimeError("Unknown kernel command %r in MANIFEST"
@@ -313,10 +691,16 @@ class TemplateGenerator(Lockable, Subprocess):
                       args.pop(0))))
             commandArgs.append(nextArg)
 
-        # anaconda scripts may take different args, so just pass them
+        # anaconda scripts may take different args, so just pass them. There
+        # is no telling what they touch, so they run alone.
         if command == 'anacondaScript':
-            self._KERNEL_anacondaScript(commandArgs)
-            return
+            # It may also change files in place, which would show through
+            # hard links made by earlier steps, and leave the contents root
+            # in no state to be updated by later builds.
+            self._copier.hardlinks = False
+            self._keepRoot = False
+            return ManifestStep(self._KERNEL_anacondaScript, (commandArgs,),
+                    exclusive=True)
 
         # This is only for "copy" right now
         if len(commandArgs) == 3:
@@ -327,8 +711,37 @@ class TemplateGenerator(Lockable, Subprocess):
             mode = 0644
         else:
             raise RuntimeError("Can't handle kernel command %r" % (command,))
-        commandFunc(inputName, outputName, mode)
-        
+        outputFile = os.path.abspath(outputName)
+        return ManifestStep(commandFunc, (inputName, outputName, mode),
+                reads=[os.path.abspath(os.path.dirname(inputName))],
+                writes=[outputFile,
+                    outputFile.replace(self._contentsDir, self._outputDir)])
+
+    def _installKernel(self):
+        # The kernel tree is only read from, so it can come from the cache of
+        # installed kernels. Its files are hard linked unless an anaconda
+        # script might change them.
+        os.mkdir(self._kernelDir)
+        if self._kernels.get(self._kernelTup, self._kernelDir, self._copier):
+            self._log.info("Using cached kernel tree for %s=%s[%s]",
+                    *self._kernelTup)
+            return
+        self._installContents(self._kernelDir, [self._kernelTup])
+        # XXX - SLES 11 needs kernel-base
+        kernels = []
+        if os.path.exists(os.path.join(self._kernelDir, 'boot')):
+            kernels = [ x for x in 
+                        os.listdir(os.path.join(self._kernelDir, 'boot')) if
+                        x.startswith('vmlinuz') ]               
+        if len(kernels) == 0:
+            self._installContents(self._kernelDir,
+                [ ('kernel-base', self._kernelTup[1], self._kernelTup[2]) ])
+        try:
+            self._kernels.put(self._kernelTup, self._kernelDir, self._copier)
+        except:
+            # The build doesn't need it.
+            self._log.warning("Could not cache the kernel tree:",
+                    exc_info=True)
 
     def _KERNEL_copy(self, inputSpec, outputFile, mode):
         inputDir = os.path.abspath(os.path.dirname(inputSpec))
@@ -342,10 +755,11 @@ class TemplateGenerator(Lockable, Subprocess):
         # We only expect one match.  If there are more, they
         # should be identical, anyway
         match = [ x for x in os.listdir(inputDir) if x.startswith(inputFileSpec) ][0]
-        util.mkdirChain(os.path.dirname(outputFile))
-        util.mkdirChain(os.path.dirname(finalFile))
+        self._checkOutput(outputFile)
+        self._mkdirChain(os.path.dirname(outputFile))
+        self._mkdirChain(os.path.dirname(finalFile))
         self._log.info("copying %s to %s", os.path.join(inputDir, match), outputFile)
-        util.copyfile(os.path.join(inputDir, match), outputFile)
+        self._copier.copyFile(os.path.join(inputDir, match), outputFile, mode)
         os.chmod(outputFile, mode)   
         self._log.info("linking %s to %s", outputFile, finalFile)
         os.link(outputFile, finalFile)
@@ -365,41 +779,116 @@ class TemplateGenerator(Lockable, Subprocess):
         
         logCall([ "bash", "-x", scriptPath ] + argList, stderr=open(self._basePath + '.log', 'w'))
 
+def _overlaps(paths, others):
+    """Return C{True} if any path in C{paths} is, or contains, or is
+    contained by, any path in C{others}."""
+    for path in paths:
+        for other in others:
+            if (path == other or other.startswith(path + '/')
+                    or path.startswith(other + '/')):
+                return True
+    return False
+
+
+def runGenerators(generators, maxJobs, wait=True, poll=1.0):
+    """
+    Build the templates for C{generators}, with at most C{maxJobs} of them
+    building at once. With C{wait}, also wait for templates that someone
+    else was already building. Returns (generator, status, path) for each.
+    """
+    waiting = list(generators)
+    running = []
+    while waiting or running:
+        while waiting and len(running) < maxJobs:
+            generator = waiting.pop(0)
+            generator.getTemplate(start=True)
+            if generator.pid:
+                running.append(generator)
+        for generator in running[:]:
+            if not generator.check():
+                running.remove(generator)
+        if running:
+            time.sleep(poll)
+
+    results = []
+    for generator in generators:
+        while True:
+            status, path = generator.getTemplate(start=False)
+            if not wait or status != TemplateStatus.IN_PROGRESS:
+                break
+            time.sleep(poll)
+        results.append((generator, status, path))
+    return results
+
+
 def main(args):
-    import time
+    import optparse
     from conary import conarycfg
     from conary.conaryclient.cmdline import parseTroveSpec
 
+    parser = optparse.OptionParser(usage=
+            "%prog <troveSpec> <kernelSpec> [<workDir>]\n"
+            "       %prog --batch <specFile> [--jobs <N>] [<workDir>]")
+    parser.add_option('--batch', metavar='FILE',
+            help="Generate the templates listed in FILE, one "
+            "'<troveSpec> [<kernelSpec>]' per line ('-' for stdin)")
+    parser.add_option('-j', '--jobs', type='int', default=0,
+            help='Templates to generate at once (default: one per CPU)')
+    parser.add_option('--changesets', metavar='DIR',
+            help="Cache downloaded changesets in DIR")
+    parser.add_option('--incremental', action='store_true',
+            help="Start from the contents of the last template built for "
+            "the same trove name, and keep them for the next one")
+    options, args = parser.parse_args(args)
+
     setupLogging(consoleLevel=logging.DEBUG, consoleFormat='file')
 
-    if len(args) == 2:
-        troveSpec, kernelSpec, workDir = args[0], args[1], '.'
-    elif len(args) == 3:
-        troveSpec, kernelSpec, workDir = args
+    if options.batch:
+        if len(args) > 1:
+            parser.error("Too many arguments")
+        workDir = args and args[0] or '.'
+        if options.batch == '-':
+            fObj = sys.stdin
+        else:
+            fObj = open(options.batch)
+        specs = []
+        for line in fObj:
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            if len(words) > 2:
+                parser.error("Bad line in spec file: %r" % line)
+            specs.append((words[0], len(words) > 1 and words[1] or None))
+    elif len(args) in (2, 3):
+        specs = [(args[0], args[1])]
+        workDir = len(args) == 3 and args[2] or '.'
     else:
-        sys.exit("Usage: %s <troveSpec> <kernelSpec> [<workDir>]" % sys.argv[0])
+        parser.error("Wrong number of arguments")
 
     cfg = conarycfg.ConaryConfiguration(False)
     cfg.configLine('includeConfigFile http://localhost/conaryrc')
     cli = ConaryClient(cfg)
     repos = cli.getRepos()
 
-    troveTup = sorted(repos.findTrove(None, parseTroveSpec(troveSpec)))[-1]
-    kernelTup = sorted(repos.findTrove(None, parseTroveSpec(kernelSpec)))[-1]
-
-    generator = TemplateGenerator(troveTup, kernelTup, cfg, workDir)
-    generator.getTemplate(start=True)
-    while True:
-        status, path = generator.getTemplate(start=False)
-        if status == generator.Status.NOT_FOUND:
-            print 'Failed!'
-            break
-        elif status == generator.Status.DONE:
+    csCache = options.changesets and ChangesetCache(options.changesets)
+    generators = []
+    for troveSpec, kernelSpec in specs:
+        troveTup = sorted(repos.findTrove(None, parseTroveSpec(troveSpec)))[-1]
+        kernelTup = kernelSpec and sorted(repos.findTrove(None,
+            parseTroveSpec(kernelSpec)))[-1] or None
+        generators.append(TemplateGenerator(troveTup, kernelTup, cfg,
+            workDir, incremental=options.incremental,
+            changesetCache=csCache))
+
+    failed = 0
+    for generator, status, path in runGenerators(generators,
+            options.jobs or cpuCount()):
+        if status == generator.Status.DONE:
             print 'Done:', path
-            break
-        time.sleep(1)
-
-    generator.wait()
+        else:
+            print 'Failed: %s=%s[%s]' % generator._troveTup
+            failed += 1
+    return failed and 1 or 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Schedules anaconda template builds.
+
+Templates that need building are queued rather than built right away, so
+that a burst of new groups doesn't start a conary install and image build for
+each one at once. The queue is a directory under the template cache with one
+C{<hash>.req} file per template, so that every process can add to it: the
+proxy, in the jobmaster or in a proxy worker, and the pre-warm passes. The
+jobmaster's L{TemplateScheduler} starts the queued builds, most urgent first,
+with at most C{templateWorkers} running at a time.
+
+Templates that a job asked for go before pre-warm requests, and within a
+priority the oldest request goes first. A queue entry is only removed once
+its generator is running and holds the template's lock, so someone checking
+on the template always sees it either queued or in progress.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+import weakref
+from jobmaster.templategen import TemplateGenerator
+from jobmaster.util import freezeTroveTup, makeConstants, thawTroveTup
+
+log = logging.getLogger(__name__)
+
+Priority = makeConstants('Priority', 'JOB PREWARM')
+
+
+class TemplateQueue(object):
+    """Templates waiting to be built, kept as files in C{path}."""
+    statsName = 'stats.json'
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, hash):
+        return os.path.join(self.path, hash + '.req')
+
+    def add(self, hash, rbuilderUrl, troveTup, kernelTup, priority):
+        """
+        Queue the template C{hash}, or raise the priority of its entry if it
+        is already queued.
+        """
+        entry = self.get(hash)
+        if entry:
+            if entry['priority'] <= priority:
+                return
+            # Keep the original time, so the wait is counted from the first
+            # request.
+            entry['priority'] = priority
+        else:
+            entry = {
+                    'hash': hash,
+                    'time': time.time(),
+                    'priority': priority,
+                    'url': rbuilderUrl,
+                    'template': freezeTroveTup(troveTup),
+                    'kernel': kernelTup and freezeTroveTup(kernelTup) or None,
+                    }
+        self._write(self._path(hash), entry)
+
+    def _write(self, path, data):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd, tmpPath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        fObj = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, fObj)
+            fObj.close()
+            os.rename(tmpPath, path)
+        except:
+            fObj.close()
+            os.unlink(tmpPath)
+            raise
+
+    def get(self, hash):
+        try:
+            return json.load(open(self._path(hash)))
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return None
+
+    def isQueued(self, hash):
+        return os.path.exists(self._path(hash))
+
+    def remove(self, hash):
+        try:
+            os.unlink(self._path(hash))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def clear(self):
+        for entry in self.entries():
+            self.remove(entry['hash'])
+
+    def entries(self):
+        """Return the queued requests, the one to build next first."""
+        try:
+            names = os.listdir(self.path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        entries = []
+        for name in names:
+            if name.endswith('.req'):
+                entry = self.get(name[:-4])
+                if entry:
+                    entries.append(entry)
+        entries.sort(key=lambda x: (x['priority'], x['time']))
+        return entries
+
+    def saveStats(self, stats):
+        self._write(os.path.join(self.path, self.statsName), stats)
+
+    def loadStats(self):
+        try:
+            return json.load(open(os.path.join(self.path, self.statsName)))
+        except (IOError, ValueError):
+            return {}
+
+    def asDict(self):
+        now = time.time()
+        entries = self.entries()
+        depth = dict((x.lower(), 0) for x in Priority.names)
+        for entry in entries:
+            depth[Priority.values[entry['priority']].lower()] += 1
+        result = self.loadStats()
+        result['depth'] = len(entries)
+        result['depth_by_priority'] = depth
+        result['oldest_wait'] = entries and (now - min(x['time']
+            for x in entries)) or 0
+        return result
+
+
+class TemplateScheduler(object):
+    """
+    Starts the builds in the template queue from the jobmaster's main loop,
+    C{workers} at a time.
+    """
+
+    def __init__(self, jobmaster, workers):
+        self.jobmaster = weakref.ref(jobmaster)
+        self.workers = workers
+        self.queue = TemplateQueue(jobmaster.cfg.getTemplateQueue())
+        self.running = []
+        self.started = 0
+        self.waitTotal = self.waitMax = 0.0
+        self.waitByPriority = {}
+
+    def check(self):
+        changed = False
+        for generator in self.running[:]:
+            if not generator.check():
+                self.running.remove(generator)
+                changed = True
+        if len(self.running) < self.workers:
+            for entry in self.queue.entries():
+                if len(self.running) >= self.workers:
+                    break
+                try:
+                    self._start(entry)
+                except:
+                    log.exception("Could not start building template %s:",
+                            entry['hash'])
+                self.queue.remove(entry['hash'])
+                changed = True
+        if changed:
+            self._saveStats()
+
+    def _start(self, entry):
+        jobmaster = self.jobmaster()
+        generator = TemplateGenerator(thawTroveTup(entry['template']),
+                entry['kernel'] and thawTroveTup(entry['kernel']) or None,
+                jobmaster.getConaryConfig(str(entry['url'])),
+                jobmaster.cfg.getTemplateCache(),
+                incremental=jobmaster.cfg.templateIncremental,
+                changesetCache=jobmaster.getChangesetCache())
+        generator.getTemplate(start=True)
+        if not generator.pid:
+            # Already built, or someone else is building it.
+            return
+        self.running.append(generator)
+
+        wait = time.time() - entry['time']
+        self.started += 1
+        self.waitTotal += wait
+        self.waitMax = max(self.waitMax, wait)
+        name = Priority.values[entry['priority']].lower()
+        count, total = self.waitByPriority.get(name, (0, 0.0))
+        self.waitByPriority[name] = (count + 1, total + wait)
+        log.info("Building template %s after %.1f seconds in the queue",
+                generator.hash, wait)
+
+    def _saveStats(self):
+        self.queue.saveStats({
+            'workers': self.workers,
+            'running': len(self.running),
+            'started': self.started,
+            'mean_wait': self.started and self.waitTotal / self.started or 0,
+            'max_wait': self.waitMax,
+            'mean_wait_by_priority': dict((name, total / count)
+                for name, (count, total) in self.waitByPriority.items()),
+            })
@@ -0,0 +1,345 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Spool-and-forward for image uploads.
+
+Instead of relaying an C{/uploadBuild/} request to the rBuilder as it arrives,
+the proxy can write the request to a spool directory and answer the slave as
+soon as the body is on disk. Entries are forwarded in the background and
+retried with a growing delay until the rBuilder accepts them, including ones
+left over from before a restart.
+
+Each entry is a C{.data} file holding the request body and a C{.json} file,
+written once the body is complete, holding the target URL and the request
+header. The body is synced to disk by the forwarder rather than the writer.
+Entries are named after the image they belong to so that they are forwarded
+in the order they arrived. Later requests for an image that still has entries
+waiting are spooled too, so that, for example, the final status update does
+not overtake the upload it refers to.
+
+Whoever writes or forwards an entry holds an exclusive C{flock} on its data
+file, which lets several proxy worker processes share one spool directory.
+"""
+
+import errno
+import fcntl
+import httplib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import urlparse
+import weakref
+
+log = logging.getLogger(__name__)
+
+IMAGE_PATH = re.compile(r'^/(?:uploadBuild|api/v1/images)/(\d+)(?:/|$)')
+
+
+class SpoolWriter(object):
+    """
+    Takes the place of the upstream connection while a client's request body
+    is written to the spool.
+    """
+    connected = True
+    out_buffer = ''
+    out_pipe = None
+
+    def __init__(self, spool, name, targetUrl, header):
+        self.spool = spool
+        self.name = name
+        self.targetUrl = targetUrl
+        self.header = header
+        # Lock the data file before it appears under its real name, so that
+        # a forwarder never mistakes it for one whose writer went away.
+        path = spool._path(name, '.data')
+        self.fObj = open(path + '.tmp', 'wb')
+        fcntl.flock(self.fObj.fileno(), fcntl.LOCK_EX)
+        os.rename(path + '.tmp', path)
+        self.size = 0
+
+    def send(self, data):
+        self.fObj.write(data)
+        self.size += len(data)
+
+    def copyable(self):
+        return True
+
+    def send_pending(self):
+        return 0
+
+    def pair_closed(self):
+        """The client went away before the body was complete."""
+        self.abort()
+
+    def commit(self):
+        """Make the entry visible to the forwarders."""
+        # The forwarder syncs the body before sending it, which keeps a
+        # large fsync out of the event loop.
+        self.fObj.flush()
+        self.spool._writeMeta(self.name, {
+            'target': self.targetUrl,
+            'header': self.header.decode('latin-1'),
+            'size': self.size,
+            })
+        self.fObj.close()
+        self.spool.wake()
+
+    def abort(self):
+        if self.fObj.closed:
+            return
+        _unlink(self.spool._path(self.name, '.data'))
+        self.fObj.close()
+
+
+class UploadSpool(object):
+    """
+    Spool directory plus the background thread that forwards its entries.
+    """
+    # Free space to leave on the spool filesystem, in bytes.
+    reserve = 1 << 30
+    # Seconds between scans when nothing wakes the forwarder.
+    interval = 10
+    # Retry delays after a failed forward, in seconds.
+    minRetry = 10
+    maxRetry = 600
+    # Socket timeout while forwarding, in seconds.
+    timeout = 300
+
+    def __init__(self, path, server):
+        self.path = path
+        self.server = weakref.ref(server)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.retries = {}
+        self.forwarded = self.failed = 0
+        self._event = threading.Event()
+        # Started on the first check so that it belongs to the process that
+        # serves requests.
+        self._thread = None
+
+    def _path(self, name, suffix):
+        return os.path.join(self.path, name + suffix)
+
+    def _writeMeta(self, name, meta):
+        path = self._path(name, '.json')
+        fObj = open(path + '.tmp', 'w')
+        json.dump(meta, fObj)
+        fObj.flush()
+        os.fsync(fObj.fileno())
+        fObj.close()
+        os.rename(path + '.tmp', path)
+
+    def _entries(self):
+        """Return entry names grouped by image, oldest first."""
+        images = {}
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.data'):
+                continue
+            name = name[:-5]
+            images.setdefault(name.split('.')[0], []).append(name)
+        return images
+
+    def pending(self, imageId):
+        prefix = imageId + '.'
+        for name in os.listdir(self.path):
+            if name.startswith(prefix) and name.endswith('.data'):
+                return True
+        return False
+
+    def wants(self, method, path, headers):
+        """
+        Return the image ID if the request should be spooled, otherwise
+        C{None}.
+        """
+        match = IMAGE_PATH.match(path)
+        if not match or method not in ('PUT', 'POST'):
+            return None
+        imageId = match.group(1)
+        if 'expect' in headers:
+            # The slave wants the rBuilder's go-ahead before sending the body.
+            return None
+        if 'content-length' in headers:
+            try:
+                size = long(headers['content-length'])
+            except ValueError:
+                return None
+        elif headers.get('transfer-encoding') == 'chunked':
+            size = 0
+        else:
+            # Delimited by the connection closing, so it can't be acked.
+            return None
+        if path.startswith('/uploadBuild/'):
+            if not self.hasRoom(size):
+                return None
+        elif not self.pending(imageId):
+            return None
+        return imageId
+
+    def hasRoom(self, size):
+        stat = os.statvfs(self.path)
+        return stat.f_bavail * stat.f_frsize >= size + self.reserve
+
+    def create(self, imageId, targetUrl, header):
+        name = '%s.%.6f.%d' % (imageId, time.time(), os.getpid())
+        return SpoolWriter(self, name, targetUrl, header)
+
+    def wake(self):
+        self._event.set()
+
+    def check(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                    name='upload-spool')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def asDict(self):
+        return {
+                'entries': sum(len(x) for x in self._entries().values()),
+                'forwarded': self.forwarded,
+                'failed': self.failed,
+                'retrying': len(self.retries),
+                }
+
+    def _run(self):
+        while True:
+            try:
+                self.forwardAll()
+            except:
+                log.exception("Unhandled error in upload spool:")
+            timeout = self.interval
+            if self.retries:
+                nextRetry = min(x[0] for x in self.retries.values())
+                timeout = max(min(timeout, nextRetry - time.time()), 0)
+            self._event.wait(timeout)
+            self._event.clear()
+
+    def forwardAll(self):
+        now = time.time()
+        images = self._entries()
+        current = set(x[0] for x in images.values())
+        for name in self.retries.keys():
+            if name not in current:
+                del self.retries[name]
+        for names in images.values():
+            # Entries of one image go strictly in order.
+            for name in names:
+                retry = self.retries.get(name)
+                if retry and retry[0] > now:
+                    break
+                if not self._forwardEntry(name):
+                    break
+
+    def _forwardEntry(self, name):
+        """Try to forward one entry. Returns C{True} if it is gone."""
+        dataPath = self._path(name, '.data')
+        metaPath = self._path(name, '.json')
+        try:
+            fObj = open(dataPath, 'rb')
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return True
+            raise
+        try:
+            try:
+                fcntl.flock(fObj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, err:
+                if err.errno in (errno.EACCES, errno.EAGAIN):
+                    # Being written, or forwarded by another process.
+                    return False
+                raise
+            if not os.path.exists(dataPath):
+                # Finished by someone else after we listed it.
+                return True
+            if not os.path.exists(metaPath):
+                # Nobody is writing it, so the client went away mid-body.
+                log.warning("Removing incomplete upload %s", name)
+                _unlink(dataPath)
+                return True
+            meta = json.load(open(metaPath))
+            # The writer doesn't sync the body; make sure it is on disk
+            # before the entry can be removed.
+            os.fsync(fObj.fileno())
+
+            try:
+                status = self._send(meta, fObj)
+            except (socket.error, httplib.HTTPException), err:
+                status, reason = None, str(err)
+            else:
+                reason = 'HTTP status %d' % status
+            if status is not None and status < 300:
+                self.forwarded += 1
+            elif status is not None and status < 500:
+                log.error("Upstream rejected spooled request %s (%s); "
+                        "discarding it", name, reason)
+                self.failed += 1
+            else:
+                attempts = self.retries.get(name, (0, 0))[1] + 1
+                delay = min(self.minRetry * 2 ** (attempts - 1),
+                        self.maxRetry)
+                log.warning("Failed to forward spooled request %s (%s); "
+                        "retrying in %d seconds", name, reason, delay)
+                self.retries[name] = (time.time() + delay, attempts)
+                return False
+            self.retries.pop(name, None)
+            # Remove the metadata first, while still holding the lock, so
+            # that anyone who opened the data file meanwhile skips it.
+            _unlink(metaPath)
+            _unlink(dataPath)
+            return True
+        finally:
+            fObj.close()
+
+    def _send(self, meta, fObj):
+        """Send a spooled request upstream and return the response status."""
+        url = urlparse.urlsplit(meta['target'])
+        if url.scheme == 'https':
+            port = url.port or 443
+        elif url.scheme == 'http':
+            port = url.port or 80
+        else:
+            raise httplib.HTTPException("Invalid target URL")
+        sock = socket.create_connection((url.hostname, port), self.timeout)
+        try:
+            if url.scheme == 'https':
+                sock = self.server().tlsContext.wrap_socket(sock,
+                        server_hostname=url.hostname)
+            sock.sendall(meta['header'].encode('latin-1'))
+            while True:
+                data = fObj.read(65536)
+                if not data:
+                    break
+                sock.sendall(data)
+            response = httplib.HTTPResponse(sock)
+            response.begin()
+            response.read()
+            return response.status
+        finally:
+            sock.close()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
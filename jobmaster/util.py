@@ -16,11 +16,16 @@
 
 
 import errno
+import fcntl
 import logging
 import os
 import select
+import shutil
+import stat
 import subprocess
 import sys
+import threading
+import time
 from conary.lib import digestlib
 from jobmaster.osutil import _close_fds
 
@@ -50,6 +55,34 @@ class CommandError(RuntimeError):
                 self.cmd, self.rv)
 
 
+def cpuCount():
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (ValueError, OSError):
+        return 1
+
+
+def resourceUsage():
+    """
+    Return (wall clock time, CPU seconds, bytes read, bytes written) so far
+    for this process, all its threads and the children it has reaped. The
+    byte counts cover every read and write, whether or not it reached the
+    disk, and are 0 where C{/proc/self/io} isn't available.
+    """
+    times = os.times()
+    read = written = 0
+    try:
+        for line in open('/proc/self/io'):
+            key, value = line.split(':', 1)
+            if key == 'rchar':
+                read = int(value)
+            elif key == 'wchar':
+                written = int(value)
+    except IOError:
+        pass
+    return time.time(), sum(times[:4]), read, written
+
+
 def devNull():
     return open('/dev/null', 'w+')
 
@@ -176,6 +209,21 @@ def rewriteFile(template, target, data):
     os.unlink(template)
 
 
+def listTree(top, parent='.'):
+    """
+    List everything under C{top}, relative to it and starting with C{.}, the
+    way C{find .} would but in name order.
+    """
+    paths = parent == '.' and ['.'] or []
+    for name in sorted(os.listdir(os.path.join(top, parent))):
+        path = os.path.join(parent, name)
+        paths.append(path)
+        full = os.path.join(top, path)
+        if os.path.isdir(full) and not os.path.islink(full):
+            paths.extend(listTree(top, path))
+    return paths
+
+
 def logCall(cmd, **kw):
     # This function logs by default.
     kw.setdefault('logCmd', True)
@@ -219,6 +267,21 @@ def specHash(troveTups, buildTimes=None):
     return digestlib.sha1('\0'.join(str(x) for x in items)).hexdigest()
 
 
+def freezeTroveTup(troveTup):
+    """Turn a trove tuple into plain strings, e.g. for JSON."""
+    name, version, flavor = troveTup
+    return [name, version.freeze(), flavor.freeze()]
+
+
+def thawTroveTup(frozen):
+    """Undo L{freezeTroveTup}."""
+    from conary import versions
+    from conary.deps import deps
+    # JSON hands back unicode, which conary doesn't expect.
+    name, version, flavor = [str(x) for x in frozen]
+    return (name, versions.ThawVersion(version), deps.ThawFlavor(flavor))
+
+
 def tryInterruptable(func, *args, **kwargs):
     while True:
         try:
@@ -287,3 +350,115 @@ def prettySize(num):
             return '%.01f %s' % (float(num) / (1024 ** power), suffix)
     else:
         return '%d B' % num
+
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+class FileCopier(object):
+    """
+    Copy files as cheaply as the filesystem allows, and count the bytes that
+    went each way:
+     - C{reflink}: share the source's extents (C{FICLONE}), which gives an
+       independent file without writing the data again;
+     - C{hardlink}: when hard links are allowed, the source has no other
+       links (or is known never to be modified) and the copy would get the
+       same mode. This relies on the caller never modifying the source or
+       the copy in place afterwards;
+     - C{copy}: copy the data, like C{shutil.copy2}.
+    """
+    strategies = ('reflink', 'hardlink', 'copy')
+
+    def __init__(self, hardlinks=True):
+        self.hardlinks = hardlinks
+        self.reflinks = True
+        self.bytes = dict((x, 0) for x in self.strategies)
+        self.files = dict((x, 0) for x in self.strategies)
+        self._lock = threading.Lock()
+
+    def _count(self, strategy, size):
+        self._lock.acquire()
+        try:
+            self.bytes[strategy] += size
+            self.files[strategy] += 1
+        finally:
+            self._lock.release()
+
+    def copyFile(self, source, dest, mode=None, readOnly=False):
+        """
+        Copy C{source} to C{dest}, following symlinks. If C{mode} is given,
+        the copy is about to be given that mode. With C{readOnly}, the source
+        is never modified, so it may be hard linked even if it already has
+        other links.
+        """
+        st = os.stat(source)
+        if self.reflinks and self._reflink(source, dest, st):
+            self._count('reflink', st.st_size)
+            return 'reflink'
+        if (self.hardlinks and (st.st_nlink == 1 or readOnly)
+                and (mode is None or mode == stat.S_IMODE(st.st_mode))):
+            try:
+                os.link(os.path.realpath(source), dest)
+            except OSError, err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+            else:
+                self._count('hardlink', st.st_size)
+                return 'hardlink'
+        shutil.copy2(source, dest)
+        self._count('copy', st.st_size)
+        return 'copy'
+
+    def _reflink(self, source, dest, st):
+        src = open(source, 'rb')
+        try:
+            dst = open(dest, 'wb')
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except IOError, err:
+                dst.close()
+                os.unlink(dest)
+                if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY,
+                        errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                    # Not supported here; don't bother trying again.
+                    self.reflinks = False
+                    return False
+                raise
+            dst.close()
+        finally:
+            src.close()
+        shutil.copystat(source, dest)
+        return True
+
+    def copyTree(self, source, dest, symlinks=False, readOnly=False):
+        """
+        Copy the contents of directory C{source} into directory C{dest}.
+        Symlinks are followed, unless C{symlinks} is set, in which case they
+        are copied as symlinks. C{readOnly} is passed to L{copyFile}.
+        """
+        for dirPath, dirNames, fileNames in os.walk(source,
+                followlinks=not symlinks):
+            destDir = os.path.join(dest, os.path.relpath(dirPath, source))
+            if not os.path.isdir(destDir):
+                os.mkdir(destDir)
+                shutil.copystat(dirPath, destDir)
+            if symlinks:
+                # Links to directories are listed with the directories.
+                for name in dirNames[:]:
+                    path = os.path.join(dirPath, name)
+                    if os.path.islink(path):
+                        os.symlink(os.readlink(path),
+                                os.path.join(destDir, name))
+                        dirNames.remove(name)
+            for name in fileNames:
+                path = os.path.join(dirPath, name)
+                if symlinks and os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(destDir, name))
+                    continue
+                self.copyFile(path, os.path.join(destDir, name),
+                        readOnly=readOnly)
+
+    def summary(self):
+        return ', '.join('%s %s in %d files' % (x, prettySize(self.bytes[x]),
+            self.files[x]) for x in self.strategies)
@@ -17,6 +17,7 @@
 
 #include <Python.h>
 
+#include <fcntl.h>
 #include <unistd.h>
 
 #include "pycompat.h"
@@ -87,11 +88,37 @@ pysethostname(PyObject *self, PyObject *args) {
 }
 
 
+static PyObject *
+pysplice(PyObject *self, PyObject *args) {
+    int fd_in, fd_out;
+    Py_ssize_t len;
+    unsigned int flags = 0;
+    ssize_t rv;
+
+    if (!PyArg_ParseTuple(args, "iin|I", &fd_in, &fd_out, &len, &flags)) {
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    rv = splice(fd_in, NULL, fd_out, NULL, len, flags);
+    Py_END_ALLOW_THREADS
+
+    if (rv < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+
+    return PyLong_FromSsize_t(rv);
+}
+
+
 static PyMethodDef OSMethods[] = {
     { "_close_fds", py_close_fds, METH_VARARGS,
         "Close all file descriptors" },
     { "sethostname", pysethostname, METH_VARARGS,
         "Set the system hostname" },
+    { "splice", pysplice, METH_VARARGS,
+        "Move data between a file descriptor and a pipe in the kernel" },
     { NULL }
 };
 